@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+bench_goodness_of_fit.py -- compare scoring many simulations with
+``goodness_of_fit`` with calling the single simulation metric functions
+in a loop, as ``OptimizationResult.result_table`` used to.
+
+Usage:
+    python benchmarks/bench_goodness_of_fit.py [n_sims] [n_years]
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from prms_python import goodness_of_fit
+from prms_python.util import nash_sutcliffe, percent_bias, rmse
+
+
+def timed(fun):
+    start = time.time()
+    ret = fun()
+    return time.time() - start, ret
+
+
+def loop_metrics(observed, simulated):
+    "Previous per simulation scoring with pandas"
+    rows = []
+    for sim in simulated:
+        sim = pd.Series(sim, index=observed.index)
+        rows.append([
+            nash_sutcliffe(observed, sim), rmse(observed, sim),
+            percent_bias(observed, sim), observed.corr(sim)**2
+        ])
+    return np.array(rows)
+
+
+def main(n_sims=10000, n_years=10):
+    rng = np.random.RandomState(0)
+    dates = pd.date_range('1980-10-01', periods=int(n_years * 365.25))
+    observed = pd.Series(rng.gamma(2.0, 100.0, size=len(dates)), index=dates)
+    simulated = observed.values * rng.uniform(0.5, 1.5, size=(n_sims, 1)) * \
+        np.exp(rng.normal(0, 0.1, size=(n_sims, len(dates))))
+
+    n_loop = min(n_sims, 500)
+    t_loop, loop = timed(lambda: loop_metrics(observed, simulated[:n_loop]))
+    t_daily, daily = timed(lambda: goodness_of_fit(observed, simulated))
+    t_month, _ = timed(
+        lambda: goodness_of_fit(observed, simulated, freq='monthly')
+    )
+
+    gaps = observed.copy()
+    gaps.iloc[::9] = np.nan
+    t_gaps, _ = timed(lambda: goodness_of_fit(gaps, simulated))
+
+    same = np.allclose(
+        loop, daily[['NSE', 'RMSE', 'PBIAS', 'COEF_DET']].values[:n_loop]
+    )
+
+    print('{} simulations of {} days'.format(n_sims, len(dates)))
+    print('loop over simulations: {:.2f} s (extrapolated from {})'.format(
+        t_loop * n_sims / n_loop, n_loop))
+    print('goodness_of_fit daily:               {:.2f} s'.format(t_daily))
+    print('goodness_of_fit monthly:             {:.2f} s'.format(t_month))
+    print('goodness_of_fit daily, observed gaps: {:.2f} s'.format(t_gaps))
+    print('metrics identical: {}'.format(same))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
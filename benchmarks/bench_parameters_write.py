@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+'''
+bench_parameters_write.py -- compare ``Parameters.write`` with the original
+line-by-line writer on a synthetic, large PRMS parameter file.
+
+Usage:
+    python benchmarks/bench_parameters_write.py [nhru] [n_modified]
+'''
+from __future__ import print_function
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from prms_python import Parameters
+
+OPJ = os.path.join
+
+
+def make_parameter_file(path, nhru, n_nhru=20, n_nhru_nmonths=20, seed=0):
+    "Write a PRMS parameter file with nhru and nhru by nmonths parameters"
+    rng = np.random.RandomState(seed)
+    with open(path, 'w') as f:
+        f.write('Synthetic parameter file\nVersion: 1.7\n** Dimensions **\n')
+        for name, val in (('nhru', nhru), ('nmonths', 12), ('one', 1)):
+            f.write('####\n{}\n{}\n'.format(name, val))
+        f.write('** Parameters **\n')
+        # spatial parameters typically take a few distinct values, e.g. one
+        # per vegetation or soil type, monthly ones are continuous
+        for i in range(n_nhru):
+            f.write('####\nhru_param_{}\n1\nnhru\n{}\n2\n'.format(i, nhru))
+            classes = rng.rand(10)
+            f.write('\n'.join(map(repr, classes[rng.randint(10, size=nhru)]
+                                   .tolist())) + '\n')
+        for i in range(n_nhru_nmonths):
+            f.write('####\nmonthly_param_{}\n2\nnhru\nnmonths\n{}\n2\n'.format(
+                i, nhru * 12))
+            f.write('\n'.join(map(repr, rng.rand(nhru * 12).tolist())) +
+                    '\n')
+
+
+def legacy_write(params, out_name):
+    "The line-by-line ``Parameters.write`` of PRMS-Python 1.0.1"
+    data_type_dic = {'1': 'int',
+                     '2': 'float'}
+
+    with open(params.base_file, 'r') as base_file:
+        with open(out_name, 'w') as out_file:
+            out_file.write('File Auto-generated by PRMS-Python\n')
+            out_file.write(datetime.datetime.now().isoformat() + '\n')
+            out_file.write('** Dimensions **\n')
+
+            name_is_next = False
+            params_start = False
+            write_params_lines = False
+            for l in base_file:
+
+                if not params_start and l.strip() == '** Parameters **':
+                    out_file.write('** Parameters **\n')
+                    params_start = True
+
+                elif l.strip() == '####':
+                    name_is_next = True
+
+                elif name_is_next:
+                    name = l.strip().split()[0]
+                    if name not in params.param_arrays:
+                        out_file.write('####\n')
+                        out_file.write(name + '\n')
+                        name_is_next = False
+                        write_params_lines = True
+                    else:
+                        write_params_lines = False
+                        name_is_next = False
+
+                elif write_params_lines:
+                    out_file.write(l.strip() + '\n')
+
+            for param, new_arr in params.param_arrays.items():
+
+                out_file.write('####\n')
+
+                param_info = [el for el in params.base_params
+                              if el['name'] == param].pop()
+
+                out_file.write(str(param_info['name']) + '\n')
+                out_file.write(str(param_info['ndims']) + '\n')
+                for dimname in param_info['dimnames']:
+                    out_file.write(dimname + '\n')
+                out_file.write(str(param_info['length']) + '\n')
+                out_file.write(str(param_info['vartype']) + '\n')
+                out_file.writelines([str(a) + '\n'
+                                     for a in new_arr.flatten().
+                                     astype(data_type_dic[param_info
+                                                          ['vartype']])])
+
+
+def best_of(fun, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fun()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(nhru=20000, n_modified=4):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        base = OPJ(tmp_dir, 'parameters')
+        make_parameter_file(base, nhru)
+        size_mb = os.path.getsize(base) / 1e6
+
+        p = Parameters(base)
+        names = [param['name'] for param in p.base_params]
+        # modify half spatial, half monthly parameters
+        hru_names = [n for n in names if n.startswith('hru')]
+        monthly_names = [n for n in names if n.startswith('monthly')]
+        modified = hru_names[:n_modified // 2] +\
+            monthly_names[:n_modified - n_modified // 2]
+        for name in modified:
+            p[name] = p[name] * 1.1
+
+        legacy_out = OPJ(tmp_dir, 'legacy')
+        new_out = OPJ(tmp_dir, 'new')
+        t_legacy = best_of(lambda: legacy_write(p, legacy_out))
+        t_new = best_of(lambda: p.write(new_out))
+
+        # outputs are identical apart from the timestamp on the second line
+        with open(legacy_out, 'rb') as a, open(new_out, 'rb') as b:
+            identical = a.readlines()[2:] == b.readlines()[2:]
+
+        print('parameter file: {:.1f} MB, nhru={}, {} of {} params modified'
+              .format(size_mb, nhru, n_modified, len(names)))
+        print('legacy write: {:.3f} s'.format(t_legacy))
+        print('new write:    {:.3f} s ({:.1f}x)'.format(
+            t_new, t_legacy / t_new))
+        print('outputs identical: {}'.format(identical))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''
+bench_statvar_cache.py -- compare reloading the statvar output of many
+simulations from text with reloading their binary copies created by
+``cache_statvar``, as done when scoring an optimization stage repeatedly.
+
+Usage:
+    python benchmarks/bench_statvar_cache.py [n_sims] [n_years] [n_vars]
+'''
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from prms_python import cache_statvar, load_statvar
+
+OPJ = os.path.join
+
+
+def make_statvar_file(path, n_years, n_vars, seed=0):
+    "Write a daily PRMS statvar file with n_vars variables"
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('1980-10-01', periods=int(n_years * 365.25))
+    values = rng.gamma(2.0, 100.0, size=(len(dates), n_vars))
+    with open(path, 'w') as f:
+        f.write('{}\n'.format(n_vars))
+        f.write(''.join('var_{} 1\n'.format(i) for i in range(n_vars)))
+        rows = np.column_stack([
+            np.arange(1, len(dates) + 1), dates.year, dates.month, dates.day,
+            np.zeros((len(dates), 3))
+        ])
+        fmt = ['%d'] * 7 + ['%f'] * n_vars
+        np.savetxt(f, np.column_stack([rows, values]), fmt=fmt)
+
+
+def timed(fun):
+    start = time.time()
+    fun()
+    return time.time() - start
+
+
+def main(n_sims=2000, n_years=10, n_vars=10):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        template = OPJ(tmp_dir, 'template')
+        make_statvar_file(template, n_years, n_vars)
+        paths = []
+        for i in range(n_sims):
+            sim_dir = OPJ(tmp_dir, 'sim_{}'.format(i), 'outputs')
+            os.makedirs(sim_dir)
+            paths.append(OPJ(sim_dir, 'statvar.dat'))
+            shutil.copy(template, paths[-1])
+        size_mb = os.path.getsize(template) / 1e6
+
+        # score one variable of every simulation, as result_table does
+        load_one = lambda: [load_statvar(p, 'var_0_1') for p in paths]
+        load_all = lambda: [load_statvar(p) for p in paths]
+        t_text_one = timed(load_one)
+        t_text_all = timed(load_all)
+
+        t_convert = timed(lambda: [cache_statvar(p) for p in paths])
+        cache_mb = os.path.getsize(paths[0] + '.npy') / 1e6
+        t_cache_one = timed(load_one)
+        t_cache_all = timed(load_all)
+
+        same = load_statvar(paths[0]).values.tolist() == \
+            load_statvar(template).values.tolist()
+
+        print('{} simulations, statvar file {:.2f} MB text, {:.2f} MB binary '
+              '({} days, {} variables)'.format(
+                  n_sims, size_mb, cache_mb, int(n_years * 365.25), n_vars))
+        print('one-time conversion:   {:.2f} s'.format(t_convert))
+        print('reload one variable:   text {:.2f} s, binary {:.2f} s ({:.1f}x)'
+              .format(t_text_one, t_cache_one, t_text_one / t_cache_one))
+        print('reload all variables:  text {:.2f} s, binary {:.2f} s ({:.1f}x)'
+              .format(t_text_all, t_cache_all, t_text_all / t_cache_all))
+        print('values identical: {}'.format(same))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
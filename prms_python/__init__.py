@@ -16,9 +16,21 @@ __name__ = 'prms_python'
 __author__ = 'John Volk and Matthew Turner'
 __version__ = '1.0.1'
 
+from prms_python.cache import ResultCache
+from prms_python.control import Control
 from prms_python.data import Data
+from prms_python.jobqueue import JobQueue
 from prms_python.optimizer import Optimizer, OptimizationResult
-from prms_python.parameters import Parameters, modify_params
+from prms_python.parameters import (
+    Parameters, ParameterOverlay, modify_params
+)
+from prms_python.pool import WorkerPool
+from prms_python.retention import Retention
+from prms_python.schedule import CostModel
+from prms_python.scratch import ScratchSpace
 from prms_python.simulation import Simulation, SimulationSeries
 from prms_python.scenario import Scenario, ScenarioSeries
-from prms_python.util import load_statvar, load_data, nash_sutcliffe
+from prms_python.warmstart import WarmStart
+from prms_python.util import (
+    cache_statvar, goodness_of_fit, load_statvar, load_data, nash_sutcliffe
+)
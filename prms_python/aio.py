@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+'''
+aio.py -- :mod:`asyncio` backend that runs many PRMS simulations from one
+event loop, used by ``SimulationSeries``, ``ScenarioSeries`` and
+``Optimizer.monte_carlo`` with ``backend='asyncio'``. Requires Python 3.7
+or later and is therefore not imported by ``prms_python`` itself.
+'''
+
+import asyncio
+import functools
+import multiprocessing as mp
+import subprocess
+import time
+
+from .simulation import (
+    _CACHED_USAGE, _NEW_PROCESS_GROUP, _file_stats, _kill_process_group,
+    _no_usage, _store_outputs, _timeout_message
+)
+
+
+async def run_simulation(simulation, prms_exec='prms', cache_statvar=False,
+                         timeout=None, retries=0, scratch=None, cache=None):
+    '''
+    Run a single :class:`Simulation` as an asyncio subprocess.
+
+    If the awaiting task is cancelled the PRMS process is killed before the
+    cancellation propagates, its outputs are left unorganized. The event
+    loop reaps PRMS, so its CPU time and peak memory are not recorded.
+
+    Arguments:
+        simulation (:class:`Simulation`): simulation to run
+
+    Keyword Arguments:
+        prms_exec (str): name of PRMS executable on $PATH or path to
+            executable
+        cache_statvar (bool or numpy.dtype): convert the *statvar.dat*
+            output to a binary copy, see :meth:`Simulation.run`
+        timeout (float or None): wall-clock seconds after which PRMS is
+            killed, see :meth:`Simulation.run`
+        retries (int): number of times a failed run is repeated
+        scratch (:class:`ScratchSpace` or None): run PRMS in a slot of this
+            scratch space, waiting for one without blocking the loop
+        cache (:class:`ResultCache` or None): reuse cached outputs of a run
+            with the same inputs, see :meth:`Simulation.run`
+
+    Returns:
+        :class:`Simulation`: ``simulation`` after it has run
+    '''
+    argv, run_dir = simulation._command(prms_exec)
+    loop = asyncio.get_running_loop()
+    stage_dir = None
+    if scratch is not None:
+        stage_dir = await _stage(scratch, run_dir)
+    try:
+        before = await loop.run_in_executor(
+            None, _file_stats, stage_dir or run_dir
+        )
+        start = time.time()
+        key, link, hit = await loop.run_in_executor(
+            None, simulation._cache_lookup, cache, argv, stage_dir or run_dir,
+            stage_dir is not None
+        )
+        if hit:
+            await loop.run_in_executor(
+                None, functools.partial(
+                    simulation._finish_run, 0, b'', time.time() - start,
+                    cache_statvar, attempts=0, usage=_CACHED_USAGE,
+                    before=before, scratch=scratch, stage_dir=stage_dir,
+                    cached=True
+                )
+            )
+            return simulation
+
+        for attempt in range(1 + retries):
+            returncode, stderr, timed_out = await _run_prms(
+                argv, stage_dir or run_dir, timeout
+            )
+            if returncode == 0:
+                break
+        wall_time = time.time() - start
+
+        if key is not None and returncode == 0:
+            await loop.run_in_executor(
+                None, _store_outputs, cache, key, stage_dir or run_dir,
+                before, wall_time, link
+            )
+
+        # moving files and converting the statvar file block, keep the loop
+        # free
+        await loop.run_in_executor(
+            None, functools.partial(
+                simulation._finish_run, returncode, stderr, wall_time,
+                cache_statvar, timed_out=timed_out, attempts=attempt + 1,
+                usage=_no_usage(), before=before, scratch=scratch,
+                stage_dir=stage_dir
+            )
+        )
+    finally:
+        if stage_dir is not None:
+            scratch.release(stage_dir)
+
+    return simulation
+
+
+async def _stage(scratch, run_dir):
+    "Wait for a scratch slot in a thread, releasing it if cancelled meanwhile"
+    future = asyncio.get_running_loop().run_in_executor(
+        None, scratch.stage, run_dir
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        def _release(future):
+            if not future.cancelled() and future.exception() is None:
+                scratch.release(future.result())
+        future.add_done_callback(_release)
+        raise
+
+
+async def _run_prms(argv, run_dir, timeout=None):
+    "Asyncio version of simulation._run_prms"
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *argv, cwd=run_dir, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, **_NEW_PROCESS_GROUP
+        )
+    except OSError as e:
+        return 127, str(e).encode('utf-8'), False
+
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        _kill_process_group(proc)
+        await proc.wait()
+        return proc.returncode, _timeout_message(timeout), True
+    except asyncio.CancelledError:
+        _kill_process_group(proc)
+        await proc.wait()
+        raise
+
+    return proc.returncode, stderr, False
+
+
+async def run_scenario(scenario, prms_exec='prms', timeout=None, retries=0,
+                       cache=None):
+    '''
+    Run a built :class:`Scenario` as an asyncio subprocess and write its
+    metadata.
+
+    Arguments:
+        scenario (:class:`Scenario`): scenario to run
+
+    Keyword Arguments:
+        prms_exec (str): name of PRMS executable on $PATH or path to
+            executable
+        timeout (float or None): see :meth:`Simulation.run`
+        retries (int): see :meth:`Simulation.run`
+        cache (:class:`ResultCache` or None): see :meth:`Simulation.run`
+
+    Returns:
+        :class:`Scenario`: ``scenario`` after it has run
+    '''
+    scenario._start_run()
+    await run_simulation(
+        scenario.simulation, prms_exec=prms_exec, timeout=timeout,
+        retries=retries, cache=cache
+    )
+    scenario._finish_run()
+
+    return scenario
+
+
+async def as_completed(runner, items, nproc=None, **kwargs):
+    '''
+    Asynchronous generator that runs ``runner(item, **kwargs)`` for all
+    ``items`` with at most ``nproc`` running at once and yields the
+    results as they finish, in order of completion.
+
+    Closing the generator early with its ``aclose`` method, e.g. by
+    iterating it within :func:`contextlib.aclosing`, or cancelling the task
+    that iterates it cancels all outstanding runs and kills their PRMS
+    processes.
+
+    Arguments:
+        runner (coroutine function): :func:`run_simulation` or
+            :func:`run_scenario`
+        items (iterable): simulations or scenarios to run
+
+    Keyword Arguments:
+        nproc (int or None): maximum number of PRMS processes running at
+            once, default half of the available processors
+        **kwargs: passed on to ``runner``
+
+    Yields:
+        results of ``runner`` in order of completion
+
+    Example:
+        Score each simulation as soon as it finishes,
+
+        >>> async for sim in as_completed(run_simulation, simulations, 8):
+                score(sim.simulation_dir)
+    '''
+    if not nproc:
+        nproc = max(1, mp.cpu_count() // 2)
+    semaphore = asyncio.Semaphore(nproc)
+
+    async def limited(item):
+        async with semaphore:
+            return await runner(item, **kwargs)
+
+    tasks = [asyncio.ensure_future(limited(item)) for item in items]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_all(runner, items, nproc=None, **kwargs):
+    '''
+    Run ``runner(item, **kwargs)`` for all ``items`` with at most ``nproc``
+    running at once, see :func:`as_completed`.
+
+    Returns:
+        :obj:`list`: ``items`` after all have run
+    '''
+    items = list(items)
+    async for _ in as_completed(runner, items, nproc=nproc, **kwargs):
+        pass
+
+    return items
+
+
+def iter_sync(async_iterator):
+    '''
+    Iterate an asynchronous iterator, e.g. :func:`as_completed`, from
+    synchronous code in a new event loop. Stopping the iteration early
+    closes ``async_iterator``.
+
+    Raises:
+        RuntimeError: if called while an event loop is running
+    '''
+    _check_no_running_loop()
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                item = loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+            yield item
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+def run_sync(coroutine):
+    '''
+    Run ``coroutine`` to completion in a new event loop from synchronous
+    code.
+
+    Raises:
+        RuntimeError: if called while an event loop is running, e.g. in a
+            Jupyter notebook, where the coroutine should be awaited instead
+    '''
+    try:
+        _check_no_running_loop()
+    except RuntimeError:
+        coroutine.close()
+        raise
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+def _check_no_running_loop():
+    "Raise RuntimeError if an event loop is running in this thread"
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    raise RuntimeError(
+        'An event loop is already running, await the run_async method '
+        'instead of calling run with backend="asyncio"'
+    )
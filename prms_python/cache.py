@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+'''
+cache.py -- holds ``ResultCache``, a content-addressed cache of PRMS outputs
+that lets simulations with the same inputs reuse the outputs of an earlier
+run instead of running PRMS again.
+'''
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from .control import Control
+
+OPJ = os.path.join
+
+# control file entries naming files PRMS writes, their names are part of the
+# cache key but not their contents
+OUTPUT_ENTRIES = (
+    'stat_var_file', 'model_output_file', 'var_save_file', 'ani_output_file',
+    'csv_output_file', 'map_output_file', 'nhruOutBaseFileName',
+    'nsubOutBaseFileName', 'basinOutBaseFileName'
+)
+
+# control file entries naming parameter files, PRMS ignores the two header
+# lines before their first section, e.g. the time they were written
+PARAMETER_ENTRIES = ('param_file',)
+
+_META_FILE = 'entry.json'
+
+# digests of input files named by paths outside of simulation directories,
+# e.g. the shared base parameter file of overlay simulations, by path,
+# inode, size, mtime and ctime, least recently used first
+_DIGESTS = OrderedDict()
+_DIGESTS_LOCK = threading.Lock()
+_MAX_DIGESTS = 64
+
+
+class ResultCache(object):
+    '''
+    Content-addressed cache of the outputs of successful PRMS runs.
+
+    The key of a run is a SHA-256 hash of the identity of the PRMS
+    executable (its resolved path, size and modification time and the
+    arguments), the normalized *control* file, i.e. its entries without the
+    description and in a fixed order, and the raw bytes of every input file
+    it names, e.g. the *data* file, the parameter files including the base
+    file of an overlay, without their header lines, and a warm start state
+    file. Paths of inputs do not
+    matter, only their contents, so the same parameters written by
+    different stages, reruns or scenario grids give the same key. The
+    digest of a file named by a path outside the simulation directory,
+    like the shared base parameter file of overlay simulations, is computed
+    once per process while it is not changed, for the most recently used
+    of such files.
+
+    On a hit the cached outputs are hard linked, or copied if ``link`` is
+    False or the cache is on another file system, into the simulation
+    directory and PRMS is not run, the simulation's ``cached`` attribute is
+    True. Outputs of runs that failed are not cached. Linked outputs share
+    their contents with the cache, they must be replaced rather than
+    modified in place, as e.g. :class:`Retention` does.
+
+    When the cache holds more than ``max_bytes`` or ``max_entries`` the
+    least recently used entries are removed. Several processes may share a
+    cache directory.
+
+    Arguments:
+        root (str): cache directory, created if needed
+
+    Keyword Arguments:
+        max_bytes (int or None): size limit of the cached outputs in bytes,
+            default None for no limit
+        max_entries (int or None): maximum number of cached runs, default
+            None for no limit
+        link (bool): hard link outputs into and out of the cache instead
+            of copying them. Default True.
+
+    Example:
+        Stages of an optimization that sample the same parameter values
+        only run PRMS once for them,
+
+        >>> cache = ResultCache('calibration_cache', max_bytes=50 * 2**30)
+        >>> optr.monte_carlo(measured, names, 'basin_cfs_1', cache=cache)
+    '''
+
+    def __init__(self, root, max_bytes=None, max_entries=None, link=True):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.link = link
+
+    def key(self, argv, run_dir):
+        '''
+        Cache key of running PRMS with ``argv`` in ``run_dir``.
+
+        Arguments:
+            argv (list): PRMS argument vector, the *control* file last
+            run_dir (str): directory PRMS runs in
+
+        Returns:
+            str: hexadecimal SHA-256 digest
+        '''
+        h = hashlib.sha256()
+        exe = _which(argv[0])
+        if exe is not None:
+            st = os.stat(exe)
+            exe = [os.path.realpath(exe), st.st_size, st.st_mtime]
+        _update(h, {'exec': exe, 'args': argv[1:-1]})
+
+        control = Control(OPJ(run_dir, argv[-1]))
+        run_dir = os.path.abspath(run_dir) + os.sep
+        for name in sorted(control):
+            values = control[name]
+            if name not in OUTPUT_ENTRIES:
+                values = [self._input_digest(v, run_dir, name)
+                          for v in values]
+            _update(h, [name, values])
+
+        return h.hexdigest()
+
+    def _input_digest(self, value, run_dir, name=None):
+        "Digest of the file a control file value names, else the value"
+        if not isinstance(value, str):
+            return value
+        path = OPJ(run_dir, value)
+        if not os.path.isfile(path):
+            return value
+
+        # only files named by paths outside the run directory are shared by
+        # simulations, inputs staged in scratch space link outside of it
+        return _file_digest(
+            path, memoize=not os.path.abspath(path).startswith(run_dir),
+            skip_header=name in PARAMETER_ENTRIES
+        )
+
+    def fetch(self, key, run_dir, link=None):
+        '''
+        Link or copy the cached outputs of ``key`` into ``run_dir``.
+
+        Keyword Arguments:
+            link (bool or None): whether to hard link, default ``link`` of
+                the cache. Outputs that PRMS may later overwrite in place,
+                e.g. in an ``input_dir`` that is run again, must be copied.
+
+        Returns:
+            :obj:`dict` or None: metadata of the cache entry with the
+                ``files`` it holds, their size in ``bytes`` and the
+                ``wall_time`` of the run that created it, None if ``key``
+                is not cached
+        '''
+        entry = self._entry(key)
+        try:
+            with open(OPJ(entry, _META_FILE)) as f:
+                meta = json.load(f)
+            for name in meta['files']:
+                dst = OPJ(run_dir, name)
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                elif not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                self._transfer(OPJ(entry, name), dst, link)
+        except (IOError, OSError, ValueError, KeyError):
+            # not cached or evicted meanwhile
+            return None
+
+        # the modification time of an entry is its last use
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+        return meta
+
+    def store(self, key, run_dir, files, wall_time=None, link=None):
+        '''
+        Cache the output ``files`` of a successful run in ``run_dir``.
+
+        Arguments:
+            key (str): cache key from :meth:`ResultCache.key`
+            run_dir (str): directory PRMS ran in
+            files (list): paths of the outputs relative to ``run_dir``
+
+        Keyword Arguments:
+            wall_time (float or None): seconds PRMS took
+            link (bool or None): see :meth:`ResultCache.fetch`
+
+        Returns:
+            None
+        '''
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+
+        tmp = '{}.{}.tmp'.format(entry, uuid.uuid4().hex)
+        try:
+            os.makedirs(tmp)
+            size = 0
+            for name in files:
+                dst = OPJ(tmp, name)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                self._transfer(OPJ(run_dir, name), dst, link)
+                size += os.path.getsize(dst)
+            with open(OPJ(tmp, _META_FILE), 'w') as f:
+                json.dump({'files': sorted(files), 'bytes': size,
+                           'wall_time': wall_time, 'created': time.time()}, f)
+            os.rename(tmp, entry)
+        except OSError as e:
+            # ENOTEMPTY or EEXIST: another process cached the same run
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        if self.max_bytes is not None or self.max_entries is not None:
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache is within
+        ``max_bytes`` and ``max_entries``.
+
+        Returns:
+            int: number of removed entries
+        '''
+        entries = self._entries()
+        entries.sort(key=lambda e: e[1])
+        total = sum(e[2] for e in entries)
+        removed = 0
+        for path, _, size in entries:
+            if (self.max_bytes is None or total <= self.max_bytes) and \
+                    (self.max_entries is None or
+                     len(entries) - removed <= self.max_entries):
+                break
+            _remove_entry(path)
+            total -= size
+            removed += 1
+
+        return removed
+
+    def info(self):
+        '''
+        Number of cached runs and their total size.
+
+        Returns:
+            :obj:`dict`: with ``entries`` and ``bytes``
+        '''
+        entries = self._entries()
+
+        return {'entries': len(entries),
+                'bytes': sum(e[2] for e in entries)}
+
+    def clear(self):
+        "Remove all cached runs"
+        for path, _, _ in self._entries():
+            _remove_entry(path)
+
+    def _entry(self, key):
+        return OPJ(self.root, key[:2], key)
+
+    def _entries(self):
+        "Path, last use and size of every complete entry"
+        ret = []
+        if not os.path.isdir(self.root):
+            return ret
+        for prefix in os.listdir(self.root):
+            prefix_dir = OPJ(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if '.' in name:
+                    continue # being written or removed
+                path = OPJ(prefix_dir, name)
+                try:
+                    with open(OPJ(path, _META_FILE)) as f:
+                        size = json.load(f)['bytes']
+                    ret.append((path, os.path.getmtime(path), size))
+                except (IOError, OSError, ValueError, KeyError):
+                    continue # being written or removed
+
+        return ret
+
+    def _transfer(self, src, dst, link=None):
+        if link is None:
+            link = self.link
+        if link and hasattr(os, 'link'):
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass # e.g. another file system
+        shutil.copy2(src, dst)
+
+    def __repr__(self):
+        return '<ResultCache {}>'.format(self.root)
+
+
+def _update(h, obj):
+    h.update(json.dumps(obj, sort_keys=True).encode('utf-8'))
+    h.update(b'\0')
+
+
+def _file_digest(path, memoize=False, skip_header=False):
+    '''
+    SHA-256 digest of the raw bytes of a file, from its first line starting
+    with ** with skip_header
+    '''
+    st = os.stat(path)
+    memo_key = (os.path.realpath(path), st.st_ino, st.st_size, st.st_mtime,
+                st.st_ctime, skip_header)
+    with _DIGESTS_LOCK:
+        if memo_key in _DIGESTS:
+            # mark as most recently used
+            _DIGESTS[memo_key] = _DIGESTS.pop(memo_key)
+            return _DIGESTS[memo_key]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if skip_header:
+            for line in iter(f.readline, b''):
+                if line.startswith(b'**'):
+                    h.update(line)
+                    break
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    digest = 'sha256:' + h.hexdigest()
+    if memoize:
+        with _DIGESTS_LOCK:
+            _DIGESTS[memo_key] = digest
+            while len(_DIGESTS) > _MAX_DIGESTS:
+                _DIGESTS.popitem(last=False)
+
+    return digest
+
+
+def _which(program):
+    "Path of an executable given by path or name on $PATH, or None"
+    if os.path.dirname(program):
+        return program if os.path.isfile(program) else None
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = OPJ(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+
+    return None
+
+
+def _remove_entry(path):
+    "Remove an entry, renamed first so it is never found half removed"
+    trash = '{}.{}.removed'.format(path, uuid.uuid4().hex)
+    try:
+        os.rename(path, trash)
+    except OSError:
+        return
+    shutil.rmtree(trash, ignore_errors=True)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+'''
+control.py -- holds ``Control`` class for reading, modifying and writing
+the PRMS *control* file.
+'''
+
+from __future__ import print_function
+import io
+import numbers
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+# control file data types to Python types, 1=int, 2=float, 3=double, 4=string
+_TYPES = {'1': int, '2': float, '3': float, '4': str}
+
+
+class Control(object):
+    '''
+    Parse a PRMS *control* file once and modify and write copies of it.
+
+    Each entry of the *control* file is a name with a data type and a list
+    of values, entries are accessed and assigned by name as lists of
+    Python values. Assigning a single value sets a list of one value,
+    assigning an entry that does not exist adds it with a data type
+    inferred from the values. Convenience properties and methods exist
+    for the simulation period, the statistic variables written to the
+    *statvar* file and the output file switches. The text of the *control*
+    file is only rebuilt after modifications which makes writing the same
+    ``Control`` to many simulation directories fast.
+
+    Arguments:
+        base_file (str): path to PRMS *control* file
+
+    Attributes:
+        header (str): text before the first entry, i.e. the description
+
+    Example:
+        Shorten a simulation and only write the streamflow to the
+        *statvar* file,
+
+        >>> c = Control('path/to/control')
+        >>> c.start_time
+            datetime.datetime(1992, 10, 1, 0, 0)
+        >>> c.end_time = '1993-09-30'
+        >>> c.statvar_names = ['basin_cfs']
+        >>> c.disable_outputs()
+        >>> c['param_file']
+            ['parameters']
+        >>> c.write('path/to/simulation/control')
+    '''
+
+    # switches of optional PRMS output files
+    output_toggles = (
+        'statsON_OFF', 'aniOutON_OFF', 'csvON_OFF', 'mapOutON_OFF',
+        'nhruOutON_OFF', 'nsubOutON_OFF', 'basinOutON_OFF',
+        'save_vars_to_file'
+    )
+
+    def __init__(self, base_file):
+        self.base_file = base_file
+        self.header = ''
+        self.__entries = OrderedDict()
+        self.__text = None
+
+        with io.open(base_file, 'r') as f:
+            lines = f.read().splitlines()
+
+        idx = 0
+        while idx < len(lines) and not lines[idx].startswith('####'):
+            idx += 1
+        self.header = '\n'.join(lines[:idx])
+
+        while idx < len(lines):
+            if not lines[idx].strip():
+                idx += 1
+                continue
+            name = lines[idx + 1].strip()
+            n_values = int(lines[idx + 2])
+            vartype = lines[idx + 3].strip()
+            values = [v.strip() for v in lines[idx + 4:idx + 4 + n_values]]
+            if len(values) != n_values or vartype not in _TYPES:
+                raise ValueError(
+                    'Invalid control file entry {} in {}'.format(
+                        name, base_file
+                    )
+                )
+            self.__entries[name] = (vartype, values)
+            idx += 4 + n_values
+
+    def __getitem__(self, key):
+        vartype, values = self.__entries[key]
+        return [_TYPES[vartype](v) for v in values]
+
+    def __setitem__(self, key, value):
+        if isinstance(value, str) or not hasattr(value, '__iter__'):
+            value = [value]
+        value = list(value)
+
+        if key in self.__entries:
+            vartype = self.__entries[key][0]
+        elif all(isinstance(v, numbers.Integral) for v in value):
+            vartype = '1'
+        elif all(isinstance(v, numbers.Real) for v in value):
+            vartype = '2'
+        else:
+            vartype = '4'
+
+        self.__entries[key] = (
+            vartype, [str(_TYPES[vartype](v)) for v in value]
+        )
+        self.__text = None
+
+    def __delitem__(self, key):
+        del self.__entries[key]
+        self.__text = None
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __iter__(self):
+        return iter(self.__entries)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def keys(self):
+        return list(self.__entries)
+
+    def copy(self):
+        '''
+        Independent copy for modifying a *control* file per simulation
+
+        Returns:
+            :class:`Control`
+        '''
+        ret = Control.__new__(Control)
+        ret.base_file = self.base_file
+        ret.header = self.header
+        ret.__entries = OrderedDict(self.__entries)
+        ret.__text = self.__text
+
+        return ret
+
+    @property
+    def start_time(self):
+        ''':class:`datetime.datetime`: start of the simulation, can be
+        assigned anything :func:`pandas.to_datetime` parses'''
+        return datetime(*self['start_time'])
+
+    @start_time.setter
+    def start_time(self, value):
+        self['start_time'] = _time_values(value)
+
+    @property
+    def end_time(self):
+        ''':class:`datetime.datetime`: end of the simulation, can be
+        assigned anything :func:`pandas.to_datetime` parses'''
+        return datetime(*self['end_time'])
+
+    @end_time.setter
+    def end_time(self, value):
+        self['end_time'] = _time_values(value)
+
+    @property
+    def statvar_names(self):
+        '''
+        :obj:`list`: names of the statistic variables written to the
+        *statvar* file. Names may be assigned as a list of names or of
+        (name, element) tuples, elements of plain names are kept from
+        the current entries or else default to the first element, use
+        tuples for variables written for several elements. The
+        *nstatVars* and *statVar_element* entries are updated to match.
+        '''
+        return self['statVar_names'] if 'statVar_names' in self else []
+
+    @statvar_names.setter
+    def statvar_names(self, names):
+        elements = dict(zip(self.statvar_names, self.statvar_elements))
+        new_names = []
+        new_elements = []
+        for name in names:
+            if isinstance(name, tuple):
+                name, element = name
+            else:
+                element = elements.get(name, 1)
+            new_names.append(name)
+            new_elements.append(str(element))
+
+        self['nstatVars'] = len(new_names)
+        self['statVar_names'] = new_names
+        self['statVar_element'] = new_elements
+
+    @property
+    def statvar_elements(self):
+        ''':obj:`list`: element (e.g. HRU) of each statistic variable'''
+        if 'statVar_element' not in self:
+            return []
+        return [str(e) for e in self['statVar_element']]
+
+    def disable_outputs(self, keep=('statsON_OFF',)):
+        '''
+        Switch off all optional PRMS output files in ``output_toggles``
+        that are in the *control* file except those in ``keep``.
+
+        Keyword Arguments:
+            keep (tuple): output switches to leave unchanged, default
+                keeps the *statvar* file switch
+
+        Returns:
+            None
+        '''
+        for toggle in self.output_toggles:
+            if toggle in self and toggle not in keep:
+                self[toggle] = 0
+
+    def to_string(self):
+        '''
+        Text of the *control* file with all modifications
+
+        Returns:
+            (str): PRMS *control* file text
+        '''
+        if self.__text is None:
+            lines = [self.header] if self.header else []
+            for name, (vartype, values) in self.__entries.items():
+                lines.extend(['####', name, str(len(values)), vartype])
+                lines.extend(values)
+            self.__text = '\n'.join(lines) + '\n'
+
+        return self.__text
+
+    def write(self, out_name):
+        '''
+        Write the *control* file with all modifications
+
+        Arguments:
+            out_name (str): path to write the *control* file to
+
+        Returns:
+            None
+        '''
+        with io.open(out_name, 'wb') as f:
+            f.write(self.to_string().encode('utf-8'))
+
+
+def _time_values(value):
+    "Control file time entry values, year to second, of a date or time"
+    t = pd.to_datetime(value)
+    return [t.year, t.month, t.day, t.hour, t.minute, t.second]
+
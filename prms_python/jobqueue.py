@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+'''
+jobqueue.py -- holds ``JobQueue``, a queue of built simulations in a
+directory on shared storage that ``prmspy worker`` processes on any host
+take simulations from and run.
+'''
+
+import errno
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+import warnings
+
+import numpy as np
+
+from .cache import ResultCache
+from .retention import Retention
+from .scratch import ScratchSpace
+from .simulation import Simulation
+
+OPJ = os.path.join
+
+_STATES = ('pending', 'running', 'done')
+
+
+class JobQueue(object):
+    '''
+    Queue of built :class:`Simulation` jobs in a directory that several
+    hosts share, e.g. on NFS, so one series of simulations can run on the
+    cores of many compute nodes.
+
+    A job is a small JSON file with the absolute path of a simulation and
+    the options to run it with, it moves through the subdirectories
+    *pending*, *running* and *done* of ``root``. A worker claims a job by
+    renaming it from *pending* to *running*, which only one worker can do,
+    so no lock server or database is needed. While it runs the job, the
+    worker touches the job file every ``heartbeat`` seconds and when it has
+    finished it writes the result record of the simulation, see
+    :meth:`Simulation.result`, with the host and process that ran it to
+    *done*. Jobs of workers that stopped touching them for ``stale_after``
+    seconds, e.g. because their host went down, are put back in *pending*
+    by the next idle worker.
+
+    Workers are started with ``prmspy worker <root>`` on each host, or by
+    calling :meth:`JobQueue.work`. :meth:`SimulationSeries.run`,
+    :meth:`ScenarioSeries.run` and :meth:`Optimizer.monte_carlo` submit
+    their simulations and wait for them with ``queue=JobQueue(root)``.
+
+    Arguments:
+        root (str): queue directory on storage all hosts can reach, created
+            if needed
+
+    Keyword Arguments:
+        heartbeat (float): seconds between touches of a running job
+        stale_after (float): seconds without a touch after which a running
+            job is given to another worker, must be well above
+            ``heartbeat`` and the clock differences between hosts
+        poll (float): seconds between checks for pending jobs by workers
+            and for finished jobs by submitters
+
+    Example:
+        On each compute node run a worker with 16 simulations at once,
+
+        .. code-block:: sh
+
+            $ prmspy worker /shared/calib_queue --nproc 16
+
+        and submit an optimization stage to them from anywhere,
+
+        >>> queue = JobQueue('/shared/calib_queue')
+        >>> optr.monte_carlo(measured, names, 'basin_cfs_1', queue=queue)
+    '''
+
+    def __init__(self, root, heartbeat=30.0, stale_after=300.0, poll=1.0):
+        self.root = os.path.abspath(root)
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.poll = poll
+        for state in _STATES:
+            path = OPJ(self.root, state)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def submit(self, simulations, prms_exec='prms', cache_statvar=False,
+               timeout=None, retries=0, scratch=None, cache=None):
+        '''
+        Add built simulations to the queue.
+
+        Arguments:
+            simulations (list): :class:`Simulation` objects ready to run
+
+        Keyword Arguments:
+            prms_exec (str): PRMS executable on $PATH of the workers or
+                path to it, ``prmspy worker --prms-exec`` overrides it
+            cache_statvar (bool or numpy.dtype): see :meth:`Simulation.run`
+            timeout (float or None): see :meth:`Simulation.run`
+            retries (int): see :meth:`Simulation.run`
+            scratch (:class:`ScratchSpace` or None): scratch space settings
+                used on each worker host, see :meth:`Simulation.run`
+            cache (:class:`ResultCache` or None): see :meth:`Simulation.run`
+
+        Returns:
+            :obj:`list`: job ids in the order of ``simulations``
+        '''
+        if not isinstance(cache_statvar, bool):
+            cache_statvar = np.dtype(cache_statvar).name
+        options = {
+            'prms_exec': prms_exec,
+            'cache_statvar': cache_statvar,
+            'timeout': timeout,
+            'retries': retries,
+            'scratch': _spec(scratch),
+            'cache': _spec(cache)
+        }
+
+        # ids sort in order of submission, pending jobs are run in that order
+        batch = '{:.6f}-{}'.format(time.time(), uuid.uuid4().hex[:8])
+        job_ids = []
+        for idx, sim in enumerate(simulations):
+            job_id = '{}-{:06d}'.format(batch, idx)
+            job = {
+                'id': job_id,
+                'input_dir': _abspath(sim.input_dir),
+                'simulation_dir': _abspath(sim.simulation_dir),
+                'retention': _spec(sim.retention),
+                'options': options,
+                'submitted': time.time()
+            }
+            _write_json(OPJ(self.root, 'pending', job_id + '.json'), job)
+            job_ids.append(job_id)
+
+        return job_ids
+
+    def iter_results(self, job_ids, timeout=None):
+        '''
+        Wait for jobs and yield their result records as they finish.
+
+        Arguments:
+            job_ids (list): ids returned by :meth:`JobQueue.submit`
+
+        Keyword Arguments:
+            timeout (float or None): seconds to wait for all jobs, default
+                no limit
+
+        Yields:
+            :obj:`tuple`: the id of a finished job and the result record of
+                its simulation, see :meth:`Simulation.result`, with the
+                ``host`` and ``pid`` of the worker that ran it. The
+                ``returncode`` is None and ``stderr`` holds the traceback
+                if the worker could not run the simulation.
+
+        Raises:
+            RuntimeError: if ``timeout`` expires first
+        '''
+        outstanding = set(job_ids)
+        done_dir = OPJ(self.root, 'done')
+        start = time.time()
+        while outstanding:
+            finished = outstanding.intersection(
+                name[:-len('.json')] for name in os.listdir(done_dir)
+                if name.endswith('.json')
+            )
+            for job_id in sorted(finished):
+                outstanding.discard(job_id)
+                yield job_id, self.result(job_id)
+            if outstanding and not finished:
+                if timeout is not None and time.time() - start > timeout:
+                    raise RuntimeError(
+                        '{} jobs did not finish within {} seconds'.format(
+                            len(outstanding), timeout
+                        )
+                    )
+                time.sleep(self.poll)
+
+    def wait(self, job_ids, timeout=None):
+        '''
+        Wait for jobs to finish, see :meth:`JobQueue.iter_results`.
+
+        Returns:
+            :obj:`list`: result records in the order of ``job_ids``
+        '''
+        records = dict(self.iter_results(job_ids, timeout))
+
+        return [records[job_id] for job_id in job_ids]
+
+    def result(self, job_id):
+        '''
+        Result record of a finished job.
+
+        Returns:
+            :obj:`dict` or None: see :meth:`JobQueue.iter_results`, None if
+                the job has not finished
+        '''
+        try:
+            with open(OPJ(self.root, 'done', job_id + '.json')) as f:
+                return json.load(f)['record']
+        except (IOError, OSError):
+            return None
+
+    def cancel(self, job_ids):
+        '''
+        Remove jobs that have not been claimed by a worker yet.
+
+        Returns:
+            int: number of removed jobs
+        '''
+        removed = 0
+        for job_id in job_ids:
+            try:
+                os.remove(OPJ(self.root, 'pending', job_id + '.json'))
+                removed += 1
+            except OSError:
+                pass # claimed or not pending
+
+        return removed
+
+    def status(self):
+        '''
+        Number of jobs in each state.
+
+        Returns:
+            :obj:`dict`: with the number of ``pending``, ``running`` and
+                ``done`` jobs
+        '''
+        return dict(
+            (state, len(self._job_ids(state))) for state in _STATES
+        )
+
+    def clear(self, state='done'):
+        '''
+        Remove the job files in ``state``, e.g. the records of finished
+        jobs that have been collected. Simulation directories are not
+        touched.
+
+        Returns:
+            None
+        '''
+        for job_id in self._job_ids(state):
+            try:
+                os.remove(OPJ(self.root, state, job_id + '.json'))
+            except OSError:
+                pass
+
+    def requeue_stale(self):
+        '''
+        Put running jobs that were not touched for ``stale_after`` seconds
+        back in *pending*.
+
+        Returns:
+            int: number of requeued jobs
+        '''
+        requeued = 0
+        now = time.time()
+        for job_id in self._job_ids('running'):
+            path = OPJ(self.root, 'running', job_id + '.json')
+            try:
+                if now - os.path.getmtime(path) < self.stale_after:
+                    continue
+                if os.path.exists(OPJ(self.root, 'done', job_id + '.json')):
+                    # finished before its worker removed it
+                    os.remove(path)
+                    continue
+                os.rename(path, OPJ(self.root, 'pending', job_id + '.json'))
+                requeued += 1
+            except OSError:
+                pass # finished or requeued meanwhile
+
+        return requeued
+
+    def claim(self):
+        '''
+        Claim the oldest pending job.
+
+        Returns:
+            :obj:`dict` or None: the job, None if no job is pending
+        '''
+        for job_id in self._job_ids('pending'):
+            pending = OPJ(self.root, 'pending', job_id + '.json')
+            path = OPJ(self.root, 'running', job_id + '.json')
+            try:
+                # renaming keeps the modification time, touch the job first
+                # so it is not stale in running from the start
+                os.utime(pending, None)
+                os.rename(pending, path)
+                with open(path) as f:
+                    return json.load(f)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # claimed by another worker or requeued meanwhile
+                    continue
+                raise
+
+        return None
+
+    def work(self, prms_exec=None, nproc=1, cache=None, scratch=None,
+             max_jobs=None, idle_timeout=None):
+        '''
+        Claim and run jobs until the queue is idle for ``idle_timeout``
+        seconds or ``max_jobs`` jobs have run, this is what
+        ``prmspy worker`` does.
+
+        Keyword Arguments:
+            prms_exec (str or None): PRMS executable of this host, default
+                the one given to :meth:`JobQueue.submit`
+            nproc (int): number of jobs run at once from threads
+            cache (:class:`ResultCache` or None): cache of this host,
+                default the one given to :meth:`JobQueue.submit`
+            scratch (:class:`ScratchSpace` or None): scratch space of this
+                host, default the one given to :meth:`JobQueue.submit`
+            max_jobs (int or None): number of jobs after which the worker
+                stops, default no limit
+            idle_timeout (float or None): seconds without pending jobs
+                after which the worker stops, 0 to stop as soon as the
+                queue is empty, default None to keep waiting for jobs
+
+        Returns:
+            int: number of jobs run
+        '''
+        overrides = {'prms_exec': prms_exec, 'cache': cache,
+                     'scratch': scratch}
+        count = [0]
+        lock = threading.Lock()
+
+        def _loop():
+            idle_since = time.time()
+            while True:
+                with lock:
+                    if max_jobs is not None and count[0] >= max_jobs:
+                        return
+                    try:
+                        job = self.claim()
+                    except Exception as e:
+                        # e.g. the shared directory is briefly unavailable,
+                        # keep the worker thread alive and try again
+                        warnings.warn('could not claim a job from {}: {}'
+                                      .format(self.root, e))
+                        job = None
+                    if job is not None:
+                        count[0] += 1
+                if job is None:
+                    self.requeue_stale()
+                    if idle_timeout is not None and \
+                            time.time() - idle_since >= idle_timeout:
+                        return
+                    time.sleep(self.poll)
+                    continue
+                self._run_job(job, overrides)
+                idle_since = time.time()
+
+        threads = [threading.Thread(target=_loop) for _ in range(nproc)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        return count[0]
+
+    def _run_job(self, job, overrides):
+        "Run a claimed job, touching it meanwhile, and record its result"
+        path = OPJ(self.root, 'running', job['id'] + '.json')
+        stop = threading.Event()
+
+        def _beat():
+            while not stop.wait(self.heartbeat):
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    return # requeued by another worker
+
+        beat = threading.Thread(target=_beat)
+        beat.daemon = True
+        beat.start()
+
+        options = job['options']
+        cache_statvar = options['cache_statvar']
+        if not isinstance(cache_statvar, bool):
+            cache_statvar = np.dtype(cache_statvar)
+        sim = Simulation(retention=_from_spec(Retention, job['retention']))
+        sim.input_dir = job['input_dir']
+        sim.simulation_dir = job['simulation_dir']
+        started = time.time()
+        try:
+            sim.run(
+                prms_exec=overrides['prms_exec'] or options['prms_exec'],
+                cache_statvar=cache_statvar, timeout=options['timeout'],
+                retries=options['retries'],
+                scratch=overrides['scratch'] or
+                _from_spec(ScratchSpace, options['scratch']),
+                cache=overrides['cache'] or
+                _from_spec(ResultCache, options['cache'])
+            )
+            record = sim.result()
+        except Exception:
+            record = sim.result()
+            record['returncode'] = None
+            record['stderr'] = traceback.format_exc()
+        finally:
+            stop.set()
+            beat.join()
+        record['host'] = socket.gethostname()
+        record['pid'] = os.getpid()
+
+        job.update(record=record, started=started, finished=time.time())
+        _write_json(OPJ(self.root, 'done', job['id'] + '.json'), job)
+        try:
+            os.remove(path)
+        except OSError:
+            pass # requeued meanwhile
+
+    def _job_ids(self, state):
+        return sorted(
+            name[:-len('.json')]
+            for name in os.listdir(OPJ(self.root, state))
+            if name.endswith('.json')
+        )
+
+    def __repr__(self):
+        return '<JobQueue {}>'.format(self.root)
+
+
+def _abspath(path):
+    return None if path is None else os.path.abspath(path)
+
+
+def _spec(obj):
+    "Constructor arguments of a ResultCache, ScratchSpace or Retention"
+    return None if obj is None else dict(vars(obj))
+
+
+def _from_spec(cls, spec):
+    return None if spec is None else cls(**spec)
+
+
+def _write_json(path, obj):
+    "Write a JSON file so that it appears complete or not at all"
+    tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp, path)
@@ -8,15 +8,18 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import os, sys, json, re, shutil
+import functools
 import multiprocessing as mp
 from copy import copy
-from copy import deepcopy
 from numpy import log10
 from datetime import datetime
+from .control import Control
 from .data import Data
-from .parameters import Parameters
+from .parameters import Parameters, ParameterOverlay
+from .retention import Retention
 from .simulation import Simulation, SimulationSeries
-from .util import load_statvar, nash_sutcliffe, percent_bias, rmse
+from .warmstart import WarmStart
+from .util import load_statvar, goodness_of_fit
 
 OPJ = os.path.join
 
@@ -100,9 +103,57 @@ class Optimizer:
         self.statvar_name = None
         self.arb_outputs = []
 
+    def spin_up(self, start_time, prms_exec='prms'):
+        '''
+        Spin up the original model once until the day before ``start_time``
+        and save its state so that simulations of ``monte_carlo`` with the
+        ``warm_start`` keyword argument only simulate the calibration 
+        period from ``start_time``.
+
+        The spin-up simulation is run in a "spinup_YYYYMMDD" subdirectory
+        of ``working_dir``, an existing spin-up there that is compatible
+        with the current parameters and control file is reused.
+
+        Arguments:
+            start_time (str or :class:`datetime.datetime`): first day of 
+                the calibration period
+
+        Keyword Arguments:
+            prms_exec (str): name of PRMS executable on $PATH or path to
+                executable
+
+        Returns:
+            :class:`WarmStart`
+
+        Example:
+            >>> warm = optr.spin_up('1995-10-01')
+            >>> optr.monte_carlo(measured, ['jh_coef'], 'basin_potet',
+                                 'jhpet', warm_start=warm)
+
+            Resampling parameters that define model storages, see 
+            :attr:`WarmStart.state_params`, with a warm start raises a 
+            ``ValueError`` since the saved state would not be valid.
+        '''
+        spinup_dir = OPJ(self.working_dir, 'spinup_{:%Y%m%d}'.format(\
+                                                 pd.to_datetime(start_time)))
+        try:
+            warm = WarmStart(spinup_dir)
+            warm.check(self.parameters, self.control_file)
+            if warm.start_time == pd.to_datetime(start_time):
+                return warm
+        except (RuntimeError, ValueError):
+            pass
+
+        return WarmStart.create(self.parameters, self.data, self.control_file,\
+                                spinup_dir, start_time, prms_exec=prms_exec)
+
     def monte_carlo(self, reference_path, param_names, statvar_name, \
                     stage, n_sims=10, method='uniform', mu_factor=1,\
-                    noise_factor=0.1, nproc=None):
+                    noise_factor=0.1, nproc=None, overlay=False,\
+                    warm_start=None, cache_statvar=False, backend='process',\
+                    timeout=None, retries=0, pool=None, scratch=None,\
+                    retention=None, cache=None, queue=None, costs=None,\
+                    lookahead=None, build_nproc=1):
         '''
         The ``monte_carlo`` method of ``Optimizer`` performs parameter
 	random resampling techniques to a set of PRMS parameters and 
@@ -126,6 +177,59 @@ class Optimizer:
             noise_factor (float): scales the variance of noise to add to
                 parameter values when using normal rv (method='normal')
             nproc (int): number of processors available to run PRMS simulations
+            overlay (bool): if True each simulation directory only gets a
+                parameter file with the resampled parameters that is listed
+                after the original parameter file in its *control* file,
+                see :meth:`Simulation.from_data`
+            warm_start (:class:`WarmStart` or None): if given all
+                simulations start at ``warm_start.start_time`` from the model
+                state saved by a spin-up simulation, see
+                :meth:`Optimizer.spin_up`
+            cache_statvar (bool or numpy.dtype): if True or a float data
+                type convert the statvar output of each simulation to a
+                binary copy that later analysis, e.g. with 
+                :class:`OptimizationResult`, loads much faster
+            backend (str): 'process', 'thread' or 'asyncio' to run the
+                simulations from a process pool, a thread pool or an
+                :mod:`asyncio` event loop, see :meth:`SimulationSeries.run`
+            timeout (float or None): wall-clock seconds after which a PRMS
+                simulation is killed, e.g. when it hangs on bad resampled
+                parameters
+            retries (int): number of times a failed simulation is run
+                again before it is quarantined
+            pool (:class:`WorkerPool` or None): run the simulations in
+                these persistent workers, e.g. shared by several stages,
+                instead of starting a new pool, ``nproc`` and ``backend``
+                are then taken from the pool
+            scratch (:class:`ScratchSpace` or None): run the simulations
+                in this bounded scratch space, e.g. on a RAM disk, and keep
+                only the outputs it lists, see :meth:`Simulation.run`
+            retention (:class:`Retention` or None): outputs of each
+                simulation to keep and compress right after it has run,
+                the statvar file is always kept for scoring
+            cache (:class:`ResultCache` or None): reuse the outputs of
+                simulations with the same inputs from earlier stages or
+                reruns instead of running PRMS again
+            queue (:class:`JobQueue` or None): submit the simulations to
+                this job queue shared with ``prmspy worker`` processes on
+                other hosts instead of running them here, ``nproc``,
+                ``backend`` and ``pool`` are then ignored
+            costs (:class:`CostModel` or None): start the simulations
+                expected to take longest first and learn their run times,
+                e.g. one model shared by all stages, see
+                :meth:`SimulationSeries.run`
+            lookahead (int or None): number of simulations built ahead of
+                the ones that have finished, default twice ``nproc``. The
+                first simulations run while later ones are still being
+                built, see :class:`SimulationSeries`.
+            build_nproc (int): number of simulations built at once
+
+        Simulations that still fail are not removed but listed with their
+        exit status and the end of PRMS standard error under "quarantine"
+        in the stage metadata file, :class:`OptimizationResult` skips them.
+        The stage's throughput, CPU time, core utilization and peak memory
+        are recorded under "resources", see
+        :meth:`SimulationSeries.resource_report`.
 
         Returns:
             None
@@ -149,26 +253,46 @@ class Optimizer:
                            mu_factor=mu_factor, noise_factor=noise_factor))
             params.append(list(tmp))
         
-        # SimulationSeries comprised of each resampled param set
+        # parse the control file once for all simulations
+        control = Control(self.control_file)
+
+        # the statvar file is needed to score the simulations
+        if retention is not None and retention.keep is not None and\
+                not retention.keeps('statvar.dat'):
+            retention = Retention(retention.keep + ('statvar.dat',),\
+                                  retention.compress, retention.compresslevel)
+
+        if pool is not None:
+            nproc, backend = pool.nproc, pool.backend
+        elif not nproc:
+            nproc = max(1, mp.cpu_count() // 2)
+
+        # SimulationSeries comprised of each resampled param set, built
+        # while the first simulations run
         series = SimulationSeries(
-            Simulation.from_data(
+            (functools.partial(Simulation.from_data,
                 self.data, _mod_params(self.parameters,\
                                    [params[n][i] for n in range(len(params))],\
                                    param_names),
-                self.control_file,
+                control,
                 OPJ(
                     self.working_dir, # name of sim: first param and mean value
                     '{0}_{1:.10f}'.format(param_names[0], np.mean(params[0][i]))
-                )
+                ),
+                overlay=overlay,
+                warm_start=warm_start,
+                retention=retention
             )
-            for i in range(n_sims)
+            for i in range(n_sims)),
+            lookahead=lookahead or 2 * nproc, build_nproc=build_nproc
         )
-
-        if not nproc:
-            nproc = mp.cpu_count() // 2
         
         # run 
-        outputs = list(series.run(nproc=nproc).outputs_iter())        
+        outputs = list(series.run(nproc=nproc, cache_statvar=cache_statvar,\
+                                  backend=backend, timeout=timeout,\
+                                  retries=retries, pool=pool,\
+                                  scratch=scratch, cache=cache,\
+                                  queue=queue, costs=costs).outputs_iter())        
         self.arb_outputs.extend(outputs) # for current instance- add outputs 
 
         end_time = datetime.now().isoformat()
@@ -189,7 +313,22 @@ class Optimizer:
                  'stage': stage,
                  'original_params' : self.parameters.base_file,
                  'nproc': nproc,
-                 'n_sims' : n_sims
+                 'backend': backend,
+                 'timeout': timeout,
+                 'retries': retries,
+                 'scratch': None if scratch is None else scratch.root,
+                 'cache': None if cache is None else cache.root,
+                 'queue': None if queue is None else queue.root,
+                 'retention': None if retention is None else\
+                              {'keep': retention.keep,\
+                               'compress': retention.compress},
+                 'quarantine': [rec for rec in series.results\
+                                if rec['returncode'] != 0],
+                 'resources': series.resource_report(),
+                 'n_sims' : n_sims,
+                 'overlay' : overlay,
+                 'warm_start' : None if warm_start is None\
+                                else warm_start.spinup_dir
                }
 
         for output in outputs:
@@ -240,14 +379,15 @@ class Optimizer:
             raise ValueError('You have not run any optimizations')
         var_name = self.statvar_name
         X = self.measured_arb
+        start, end = X.index.min(), X.index.max()
         idx = X.index.intersection(load_statvar(self.arb_outputs[0]\
-                           ['statvar'])['{}'.format(var_name)].index)
+                           ['statvar'], var_name, start, end).index)
         X = X[idx]
-        orig = load_statvar(OPJ(self.input_dir, 'statvar.dat'))['{}'\
-                            .format(var_name)][idx]
+        orig = load_statvar(OPJ(self.input_dir, 'statvar.dat'), var_name,\
+                            start, end)[var_name][idx]
         meas = self.measured_arb[idx]
-        sims = [load_statvar(out['statvar'])['{}'.format(var_name)][idx] for \
-                out in self.arb_outputs]
+        sims = [load_statvar(out['statvar'], var_name, start, end)[var_name]\
+                [idx] for out in self.arb_outputs]
         simdirs = [out['simulation_dir'].split(os.sep)[-1].\
                    replace('_', ' ') for out in self.arb_outputs]
         var_name = '{}'.format(self.statvar_name)
@@ -441,7 +581,8 @@ def resample_param(params, param_name, how='uniform', mu_factor=1,\
     ndims = param_dic.get(param_name)['ndims']
     dimnames = param_dic.get(param_name)['dimnames']
     length = param_dic.get(param_name)['length']
-    param = deepcopy(params[param_name])
+    # not copied, resampled values are always returned as a new array
+    param = params[param_name]
     
     # could expand list and check parameter name also e.g. cascade_flg
     # is a parameter that should not be changed 
@@ -478,16 +619,15 @@ def resample_param(params, param_name, how='uniform', mu_factor=1,\
         if how == 'uniform':
             ret = np.random.uniform(low=p_min, high=p_max, size=param.shape) 
         elif how == 'normal': # scale parameter mean if mu_factor given 
-            param *= mu_factor
             tmp = np.random.normal(0, s, size=param.shape)
-            ret = tmp + param
+            ret = tmp + param * mu_factor
 
     elif dim_case == 'resample_each_value':
-        ret = param
         if how == 'uniform':
             ret = np.random.uniform(low=p_min, high=p_max, size=param.shape)
         elif how == 'normal': # the original value is considered the mean
-            if len(ret.shape) != 0:
+            if len(param.shape) != 0:
+                ret = np.empty(param.shape)
                 for i, el in enumerate(param):
                     mu = el * mu_factor
                     ret[i] =  np.random.normal(mu, s) 
@@ -497,24 +637,25 @@ def resample_param(params, param_name, how='uniform', mu_factor=1,\
 
     # nhru by nmonth dimensional params
     elif dim_case == 'nhru_nmonths':
-        ret = param
+        ret = np.empty(param.shape)
         if how == 'uniform':
             for month in range(12):
                 ret[month] = np.random.uniform(low=p_min, high=p_max,\
                                                            size=param[0].shape)
         elif how == 'normal':
             for i, el in enumerate(param):
-                el *= mu_factor
+                el = el * mu_factor
                 tmp = np.random.normal(0, s, size=el.shape)
                 ret[i] = tmp + el
 
     return ret
 
 def _mod_params(parameters, params, param_names):
-    # loop through list of params and assign their values to Parameter instance
-    ret = copy(parameters)
+    # loop through list of params and assign their values to a copy-on-write
+    # overlay so the shared base parameters are never modified or copied
+    ret = ParameterOverlay(parameters)
     for idx, param in enumerate(params):
-        ret[param_names[idx]] = np.array(param)
+        ret[param_names[idx]] = np.asarray(param)
     return ret
 
 
@@ -574,6 +715,8 @@ class OptimizationResult:
         self.stage = stage
         self.metadata_json_paths = self._get_optr_jsons(working_dir, stage) 
         self.total_sims = self._count_total_sims()
+        # result records of simulations that failed, these are skipped
+        self.quarantine = self._get_quarantine(stage)
         self.statvar_name = self._get_statvar_name(stage)
         self.measured = self._get_measured(stage)
         self.input_dir = self._get_input_dir(stage)
@@ -589,13 +732,8 @@ class OptimizationResult:
  following input parameter files:\n{}'.format('\n'.join(self.input_params)))
  
     def _count_total_sims(self):
-        # total number of simulations of given stage in working directory
-        tracked_dirs = []
-        for f in self.metadata_json_paths[self.stage]:
-            with open(f) as fh:
-                json_data = json.load(fh)
-                tracked_dirs.extend(json_data.get('sim_dirs'))
-        return len(tracked_dirs)
+        # total number of successful simulations of given stage
+        return len(self._get_sim_dirs(self.stage))
 
     def _get_optr_jsons(self, work_dir, stage):
         """
@@ -648,11 +786,22 @@ class OptimizationResult:
         for inf in jsons:
             with open(inf) as json_file:
                 json_files.append(json.load(json_file))
+        quarantined = set(rec['simulation_dir'] for rec in\
+                          self._get_quarantine(stage))
         for json_file in json_files:
-            sim_dirs.extend(json_file['sim_dirs'])
-        # list of all simulation directory paths for stage 
+            sim_dirs.extend(d for d in json_file['sim_dirs']\
+                            if d not in quarantined)
+        # list of simulation directory paths for stage that did not fail
         return sim_dirs
 
+    def _get_quarantine(self, stage):
+        # result records of failed simulations of the stage, if recorded
+        quarantine = []
+        for inf in self.metadata_json_paths[stage]:
+            with open(inf) as json_file:
+                quarantine.extend(json.load(json_file).get('quarantine', []))
+        return quarantine
+
     def _get_measured(self, stage):
         # only need to open one json file to get this information
         if not self.metadata_json_paths.get(stage):
@@ -668,7 +817,7 @@ class OptimizationResult:
         # only need to open one json file to get this information
         try:
             first_json = self.metadata_json_paths[stage][0]
-        except:
+        except (IndexError, KeyError):
             raise ValueError("""No optimization has been run for
                               stage: {}""".format(stage))    
         with open(first_json) as json_file:
@@ -678,7 +827,22 @@ class OptimizationResult:
         return var_name
 
     def result_table(self, freq='daily', top_n=5, latex=False):
-        ##TODO: add stats for freq options annual (means or sum)
+        """
+        Table of goodness-of-fit metrics of the simulations of the stage
+        against the measured data sorted from best to worst, with the
+        metrics of the original parameters in the first row.
+
+        Keyword Arguments:
+            freq (str): 'daily', 'monthly' (means of each month of the
+                year) or 'annual' (means of each year), see
+                :func:`util.goodness_of_fit`
+            top_n (int): number of best simulations to include
+            latex (bool): if True return the table as LaTeX string
+
+        Returns:
+            (pandas.DataFrame or str): NSE, RMSE, PBIAS and COEF_DET of
+                the original parameters and the ``top_n`` simulations
+        """
 
         sim_dirs = self._get_sim_dirs(self.stage)
         if top_n >= len(sim_dirs): 
@@ -686,65 +850,45 @@ class OptimizationResult:
         sim_names = [path.split(os.sep)[-1] for path in sim_dirs] 
         meas_var = self._get_measured(self.stage)
         statvar_name = self._get_statvar_name(self.stage)
-        orig_statvar = load_statvar(OPJ(self.input_dir,'statvar.dat'))\
-                       [statvar_name]
+        # only parse the optimization variable within the measured period
+        start, end = meas_var.index.min(), meas_var.index.max()
+        orig_statvar = load_statvar(OPJ(self.input_dir,'statvar.dat'),\
+                                    statvar_name, start, end)[statvar_name]
 
-        result_df = pd.DataFrame(columns=\
-                            ['NSE','RMSE','PBIAS','COEF_DET','ABS(PBIAS)'])
-        orig_results = pd.DataFrame(index=['orig_params'],\
-                                 columns=['NSE','RMSE','PBIAS','COEF_DET'])
         # get datetime indices that overlap from measured and simulated
-        sim_out = load_statvar(OPJ(sim_dirs[0], 'outputs', 'statvar.dat'))\
-                                               [statvar_name]
+        sim_out = load_statvar(OPJ(sim_dirs[0], 'outputs', 'statvar.dat'),\
+                               statvar_name, start, end)[statvar_name]
         idx = meas_var.index.intersection(sim_out.index)
         meas_var = copy(meas_var[idx])
-        #sim_out = sim_out[idx]    
-        orig_statvar = orig_statvar[idx]
-        
-        if freq == 'monthly':
-            meas_mo = meas_var.groupby(meas_var.index.month).mean()
-            orig_mo = orig_statvar.groupby(orig_statvar.index.month).mean()            
-        
+        orig_statvar = orig_statvar.reindex(idx)
+
+        # simulated values of all simulations aligned to measured as rows
+        names = []
+        rows = []
         for i, sim in enumerate(sim_dirs):
             try: 
-                sim_out = load_statvar(OPJ(sim, 'outputs', 'statvar.dat'))\
-                                               ['{}'.format(statvar_name)]
-            except: # simulation might have been removed or missing
-                pass
-
-            sim_out = sim_out[idx]    
-            if freq == 'daily':
-                result_df.loc[sim_names[i]] = [\
-                              nash_sutcliffe(meas_var, sim_out),\
-                              rmse(meas_var, sim_out),\
-                              percent_bias(meas_var,sim_out),\
-                              meas_var.corr(sim_out)**2,\
-                              np.abs(percent_bias(meas_var, sim_out)) ]                                  
-                orig_results.loc['orig_params'] = [\
-                              nash_sutcliffe(orig_statvar,meas_var),\
-                              rmse(orig_statvar,meas_var),\
-                              percent_bias(orig_statvar,meas_var),\
-                              orig_statvar.corr(meas_var)**2]
-                              
-            elif freq == 'monthly':
-                sim_out = sim_out.groupby(sim_out.index.month).mean()
-                result_df.loc[sim_names[i]] = [\
-                              nash_sutcliffe(meas_mo, sim_out),\
-                              rmse(meas_mo, sim_out),\
-                              percent_bias(meas_mo, sim_out),\
-                              meas_mo.corr(sim_out)**2,\
-                              np.abs(percent_bias(meas_mo, sim_out)) ]    
-                orig_results.loc['orig_params'] = [\
-                              nash_sutcliffe(orig_mo,meas_mo),\
-                              rmse(orig_mo,meas_mo),\
-                              percent_bias(orig_mo,meas_mo),\
-                              orig_mo.corr(meas_mo)**2]
+                sim_out = load_statvar(OPJ(sim, 'outputs', 'statvar.dat'),\
+                                       statvar_name, start, end)[statvar_name]
+            except (IOError, OSError, ValueError): 
+                continue # simulation might have been removed or missing
+            names.append(sim_names[i])
+            rows.append(sim_out.reindex(idx).values)
+
+        # score all simulations at once
+        metrics = ['NSE','RMSE','PBIAS','COEF_DET']
+        result_df = goodness_of_fit(meas_var,\
+                                    np.reshape(rows, (len(rows), len(idx))),\
+                                    freq=freq, names=names)[metrics]
+        result_df['ABS(PBIAS)'] = result_df['PBIAS'].abs()
+        orig_results = goodness_of_fit(meas_var, [orig_statvar.values],\
+                                       freq=freq, names=['orig_params'])\
+                                       [metrics]
                                  
         sorted_result = result_df.sort_values(by=['NSE','RMSE','ABS(PBIAS)',\
                                'COEF_DET'], ascending=[False,True,True,False])
-        sorted_result.columns.name = '{} parameters'.format(self.stage)
-        sorted_result = sorted_result[['NSE','RMSE','PBIAS','COEF_DET']] 
+        sorted_result = sorted_result[metrics] 
         sorted_result = pd.concat([orig_results,sorted_result])
+        sorted_result.columns.name = '{} parameters'.format(self.stage)
 
         if latex: return sorted_result[:top_n].to_latex(escape=False)
         else: return  sorted_result[:top_n]
@@ -824,9 +968,10 @@ class OptimizationResult:
             json_path = OPJ(archive_dir, '{sim}.json'.format(sim=sim))
             try:
                 output_series = load_statvar(OPJ(self.working_dir, sim,\
-                                              'outputs', 'statvar.dat'))\
+                                              'outputs', 'statvar.dat'),\
+                                              self.statvar_name)\
                                               [self.statvar_name]
-            except: # simulation directory was already removed
+            except (IOError, OSError, ValueError): # sim was already removed
                 continue
             
             # look for resampling method info for the particular simulation
@@ -882,7 +1027,7 @@ class OptimizationResult:
             for meta_file in self.metadata_json_paths[self.stage]:
                 try:
                     os.remove(meta_file)
-                except:
+                except OSError:
                     continue
     
 
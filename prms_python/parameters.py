@@ -5,15 +5,21 @@ the standard PRMS parameters input file.
 '''
 
 import datetime, calendar
-import io, os
-import itertools
+import hashlib, io, json, os
+import warnings
+import weakref
+import zlib
 import numpy as np
+
 import pandas as pd
 import matplotlib.pyplot as plt
 
 from matplotlib.backends.backend_pdf import PdfPages
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from .util import _replace_file
 
 OPJ = os.path.join
 
@@ -36,19 +42,38 @@ class Parameters(object):
     Arguments:
         base_file (str): path to PRMS parameters file 
 
+    Keyword Arguments:
+        cache (bool or str): opt-in persistent cache of the parsed
+            ``base_file``. If True the dimensions, parameter metadata and
+            all parameter arrays are stored in a binary ``.npz`` sidecar
+            file next to ``base_file``, if a path to a directory is given
+            the cache file is stored there instead. The cache is keyed by
+            the path, size, modification time and content hash of
+            ``base_file``; a valid cache is reused by any process that
+            creates a ``Parameters`` with the same ``base_file``, a stale
+            one is rebuilt automatically. Default False, no cache.
+        max_bytes (int or None): memory budget in bytes for parameter
+            arrays that were read from ``base_file`` but not modified, the
+            least recently used are evicted from ``param_arrays`` once the
+            budget is exceeded and read again if accessed later. Modified
+            arrays are never evicted. Default None, keep every accessed
+            array in memory. See :meth:`Parameters.cache_info`.
+
     Attributes:
         base_file (str): path to PRMS parameters file 
-        base_file_reader (file): file handle of PRMS parameters file
+        cache_file (str or None): path to the binary cache of ``base_file``
+            if the ``cache`` option was used
         dimensions (:obj:`collections.OrderedDict`): dictionary with 
             parameter dimensions as defined in parameters file loaded on
             initialization
         base_params (list of dicts): list of dictionaries of parameter
             metadata loaded on initialization e.g. name, dimension(s), data 
-            type, length of data array, and lines where data starts and ends 
-            in file
-        param_arrays (dict): dictionary with parameteter names as keys and
-            ``numpy.array`` and ``numpy.ndarray`` representations of parameter
-            values as keys. Initially empty, uses getter and setter functions.
+            type, length of data array, and the line and byte offsets where
+            each parameter block and its data start and end in file
+        param_arrays (:class:`ParamArrayCache`): dictionary-like container
+            with parameteter names as keys and ``numpy.array`` and
+            ``numpy.ndarray`` representations of parameter values as
+            values. Initially empty, uses getter and setter functions.
 
     Example:
         >>> p = Parameters('path/to/a/parameter/file')
@@ -64,19 +89,33 @@ class Parameters(object):
         parameter instance ``p``. 
     '''
 
-    def __init__(self, base_file):
+    def __init__(self, base_file, cache=False, max_bytes=None):
         self.base_file = base_file
-        self.base_file_reader = open(base_file)
-        self.dimensions, self.base_params = self.__read_base(base_file)
-        self.param_arrays = dict()
+        self.cache_file = _cache_path(base_file, cache) if cache else None
+
+        self._cache_valid = False
+
+        cached = self.__read_cache() if self.cache_file else None
+        if cached:
+            self.dimensions, self.base_params = cached
+            self._cache_valid = True
+        else:
+            self.dimensions, self.base_params = self.__read_base(base_file)
+            if self.cache_file:
+                self.__write_cache()
+
+        self.param_arrays = ParamArrayCache(max_bytes=max_bytes)
 
     def write(self, out_name):
         """
         Writes current state of ``Parameters`` to disk in PRMS text format
 
-        To reduce memory usage the ``write`` method copies parameters
-        from the initial ``base_file`` parameter file for all parameters
-        that were never modified. 
+        To reduce memory usage and time the ``write`` method copies the
+        dimensions and all parameters that were never accessed or modified
+        directly from the initial ``base_file`` parameter file as raw byte
+        ranges, using the byte offsets found when ``base_file`` was read.
+        Accessed or modified parameters are formatted in bulk and appended
+        to the end of the file.
 
         Arguments:
             out_name (str): path to write ``Parameters`` data to PRMS text
@@ -85,63 +124,193 @@ class Parameters(object):
         Returns:
             None
         """
-        data_type_dic = {'1': 'int', 
-                         '2': 'float'} # retain PRMS data types
+        param_dic = {param['name']: param for param in self.base_params}
+        arrays = self._arrays_to_write()
 
-        with open(self.base_file, 'r') as base_file:
-            with open(out_name, 'w') as out_file:
+        with io.open(self.base_file, 'rb') as base_file:
+            with io.open(out_name, 'wb') as out_file:
                 # write metadata
-                out_file.write('File Auto-generated by PRMS-Python\n')
-                out_file.write(datetime.datetime.now().isoformat() + '\n')
-
-                # # write dimensions
-                out_file.write('** Dimensions **\n')
-
-                # write parameters; pre-sorted by data start line on read
-                name_is_next = False
-                params_start = False
-                write_params_lines = False
-                for l in base_file:
-
-                    if not params_start and l.strip() == '** Parameters **':
-                        out_file.write('** Parameters **\n')
-                        params_start = True
-
-                    elif l.strip() == '####':
-                        name_is_next = True
-
-                    elif name_is_next:
-                        name = l.strip().split()[0] 
-                        if name not in self.param_arrays:
-                            out_file.write('####\n')
-                            out_file.write(name + '\n')
-                            name_is_next = False
-                            write_params_lines = True
-                        else:
-                            write_params_lines = False
-                            name_is_next = False
-
-                    elif write_params_lines:
-                        out_file.write(l.strip() + '\n')
+                out_file.write(_file_header())
+
+                # copy dimensions and unmodified parameters from base file
+                for start, end in self.__unmodified_ranges(arrays):
+                    _copy_range(base_file, out_file, start, end)
 
                 # write all parameters that had been accessed and/or modified
-                for param, new_arr in self.param_arrays.items():
+                for param, new_arr in arrays.items():
+                    out_file.write(
+                        _format_param_block(param_dic[param], new_arr)
+                    )
+
+    def write_overlay(self, out_name):
+        """
+        Write only the modified parameters to a small parameter file in PRMS text format that overrides ``base_file``.
+
+        PRMS accepts several parameter files in the *param_file* entry of
+        the *control* file, later files override parameters of earlier
+        ones. Listing ``base_file`` followed by ``out_name`` runs the same
+        model as listing a file written by :meth:`Parameters.write`
+        without copying all unmodified parameters. The dimensions of
+        ``base_file`` are included so that the overlay file can also be
+        read by :class:`Parameters`.
+
+        Arguments:
+            out_name (str): path to write the overlay parameter file to
+
+        Returns:
+            None
+
+        Example:
+            >>> p = Parameters('path/to/a/parameter/file')
+            >>> p['jh_coef'] = p['jh_coef'] * 1.1
+            >>> p.write_overlay('path/to/overlay')
 
-                    out_file.write('####\n')
+            Then list both files in the *control* file *param_file*
+            entry, see :meth:`Simulation.from_data` which does this with
+            ``overlay=True``.
+        """
+        param_dic = {param['name']: param for param in self.base_params}
+        arrays = self._modified_arrays()
+        params_startbyte = min(
+            param['block_startbyte'] for param in self.base_params
+        )
+
+        with io.open(self.base_file, 'rb') as base_file:
+            with io.open(out_name, 'wb') as out_file:
+                out_file.write(_file_header())
+                # dimensions through the "** Parameters **" line
+                _copy_range(
+                    base_file, out_file, self._dimensions_startbyte,
+                    params_startbyte
+                )
+                for param, new_arr in arrays.items():
+                    out_file.write(
+                        _format_param_block(param_dic[param], new_arr)
+                    )
+
+    def write_batch(self, out_names, param_stacks, nthreads=None):
+        """
+        Write many parameter files that differ from the current state of
+        ``Parameters`` only in a few parameters in one streaming pass.
+
+        The text that is the same in all files, i.e. the dimensions and
+        all unmodified parameters copied from ``base_file`` plus any
+        parameters accessed or modified in this instance, is assembled
+        once as a byte buffer. For each file only the blocks of the
+        parameters in ``param_stacks`` are formatted, the files are
+        otherwise identical to what :meth:`Parameters.write` would write
+        after assigning each sample.
+
+        Arguments:
+            out_names (list): paths of the N parameter files to write
+            param_stacks (dict): parameter names as keys and arrays of
+                shape ``(N, *param_shape)`` as values, the i'th element of
+                each array is written to the i'th file of ``out_names``
 
-                    param_info = [el for el in self.base_params
-                                  if el['name'] == param].pop()
+        Keyword Arguments:
+            nthreads (int or None): if given, write files with a pool of
+                ``nthreads`` threads, default None writes sequentially
+
+        Returns:
+            None
+
+        Raises:
+            KeyError: if a key of ``param_stacks`` is not a valid
+                parameter name
+            ValueError: if an array of ``param_stacks`` does not have the
+                shape ``(len(out_names), *param_shape)``
+
+        Example:
+            Write 1000 parameter files with resampled *jh_coef* and
+            *rad_trncf* values,
+
+            >>> p = Parameters('path/to/a/parameter/file')
+            >>> n = 1000
+            >>> jh_coef = np.random.uniform(0.005, 0.06, size=(n, 12))
+            >>> rad_trncf = p['rad_trncf'] * np.random.uniform(
+                    0.5, 1.5, size=(n, 1))
+            >>> out_names = ['params_{}'.format(i) for i in range(n)]
+            >>> p.write_batch(
+                    out_names, {'jh_coef': jh_coef, 'rad_trncf': rad_trncf},
+                    nthreads=4
+                )
+        """
+        out_names = list(out_names)
+        n_samples = len(out_names)
+        param_dic = {param['name']: param for param in self.base_params}
+
+        stacks = OrderedDict()
+        for name, stack in param_stacks.items():
+            if name not in param_dic:
+                raise KeyError(name)
+            stack = np.asarray(stack)
+            shape = (n_samples,) +\
+                _param_shape(param_dic[name], self.dimensions)
+            if not stack.shape == shape:
+                raise ValueError(
+                    '{} array has shape {}, expected {}'.format(
+                        name, stack.shape, shape)
+                )
+            stacks[name] = stack
 
-                    out_file.write(str(param_info['name']) + '\n')
-                    out_file.write(str(param_info['ndims']) + '\n')
-                    for dimname in param_info['dimnames']:
-                        out_file.write(dimname + '\n')
-                    out_file.write(str(param_info['length']) + '\n')
-                    out_file.write(str(param_info['vartype']) + '\n')
-                    out_file.writelines([str(a) + '\n'
-                                         for a in new_arr.flatten().\
-                                        astype(data_type_dic[param_info\
-                                        ['vartype']])])
+        constant_arrays = OrderedDict(
+            (name, arr) for name, arr in self._arrays_to_write().items()
+            if name not in stacks
+        )
+
+        # text shared by all files: copied blocks then constant arrays
+        template = io.BytesIO()
+        skip = set(constant_arrays) | set(stacks)
+        with io.open(self.base_file, 'rb') as base_file:
+            for start, end in self.__unmodified_ranges(skip):
+                _copy_range(base_file, template, start, end)
+        for name, arr in constant_arrays.items():
+            template.write(_format_param_block(param_dic[name], arr))
+        template = template.getvalue()
+
+        def write_sample(idx):
+            with io.open(out_names[idx], 'wb') as out_file:
+                out_file.write(_file_header())
+                out_file.write(template)
+                for name, stack in stacks.items():
+                    out_file.write(
+                        _format_param_block(param_dic[name], stack[idx])
+                    )
+
+        if nthreads:
+            pool = ThreadPool(nthreads)
+            try:
+                # map raises any exception from the threads
+                pool.map(write_sample, range(n_samples))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for idx in range(n_samples):
+                write_sample(idx)
+
+    def __unmodified_ranges(self, names):
+        """
+        Byte ranges of ``base_file`` from the start of the dimensions to the
+        end of the last parameter, skipping the blocks of parameters in
+        ``names`` which are written separately. Adjacent ranges are merged
+        so they can be copied at once.
+        """
+        ret = []
+        start = self._dimensions_startbyte
+        for param in sorted(self.base_params,
+                            key=lambda p: p['block_startbyte']):
+            if param['name'] in names:
+                if param['block_startbyte'] > start:
+                    ret.append((start, param['block_startbyte']))
+                start = param['data_endbyte']
+
+        if self.base_params:
+            last = max(p['data_endbyte'] for p in self.base_params)
+            if last > start:
+                ret.append((start, last))
+
+        return ret
 
     def plot(self, nrows, which='all', out_dir=None, xlabel=None,\
                     ylabel=None, cbar_label=None, title=None, mpl_style=None):
@@ -365,51 +534,201 @@ class Parameters(object):
                 val = params[param_name]
                 print('{param} is single valued with value: {v}'.format(param=param_name, v=val))          
 
+    def load(self, names=None):
+        """
+        Load many parameters from ``base_file`` in a single pass.
+
+        Uses the byte offsets of each parameter data block that were found
+        when ``base_file`` was scanned on initialization, so the file is
+        opened once and only the requested blocks are read and parsed, in
+        file order. Parameters that were already accessed or modified are
+        not re-read. Loaded arrays are kept in ``param_arrays`` exactly as
+        if they were accessed with the dictionary-like syntax.
+
+        Keyword Arguments:
+            names (list or None): names of parameters to load, if None
+                (default) load all parameters in ``base_file``
+
+        Returns:
+            (dict): dictionary with parameter names as keys and
+                ``numpy.ndarray`` parameter values as values
+
+        Raises:
+            KeyError: if any of ``names`` is not a valid parameter name
+
+        Example:
+            >>> p = Parameters('path/to/a/parameter/file')
+            >>> arrs = p.load(['jh_coef', 'snow_adj', 'rad_trncf'])
+            >>> arrs['jh_coef'] is p['jh_coef']
+                True
+        """
+        if names is None:
+            names = [param['name'] for param in self.base_params]
+
+        param_dic = {param['name']: param for param in self.base_params}
+        for name in names:
+            if name not in param_dic:
+                raise KeyError(name)
+
+        to_load = [
+            param_dic[name] for name in set(names)
+            if name not in self.param_arrays
+        ]
+
+        ret = {
+            name: self.param_arrays[name] for name in names
+            if name in self.param_arrays
+        }
+        for name, arr in self.__load_parameter_arrays(to_load).items():
+            self.param_arrays.add(name, arr)
+            ret[name] = arr
+
+        return ret
+
+    def __load_parameter_arrays(self, params_metadata):
+        """
+        Read and parse the data blocks of one or more parameters with a
+        single open of ``base_file``, seeking to each block in file order.
+        """
+        ret = dict()
+        if not params_metadata:
+            return ret
+
+        if self._cache_valid:
+            with np.load(self.cache_file) as cache:
+                for param_metadata in params_metadata:
+                    name = param_metadata['name']
+                    ret[name] = cache[_CACHE_ARRAY_PREFIX + name]
+            return ret
+
+        params_metadata = sorted(
+            params_metadata, key=lambda p: p['data_startbyte']
+        )
+        with io.open(self.base_file, 'rb') as base_file:
+            for param_metadata in params_metadata:
+                base_file.seek(param_metadata['data_startbyte'])
+                buf = base_file.read(
+                    param_metadata['data_endbyte'] -
+                    param_metadata['data_startbyte']
+                )
+                ret[param_metadata['name']] = _parse_param_data(
+                    buf, param_metadata, self.dimensions
+                )
+
+        return ret
+
+    def __read_cache(self):
+        """
+        Return 2-tuple of dimensions and params dict from ``cache_file``
+        or None if it does not exist or is stale, i.e. ``base_file`` has
+        changed since the cache was written.
+        """
+        if not os.path.isfile(self.cache_file):
+            return None
+
+        try:
+            with np.load(self.cache_file) as cache:
+                metadata = json.loads(
+                    str(cache[_CACHE_METADATA_KEY]),
+                    object_pairs_hook=OrderedDict
+                )
+        except (IOError, OSError, ValueError, KeyError):
+            # unreadable, e.g. partially written by an older version
+            return None
+
+        if not metadata['key'] == _cache_key(
+                self.base_file, metadata['key']):
+            return None
+
+        self._dimensions_startbyte = metadata['dimensions_startbyte']
+
+        return (metadata['dimensions'], metadata['base_params'])
+
+    def __write_cache(self):
+        """
+        Write dimensions, parameter metadata and all parameter arrays of
+        ``base_file`` to ``cache_file``. The file is first written under a
+        temporary name and then renamed so that processes sharing the
+        cache never read a partially written file.
+        """
+        metadata = dict(
+            key=_cache_key(self.base_file),
+            dimensions=self.dimensions,
+            dimensions_startbyte=self._dimensions_startbyte,
+            base_params=self.base_params
+        )
+        arrays = {
+            _CACHE_ARRAY_PREFIX + name: arr for name, arr in
+            self.__load_parameter_arrays(self.base_params).items()
+        }
+        arrays[_CACHE_METADATA_KEY] = np.array(json.dumps(metadata))
+
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as outf:
+                np.savez(outf, **arrays)
+            _replace_file(tmp_file, self.cache_file)
+            self._cache_valid = True
+        except (IOError, OSError) as e:
+            warnings.warn('could not write parameter cache {}: {}'.format(
+                self.cache_file, e))
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            self.cache_file = None
+
     def __read_base(self, base_file):
         "Read base file returning 2-tuple of dimension and params dict"
 
-        params_startline, dimensions = self.__make_dimensions_dict(base_file)
-        base_params = self.__make_parameter_dict(base_file, params_startline)
+        # binary mode so that byte offsets of parameter blocks can be tracked
+        with io.open(base_file, 'rb') as base_file_reader:
+            params_startline, params_startbyte, dimensions = \
+                self.__make_dimensions_dict(base_file_reader)
+            base_params = self.__make_parameter_dict(
+                base_file_reader, params_startline, params_startbyte
+            )
 
         return (dimensions, base_params)
 
-    def __make_dimensions_dict(self, base_file):
+    def __make_dimensions_dict(self, base_file_reader):
         """
         Extract dimensions and each dimension length. Runs before
-        __make_parameter_dict.
+        __make_parameter_dict which continues reading from the same
+        file handle.
         """
         ret = OrderedDict()
 
         dim_name = ''
         dim_len = 0
-        # finished = False
+        offset = 0
+        self._dimensions_startbyte = 0
         found_dim_start = False
-        # while not finished:
-        for idx, l in enumerate(self.base_file_reader):
+        for idx, l in enumerate(base_file_reader):
+            offset += len(l)
 
-            if l.strip() == '** Dimensions **':  # start of dimensions
+            if l.strip() == b'** Dimensions **':  # start of dimensions
                 found_dim_start = True
+                self._dimensions_startbyte = offset - len(l)
 
-            elif '#' in l:  # comments
+            elif b'#' in l:  # comments
                 pass
 
-            elif l.strip() == '** Parameters **':  # start of parameters
+            elif l.strip() == b'** Parameters **':  # start of parameters
                 dimlines = idx
-                # finished = True
                 break
 
             elif found_dim_start:
 
                 if dim_name == '':
-                    dim_name = l.strip()
+                    dim_name = l.strip().decode()
                 else:
                     dim_len = int(l)
                     ret.update({dim_name: dim_len})
                     dim_name = ''
 
-        return (dimlines, ret)
+        return (dimlines, offset, ret)
 
-    def __make_parameter_dict(self, base_file, params_startline=0):
+    def __make_parameter_dict(self, base_file_reader, params_startline=0,
+                              params_startbyte=0):
         ret = []
 
         name = ''
@@ -420,10 +739,16 @@ class Parameters(object):
 
         dimnames_read = 0
         data_startline = 0
+        # byte offsets of the parameter block ("####" line) and of its data
+        block_startbyte = 0
+        data_startbyte = 0
+        offset = params_startbyte
 
-        for idx, l in enumerate(self.base_file_reader):
+        for idx, l in enumerate(base_file_reader):
+            line_startbyte = offset
+            offset += len(l)
 
-            if '#' in l:
+            if b'#' in l:
                 # we have a comment; the next lines will be new
                 # parameter metadata. No data for the first time through, so
                 # we don't want to append an metadata blob with empty values
@@ -435,7 +760,10 @@ class Parameters(object):
                             dimnames=dimnames,
                             length=length,
                             vartype=vartype,
-                            data_startline=data_startline
+                            data_startline=data_startline,
+                            block_startbyte=block_startbyte,
+                            data_startbyte=data_startbyte,
+                            data_endbyte=line_startbyte
                         )
                     )
 
@@ -446,24 +774,28 @@ class Parameters(object):
                     vartype = ''
                     dimnames_read = 0
 
+                block_startbyte = line_startbyte
+
             elif not name:
-                name = l.strip().split()[0] # in case old format with integer after name
+                # in case old format with integer after name
+                name = l.strip().split()[0].decode()
 
             elif not ndims:
                 ndims = int(l.strip())
 
             elif not (dimnames_read == ndims):
-                dimnames.append(l.strip())
+                dimnames.append(l.strip().decode())
                 dimnames_read += 1
 
             elif not length:
                 length = int(l.strip())
 
             elif not vartype:
-                vartype = l.strip()
+                vartype = l.strip().decode()
                 # advance one from current position and account for starting
                 # to count from zero
                 data_startline = params_startline + idx + 2
+                data_startbyte = offset
 
         # need to append one more time since iteration will have stopped after
         # last line
@@ -474,7 +806,10 @@ class Parameters(object):
                 dimnames=dimnames,
                 length=length,
                 vartype=vartype,
-                data_startline=data_startline
+                data_startline=data_startline,
+                block_startbyte=block_startbyte,
+                data_startbyte=data_startbyte,
+                data_endbyte=offset
             )
         )
 
@@ -487,26 +822,6 @@ class Parameters(object):
         Raises:
             KeyError if parameter name is not valid
         """
-        def load_parameter_array(param_metadata):
-
-            startline = param_metadata['data_startline']
-            endline = startline + param_metadata['length'] + 1
-
-            param_slice = itertools.islice(
-                    io.open(self.base_file, 'rb'), startline, endline
-                )
-
-            arr = np.genfromtxt(param_slice)
-
-            if param_metadata['ndims'] > 1:
-                dimsizes = [
-                    self.dimensions[d] for d in param_metadata['dimnames']
-                ]
-                dimsizes.reverse()
-                arr = arr.reshape(dimsizes)
-
-            return arr
-
         if key in self.param_arrays:
             return self.param_arrays[key]
 
@@ -519,21 +834,464 @@ class Parameters(object):
             except IndexError:
                 raise KeyError(key)
 
-            arr = load_parameter_array(param_metadata)
+            arr = self.__load_parameter_arrays([param_metadata])[key]
 
-            # cache the value for future access (but maybe shouldn't?)
-            self.param_arrays.update({key: arr})
+            # cache the value for future access, evicted later if the
+            # arrays exceed the memory budget of param_arrays
+            self.param_arrays.add(key, arr)
 
             return arr
 
     def __setitem__(self, key, value):
 
+        # load the current array if it was never accessed to check the shape
+        cur_arr = self[key]
+        if not value.shape == cur_arr.shape:
+            raise ValueError('New array does not match existing')
+
+        self.param_arrays[key] = value
+
+    def cache_info(self):
+        """
+        Statistics of the in-memory parameter arrays for tuning the
+        ``max_bytes`` memory budget.
+
+        Returns:
+            (dict): number of ``hits`` (accessed arrays already in memory),
+                ``misses`` (arrays read from ``base_file``) and
+                ``evictions``, plus the memory budget ``max_bytes``, the
+                bytes currently held ``nbytes``, the number of arrays held
+                ``n_arrays`` and of those the number ``n_modified``.
+        """
+        return self.param_arrays.info()
+
+    def _arrays_to_write(self):
+        """
+        Accessed and/or modified parameter arrays that ``write`` formats,
+        all other parameters are copied from ``base_file``.
+        """
+        return OrderedDict(self.param_arrays.items())
+
+    def _modified_arrays(self):
+        """
+        Parameter arrays that were assigned or modified in place, i.e. that
+        differ from ``base_file``, written by ``write_overlay``.
+        """
+        modified = self.param_arrays.modified()
+        return OrderedDict(
+            (name, arr) for name, arr in self.param_arrays.items()
+            if name in modified
+        )
+
+
+class ParameterOverlay(Parameters):
+    '''
+    Lightweight copy-on-write layer on top of a :class:`Parameters` instance.
+
+    A ``ParameterOverlay`` shares the dimensions, parameter metadata and
+    ``base_file`` of its ``base`` without reading the parameter file again
+    and only stores the arrays that are assigned to it. All other
+    parameters are read from the shared ``base``, which caches them once
+    for any number of overlays, and are returned as read-only arrays so
+    that the base can not be modified through an overlay by accident.
+    This makes overlays cheap to create in the thousands, e.g. one per
+    parameter sample of a Monte Carlo workflow. Overlays are written
+    through the normal :meth:`Parameters.write` path: parameters neither
+    modified in the overlay nor in ``base`` are copied from ``base_file``.
+
+    Arguments:
+        base (:class:`Parameters`): shared parameters to read unmodified
+            parameters from, may itself be a ``ParameterOverlay``
+
+    Attributes:
+        base (:class:`Parameters`): the shared base parameters
+        param_arrays (dict): dictionary with only the parameters that were
+            assigned to the overlay
+
+    Example:
+        >>> base = Parameters('path/to/a/parameter/file')
+        >>> overlays = []
+        >>> for scale in (0.9, 1.0, 1.1):
+        ...     p = ParameterOverlay(base)
+        ...     p['jh_coef'] = base['jh_coef'] * scale
+        ...     overlays.append(p)
+        >>> overlays[0].write('jh_coef_0.9_params')
+
+        ``base['jh_coef']`` is not changed and only one array is stored by
+        each overlay. To modify a parameter assign a new array, arrays read
+        from the base can not be modified in place:
+
+        >>> p['snow_adj'][0] = 1.0
+            ValueError: assignment destination is read-only
+    '''
+
+    def __init__(self, base):
+        if not isinstance(base, Parameters):
+            raise TypeError('base must be instance of Parameters, not '\
+                            + str(type(base)))
+        self.base = base
+        self.base_file = base.base_file
+        self.cache_file = base.cache_file
+        self.dimensions = base.dimensions
+        self.base_params = base.base_params
+        self._dimensions_startbyte = base._dimensions_startbyte
+        self._cache_valid = base._cache_valid
+        self.param_arrays = dict()
+
+    def load(self, names=None):
+        """
+        Load many parameters in a single pass into the shared ``base``,
+        see :meth:`Parameters.load`.
+        """
+        base_arrays = self.base.load(names)
+        return {name: self[name] for name in base_arrays}
+
+    def __getitem__(self, key):
         if key in self.param_arrays:
-            cur_arr = self.param_arrays[key]
-            if not value.shape == cur_arr.shape:
-                raise ValueError('New array does not match existing')
+            return self.param_arrays[key]
+
+        arr = self.base[key].view()
+        arr.flags.writeable = False
+
+        return arr
+
+    def cache_info(self):
+        "Statistics of the in-memory arrays of the base :class:`Parameters`"
+        return self.base.cache_info()
+
+    def _arrays_to_write(self):
+        ret = dict(self.base._arrays_to_write())
+        ret.update(self.param_arrays)
+
+        return ret
+
+    def _modified_arrays(self):
+        # arrays of the overlay are only ever assigned, never read
+        ret = dict(self.base._modified_arrays())
+        ret.update(self.param_arrays)
+
+        return ret
+
+class ParamArrayCache(object):
+    '''
+    Dictionary-like container of the parameter arrays of a
+    :class:`Parameters` instance with an optional memory budget.
+
+    Arrays read from the parameter file are added with ``add`` and, once
+    the arrays held exceed ``max_bytes``, the least recently used of them
+    are evicted. Arrays assigned with item assignment are considered
+    modified and are never evicted. Arrays that were modified in place
+    after being read are detected by a checksum taken when they were read
+    and kept as modified too, including evicted arrays that are still
+    referenced elsewhere.
+
+    Keyword Arguments:
+        max_bytes (int or None): memory budget, None for no limit
+
+    Attributes:
+        hits (int): lookups of arrays held in memory
+        misses (int): arrays added after reading them from file
+        evictions (int): arrays evicted to stay within ``max_bytes``
+    '''
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        # insertion ordered arrays, LRU order of evictable names and
+        # checksums of arrays as they were read
+        self._arrays = OrderedDict()
+        self._lru = OrderedDict()
+        self._checksums = dict()
+        # evicted arrays that may still be referenced and modified
+        self._evicted = dict()
+
+    def add(self, name, arr):
+        "Add an array that was read from file, i.e. not modified"
+        self.misses += 1
+        self.__insert(name, arr)
+        self._checksums[name] = _checksum(arr)
+        if self.max_bytes is not None:
+            self._lru[name] = None
+            self.__evict(keep=name)
+
+    def info(self):
+        "Dictionary of cache statistics"
+        self.__collect_evicted()
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            max_bytes=self.max_bytes,
+            nbytes=self.nbytes,
+            n_arrays=len(self._arrays),
+            n_modified=len(self.modified())
+        )
+
+    def modified(self):
+        """
+        Names of arrays that were assigned or changed in place after they
+        were read from file.
+        """
+        self.__collect_evicted()
+        return set(
+            name for name, arr in self._arrays.items()
+            if name not in self._checksums or
+            not _checksum(arr) == self._checksums[name]
+        )
+
+    def __insert(self, name, arr):
+        if name in self._arrays:
+            self.nbytes -= self._arrays[name].nbytes
+        self._arrays[name] = arr
+        self.nbytes += arr.nbytes
+        self._evicted.pop(name, None)
+
+    def __remove(self, name):
+        arr = self._arrays.pop(name)
+        self.nbytes -= arr.nbytes
+        self._lru.pop(name, None)
+        return arr
+
+    def __evict(self, keep=None):
+        "Evict least recently used unmodified arrays to fit max_bytes"
+        for name in list(self._lru):
+            if self.nbytes <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            arr = self._arrays[name]
+            if not _checksum(arr) == self._checksums[name]:
+                # modified in place after it was read, pin it
+                del self._lru[name]
+                continue
+            self.__remove(name)
+            self.evictions += 1
+            try:
+                self._evicted[name] = weakref.ref(arr)
+            except TypeError:
+                pass
+
+    def __collect_evicted(self):
+        """
+        Take back evicted arrays that are still referenced elsewhere, as
+        modified if they were changed in place after eviction.
+        """
+        for name, ref in list(self._evicted.items()):
+            arr = ref()
+            if arr is None:
+                del self._evicted[name]
+            elif not _checksum(arr) == self._checksums[name]:
+                self.__insert(name, arr)
+
+    def __contains__(self, name):
+        if name in self._arrays:
+            return True
+        ref = self._evicted.get(name)
+        return ref is not None and ref() is not None
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            arr = self._evicted[name]() if name in self._evicted else None
+            if arr is None:
+                raise KeyError(name)
+            # still referenced after eviction, take it back
+            self.__insert(name, arr)
+            if _checksum(arr) == self._checksums[name]:
+                self._lru[name] = None
+                self.__evict(keep=name)
+        elif name in self._lru:
+            # mark as most recently used
+            del self._lru[name]
+            self._lru[name] = None
+
+        self.hits += 1
+        return self._arrays[name]
+
+    def __setitem__(self, name, arr):
+        "Assign a modified array, it will not be evicted"
+        self.__insert(name, arr)
+        self._lru.pop(name, None)
+        self._checksums.pop(name, None)
+
+    def update(self, arrays):
+        for name, arr in dict(arrays).items():
+            self[name] = arr
+
+    def __iter__(self):
+        self.__collect_evicted()
+        return iter(list(self._arrays))
+
+    def __len__(self):
+        self.__collect_evicted()
+        return len(self._arrays)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self._arrays[name] for name in self]
+
+    def items(self):
+        return [(name, self._arrays[name]) for name in self]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getstate__(self):
+        # weak references can not be pickled
+        state = self.__dict__.copy()
+        state['_evicted'] = dict()
+        return state
+
+_CACHE_METADATA_KEY = '__metadata__'
+_CACHE_ARRAY_PREFIX = 'param:'
+
+def _cache_path(base_file, cache):
+    """
+    Path of the binary cache file for ``base_file``, a hidden sidecar
+    file next to it if ``cache`` is True or a file named by the hash of
+    the absolute path of ``base_file`` if ``cache`` is a directory.
+    """
+    if cache is True:
+        base_dir, name = os.path.split(os.path.abspath(base_file))
+        return OPJ(base_dir, '.{}.cache.npz'.format(name))
+
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    path_hash = hashlib.sha1(
+        os.path.abspath(base_file).encode('utf-8')
+    ).hexdigest()
+    return OPJ(cache, '{}.npz'.format(path_hash))
+
+def _cache_key(base_file, cached_key=None):
+    """
+    Identity of ``base_file``: absolute path, size, modification time and
+    SHA-1 content hash. If a previously ``cached_key`` is given the content
+    hash is only computed if the path, size and modification time match.
+    """
+    stat = os.stat(base_file)
+    key = dict(
+        path=os.path.abspath(base_file),
+        size=stat.st_size,
+        mtime=stat.st_mtime
+    )
+    if cached_key is not None and any(
+            cached_key.get(k) != v for k, v in key.items()):
+        return key
+
+    sha1 = hashlib.sha1()
+    with io.open(base_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    key['sha1'] = sha1.hexdigest()
+
+    return key
+
+def _checksum(arr):
+    "Cheap checksum of the data of an array to detect in place changes"
+    return zlib.crc32(np.ascontiguousarray(arr).view(np.uint8).ravel())
+
+def _file_header():
+    "First two lines of parameter files written by ``Parameters``"
+    return 'File Auto-generated by PRMS-Python\n{}\n'.format(
+        datetime.datetime.now().isoformat()
+    ).encode()
+
+def _copy_range(src, dst, start, end, chunk_size=1 << 20):
+    """
+    Copy bytes ``start`` to ``end`` of file handle ``src`` to ``dst`` in
+    chunks, making sure the copied range ends with a newline.
+    """
+    src.seek(start)
+    remaining = end - start
+    last = b''
+    while remaining > 0:
+        buf = src.read(min(chunk_size, remaining))
+        if not buf:
+            break
+        dst.write(buf)
+        remaining -= len(buf)
+        last = buf[-1:]
+
+    if last and last != b'\n':
+        dst.write(b'\n')
+
+def _format_param_values(arr, vartype):
+    """
+    Format parameter values as newline separated PRMS text in bulk, using
+    the shortest repr of floats which is identical to ``str`` of numpy
+    floats, integers for PRMS data type 1 and strings for data type 4.
+    """
+    if vartype == '1':
+        values = np.asarray(arr).astype(int).ravel()
+        text = '\n'.join(map(str, values.tolist()))
+    elif vartype == '4':
+        values = np.asarray(arr).astype(str).ravel()
+        text = '\n'.join(values.tolist())
+    else:
+        values = np.ascontiguousarray(arr, dtype=float).ravel()
+        # float repr is the expensive part; parameters often repeat few
+        # distinct values (e.g. per land cover type) so format each unique
+        # value once, compared by bits to keep -0.0 and nan as they are
+        uniq, inverse = np.unique(values.view(np.int64), return_inverse=True)
+        if uniq.size < values.size // 2:
+            uniq_text = np.array(
+                [repr(v) for v in uniq.view(float).tolist()], dtype=object
+            )
+            text = '\n'.join(uniq_text[inverse.ravel()].tolist())
+        else:
+            text = '\n'.join(map(repr, values.tolist()))
+
+    return (text + '\n').encode() if values.size else b''
+
+def _format_param_block(param_info, arr):
+    "PRMS text of one parameter block including its metadata lines"
+    header = ['####', str(param_info['name']), str(param_info['ndims'])]
+    header.extend(param_info['dimnames'])
+    header.extend([str(param_info['length']), str(param_info['vartype'])])
+
+    return ('\n'.join(header) + '\n').encode() +\
+        _format_param_values(arr, param_info['vartype'])
+
+def _parse_param_data(buf, param_metadata, dimensions):
+    """
+    Parse the raw bytes of a parameter data block into a ``numpy.ndarray``
+    of the PRMS data type of the parameter (integer for vartype 1, string
+    for vartype 4, float otherwise) shaped by the parameter dimensions.
+    """
+    if param_metadata['vartype'] == '4':
+        arr = np.array(buf.decode().split(), dtype=str)
+    elif param_metadata['vartype'] == '1':
+        # integers may be written with a decimal point, e.g. 1.0
+        arr = np.array(buf.split(), dtype=float).astype(int)
+    else:
+        arr = np.array(buf.split(), dtype=float)
+
+    if not arr.size == param_metadata['length']:
+        raise ValueError(
+            '{} has {} values, expected {}'.format(
+                param_metadata['name'], arr.size, param_metadata['length']
+            )
+        )
 
-            self.param_arrays[key] = value
+    return arr.reshape(_param_shape(param_metadata, dimensions))
+
+def _param_shape(param_metadata, dimensions):
+    "Shape of the ``numpy.ndarray`` representation of a parameter"
+    if param_metadata['ndims'] > 1:
+        dimsizes = [
+            dimensions[d] for d in param_metadata['dimnames']
+        ]
+        dimsizes.reverse()
+        return tuple(dimsizes)
+    elif param_metadata['length'] == 1:
+        # single valued parameters are zero dimensional arrays
+        return ()
+
+    return (param_metadata['length'],)
 
 def modify_params(params_in, params_out, param_mods=None):
     '''
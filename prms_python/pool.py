@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+pool.py -- holds ``WorkerPool``, a persistent pool of workers that runs the
+PRMS simulations of many ``SimulationSeries``, ``ScenarioSeries`` and
+``Optimizer`` stages without starting new workers for each.
+'''
+
+import importlib
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+
+class WorkerPool(object):
+    '''
+    Pool of worker processes or threads that stays alive across calls.
+
+    ``SimulationSeries.run``, ``ScenarioSeries.run`` and
+    ``Optimizer.monte_carlo`` otherwise start a new pool for each call and
+    pay for starting the workers and importing NumPy, pandas and
+    ``prms_python`` in each of them every time. A ``WorkerPool`` passed as
+    their ``pool`` argument is reused instead and only shut down by
+    :meth:`WorkerPool.close` or at the end of a ``with`` block.
+
+    With the 'forkserver' start method the modules in ``preload`` are
+    imported once by the fork server and every worker is forked from it
+    ready to run, with 'spawn' or 'fork' each worker imports them when it
+    starts, before the first simulation is run.
+
+    Keyword Arguments:
+        nproc (int or None): number of workers, default half of the
+            available processors
+        backend (str): 'process' for a :class:`multiprocessing.Pool` or
+            'thread' for a thread pool, see :meth:`SimulationSeries.run`.
+            Default 'process'.
+        start_method (str or None): :mod:`multiprocessing` start method of
+            the worker processes, 'fork', 'forkserver' or 'spawn', default
+            the platform default. Requires Python 3.4 or later.
+        preload (tuple): names of modules imported by the workers before
+            running simulations
+
+    Example:
+        Run several Monte Carlo stages with the same 8 workers,
+
+        >>> with WorkerPool(nproc=8, start_method='forkserver') as pool:
+                for stage, names in stages.items():
+                    optr.monte_carlo(measured, names, 'basin_cfs_1',
+                                     stage=stage, pool=pool)
+
+    Raises:
+        ValueError: if ``backend`` or ``start_method`` are not supported
+    '''
+
+    def __init__(self, nproc=None, backend='process', start_method=None,
+                 preload=('prms_python',)):
+        if not nproc:
+            nproc = max(1, mp.cpu_count() // 2)
+        self.nproc = nproc
+        self.backend = backend
+        self.start_method = start_method
+        self.preload = tuple(preload)
+
+        if backend == 'thread':
+            self._pool = ThreadPool(processes=nproc)
+        elif backend == 'process':
+            if start_method is None:
+                context = mp
+            elif hasattr(mp, 'get_context'):
+                context = mp.get_context(start_method)
+            else:
+                raise ValueError(
+                    'start_method requires Python 3.4 or later'
+                )
+            if start_method == 'forkserver':
+                context.set_forkserver_preload(list(self.preload))
+            self._pool = context.Pool(
+                processes=nproc, initializer=_preload,
+                initargs=(self.preload,)
+            )
+        else:
+            raise ValueError('backend must be process or thread')
+
+        self.closed = False
+
+    def imap_unordered(self, fun, iterable, chunksize=1):
+        '''
+        Apply ``fun`` to each item of ``iterable`` in the workers.
+
+        Returns:
+            iterator of the results in order of completion
+        '''
+        self._check_open()
+        return self._pool.imap_unordered(fun, iterable, chunksize)
+
+    def map(self, fun, iterable, chunksize=None):
+        '''
+        Apply ``fun`` to each item of ``iterable`` in the workers.
+
+        Returns:
+            :obj:`list`: results in the order of ``iterable``
+        '''
+        self._check_open()
+        return self._pool.map(fun, iterable, chunksize)
+
+    def close(self):
+        '''
+        Let the workers finish outstanding work, then stop them.
+
+        Returns:
+            None
+        '''
+        if not self.closed:
+            self.closed = True
+            self._pool.close()
+            self._pool.join()
+
+    def terminate(self):
+        '''
+        Stop the workers immediately, outstanding work is lost.
+
+        Returns:
+            None
+        '''
+        if not self.closed:
+            self.closed = True
+            self._pool.terminate()
+            self._pool.join()
+
+    def _check_open(self):
+        if self.closed:
+            raise RuntimeError('WorkerPool has been closed')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def __repr__(self):
+        return '<WorkerPool {} {} workers{}>'.format(
+            self.nproc, self.backend, ', closed' if self.closed else ''
+        )
+
+
+def _preload(modules):
+    "Worker initializer importing the modules used by the simulations"
+    for name in modules:
+        importlib.import_module(name)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+retention.py -- holds ``Retention``, a policy for which outputs of a
+simulation are kept and how they are compressed right after it has run.
+'''
+
+import fnmatch
+import gzip
+import os
+import shutil
+
+from .util import COMPRESSED_SUFFIXES, lzma
+
+OPJ = os.path.join
+
+
+class Retention(object):
+    '''
+    Output retention policy applied to ``simulation_dir/outputs`` of a
+    :class:`Simulation` as soon as PRMS has finished.
+
+    Outputs that match none of the ``keep`` patterns are deleted and the
+    remaining text outputs are compressed with gzip or lzma, so thousands
+    of simulations of an optimization stage do not fill the disk before
+    they are analyzed. :func:`util.load_statvar` and :func:`util.load_data`
+    read the compressed files transparently by their original path, e.g.
+    *outputs/statvar.dat* is read from *outputs/statvar.dat.gz*.
+
+    Keyword Arguments:
+        keep (tuple or None): :mod:`fnmatch` patterns of the outputs to
+            keep, e.g. ('statvar.dat', 'prms.out'), None keeps all
+        compress (str or None): 'gzip' or 'lzma' to compress the kept
+            outputs, None (default) leaves them uncompressed
+        compresslevel (int or None): compression level, default 6 for
+            gzip and the lzma default preset
+
+    Example:
+        Keep only the gzipped statvar file of each Monte Carlo simulation,
+
+        >>> retention = Retention(keep=('statvar.dat',), compress='gzip')
+        >>> optr.monte_carlo(measured, names, 'basin_cfs_1',
+                             retention=retention)
+
+    Raises:
+        ValueError: if ``compress`` is not 'gzip', 'lzma' or None, or lzma
+            is not available
+    '''
+
+    def __init__(self, keep=None, compress=None, compresslevel=None):
+        if compress not in (None, 'gzip', 'lzma'):
+            raise ValueError('compress must be gzip, lzma or None')
+        if compress == 'lzma' and lzma is None:
+            raise ValueError('lzma compression requires Python 3')
+        self.keep = None if keep is None else tuple(keep)
+        self.compress = compress
+        self.compresslevel = compresslevel
+
+    def apply(self, outputs_dir):
+        '''
+        Delete the outputs in ``outputs_dir`` that are not kept and compress
+        the others.
+
+        Arguments:
+            outputs_dir (str): directory with the outputs of a simulation
+
+        Returns:
+            :obj:`list`: names of the kept files after compression
+        '''
+        kept = []
+        for name in sorted(os.listdir(outputs_dir)):
+            path = OPJ(outputs_dir, name)
+            if not os.path.isfile(path):
+                continue
+            if not self.keeps(name):
+                os.remove(path)
+                continue
+            if self.compress and not _is_binary(name):
+                name = os.path.basename(self._compress(path))
+            kept.append(name)
+
+        return kept
+
+    def keeps(self, name):
+        '''
+        Whether the output ``name``, compressed or not, is kept.
+
+        Returns:
+            bool
+        '''
+        if self.keep is None:
+            return True
+        for suffix in COMPRESSED_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+
+        return any(fnmatch.fnmatch(name, pat) for pat in self.keep)
+
+    def _compress(self, path):
+        "Replace path by its compressed copy, keeping the modification time"
+        if self.compress == 'gzip':
+            dst = path + '.gz'
+            outf = gzip.open(
+                dst, 'wb', 6 if self.compresslevel is None
+                else self.compresslevel
+            )
+        else:
+            dst = path + '.xz'
+            outf = lzma.open(dst, 'wb', preset=self.compresslevel)
+        with open(path, 'rb') as inf:
+            with outf:
+                shutil.copyfileobj(inf, outf, 2**20)
+        shutil.copystat(path, dst)
+        os.remove(path)
+
+        return dst
+
+    def __repr__(self):
+        return '<Retention keep={} compress={}>'.format(
+            self.keep, self.compress
+        )
+
+
+def _is_binary(name):
+    "Outputs that are compressed already or not text"
+    return name.endswith(COMPRESSED_SUFFIXES + ('.npy',))
@@ -5,18 +5,24 @@ managing parameter-based model scenarios that may be used for hypotheses
 testing.
 '''
 
+import functools
 import inspect
 import json
 import multiprocessing as mp
 import os
 import shutil
+import time
 import uuid
 
 from datetime import datetime
 from .parameters import modify_params, Parameters
 from .data import Data
 from .util import load_statvar
-from .simulation import Simulation
+from .control import Control
+from .pool import WorkerPool
+from .simulation import (
+    Simulation, _overlay_param_files, _resource_report
+)
 
 
 class ScenarioSeries(object):
@@ -146,7 +152,7 @@ class ScenarioSeries(object):
     def __len__(self):
         return len(self.scenarios)
 
-    def build(self, scenarios_list):
+    def build(self, scenarios_list, overlay=False):
         """
         Build the scenarios from a list of scenario definitions in dicitonary
         form. 
@@ -162,6 +168,13 @@ class ScenarioSeries(object):
             scenarios_list (list): list of dictionaries with key-value
                 pairs being parameter-function definition pairs or
                 title-title string or description-description string.
+
+        Keyword Arguments:
+            overlay (bool): if True each scenario only gets a parameter
+                file with its modified parameters that is listed after
+                ``base_inputs/parameters`` in its *control* file, see
+                :meth:`Scenario.build`. Default False.
+
         Returns:
             None
 
@@ -233,14 +246,18 @@ class ScenarioSeries(object):
 
             scenario_path = os.path.join(self.scenarios_dir, uu)
 
+            # overlays reference the copy of the base inputs in the series
+            base_dir = os.path.join(self.scenarios_dir, 'base_inputs') \
+                if overlay else self.base_dir
+
             # create Scenario
             scenario = Scenario(
-                self.base_dir, scenario_path, title=title,
+                base_dir, scenario_path, title=title,
                 description=description
             )
 
             # s now only contains parameter keys and function references vals
-            scenario.build(s)
+            scenario.build(s, overlay=overlay)
 
             self.scenarios.append(scenario)
 
@@ -250,7 +267,8 @@ class ScenarioSeries(object):
 
             f.write(json.dumps(self.metadata, indent=2))
 
-    def run(self, prms_exec='prms', nproc=None):
+    def run(self, prms_exec='prms', nproc=None, backend='process',
+            timeout=None, retries=0, pool=None, cache=None, queue=None):
         """
         Run a "built" ``ScenarioSeries`` and make final updates
         to file structure and metadata. 
@@ -262,10 +280,33 @@ class ScenarioSeries(object):
                 parallelize PRMS simulations, if None (default) then use
                 half of what the :mod:`multiprocessing` detects on the
                 machine.
+            backend (str): 'process', 'thread' or 'asyncio', see
+                :meth:`SimulationSeries.run`. Default 'process'.
+            timeout (float or None): wall-clock seconds after which the
+                PRMS run of a scenario is killed, see :meth:`Simulation.run`
+            retries (int): number of times a failed PRMS run is repeated
+            pool (:class:`WorkerPool` or None): run the scenarios in these
+                persistent workers instead of starting a new pool,
+                ``nproc`` and ``backend`` are then ignored, see
+                :meth:`SimulationSeries.run`
+            cache (:class:`ResultCache` or None): reuse the outputs of runs
+                with the same inputs, e.g. repeated grid points, see
+                :meth:`Simulation.run`
+            queue (:class:`JobQueue` or None): submit the scenarios to this
+                job queue and wait for ``prmspy worker`` processes on any
+                host to run them, ``nproc``, ``backend`` and ``pool`` are
+                then ignored
 
         Returns:
             None
 
+        Raises:
+            ValueError: if ``backend`` is not 'process', 'thread' or
+                'asyncio' and no ``pool`` is given
+            RuntimeError: with ``backend='asyncio'`` if an event loop is
+                already running, await :meth:`ScenarioSeries.run_async`
+                instead
+
         Examples:
             This example starts where the example ends in 
             :meth:`ScenarioSeries.build`, calling ``run`` will run the
@@ -279,20 +320,22 @@ class ScenarioSeries(object):
             │   │   ├── data
             │   │   └── parameters
             │   ├── metadata.json
-            │   └── outputs
-            │       ├── prms_ic.out
-            │       ├── prms.out
-            │       └── statvar.dat
+            │   ├── outputs
+            │   │   ├── prms_ic.out
+            │   │   ├── prms.out
+            │   │   └── statvar.dat
+            │   └── resources.json
             ├── 9d28ec5a-b570-4abb-8000-8dac113cbed3
             │   ├── inputs
             │   │   ├── control
             │   │   ├── data
             │   │   └── parameters
             │   ├── metadata.json
-            │   └── outputs
-            │       ├── prms_ic.out
-            │       ├── prms.out
-            │       └── statvar.dat
+            │   ├── outputs
+            │   │   ├── prms_ic.out
+            │   │   ├── prms.out
+            │   │   └── statvar.dat
+            │   └── resources.json
             ├── base_inputs
             │   ├── control
             │   ├── data
@@ -312,6 +355,10 @@ class ScenarioSeries(object):
               }
             }
         
+        After the run it also holds the aggregate ``"resources"`` used by the
+        scenarios, see :meth:`SimulationSeries.resource_report`, and each
+        scenario's *resources.json* holds its own, see
+        :meth:`Simulation.run`.
         Therefore one can use the :mod:`json` file to track between UUID's and 
         individual scenario titles. The json files are read as a Python
         dictionary which makes them particularly convenient. The contents of
@@ -337,16 +384,105 @@ class ScenarioSeries(object):
             one would have to rely on the individual ``metadata.json`` files
             in each scenario directory which may be more cumbersome.
         """
-        if not nproc:
-            nproc = mp.cpu_count()//2
+        if pool is not None:
+            nproc = pool.nproc
+        elif not nproc:
+            nproc = max(1, mp.cpu_count() // 2)
+
+        if queue is not None:
+            start = time.time()
+            self._run_queue(queue, prms_exec, timeout, retries, cache)
+            self._write_resources(time.time() - start, nproc)
+            return
+        elif pool is None and backend == 'asyncio':
+            from .aio import run_sync
+            start = time.time()
+            run_sync(self.run_async(prms_exec, nproc, timeout, retries,
+                                    cache))
+            self._write_resources(time.time() - start, nproc)
+            return
+        elif pool is None and backend not in ('process', 'thread'):
+            raise ValueError('backend must be process, thread or asyncio')
+
+        runner = functools.partial(
+            _scenario_runner, prms_exec=prms_exec, timeout=timeout,
+            retries=retries, cache=cache
+        )
+        start = time.time()
+        if pool is not None:
+            records = pool.map(runner, self.scenarios)
+        else:
+            with WorkerPool(nproc, backend) as pool:
+                records = pool.map(runner, self.scenarios)
+        # scenarios run in worker processes are copies
+        for scenario, record in zip(self.scenarios, records):
+            scenario.simulation._update(record)
+        self._write_resources(time.time() - start, nproc)
+
+    def _run_queue(self, queue, prms_exec, timeout, retries, cache):
+        "Submit the scenarios to a JobQueue and wait for them"
+        for scenario in self.scenarios:
+            scenario._start_run()
+        job_ids = queue.submit(
+            [scenario.simulation for scenario in self.scenarios],
+            prms_exec=prms_exec, timeout=timeout, retries=retries,
+            cache=cache
+        )
+        index = dict((job_id, idx) for idx, job_id in enumerate(job_ids))
+        for job_id, record in queue.iter_results(job_ids):
+            scenario = self.scenarios[index[job_id]]
+            scenario.simulation._update(record)
+            scenario._finish_run()
+
+    def _write_resources(self, elapsed, nproc):
+        "Add the resource report of the run to series_metadata.json"
+        self.metadata['resources'] = _resource_report(
+            [scenario.simulation.result() for scenario in self.scenarios],
+            elapsed=elapsed, nproc=nproc
+        )
+        with open(
+            os.path.join(self.scenarios_dir, 'series_metadata.json'), 'w'
+        ) as f:
+            f.write(json.dumps(self.metadata, indent=2))
+
+    def run_async(self, prms_exec='prms', nproc=None, timeout=None,
+                  retries=0, cache=None):
+        """
+        Coroutine that runs all built scenarios as :mod:`asyncio`
+        subprocesses, the ``ScenarioSeries`` counterpart of
+        :meth:`SimulationSeries.run_async`. Requires Python 3.7 or later.
+
+        Keyword Arguments:
+            prms_exec (str): name of PRMS executable on $PATH or path to
+                executable. Default = 'prms'
+            nproc (int or None): maximum number of PRMS processes running
+                at once, default half of the available processors
+            timeout (float or None): see :meth:`Simulation.run`
+            retries (int): see :meth:`Simulation.run`
+            cache (:class:`ResultCache` or None): see :meth:`Simulation.run`
+
+        Returns:
+            coroutine that returns the list of scenarios when awaited
+
+        Example:
+            >>> series.build(scenario_list)
+            >>> await series.run_async(nproc=8)
+        """
+        from .aio import run_all, run_scenario
 
-        pool = mp.Pool(processes=nproc)
-        pool.map(_scenario_runner, self.scenarios)
+        return run_all(
+            run_scenario, self.scenarios, nproc=nproc, prms_exec=prms_exec,
+            timeout=timeout, retries=retries, cache=cache
+        )
 
 
 # multiprocessing req the function be def'd at root scope so it's picklable
-def _scenario_runner(scenario, prms_exec='prms'):
-    scenario.run(prms_exec=prms_exec)
+def _scenario_runner(scenario, prms_exec='prms', timeout=None, retries=0,
+                     cache=None):
+    scenario.run(prms_exec=prms_exec, timeout=timeout, retries=retries,
+                 cache=cache)
+
+    return scenario.simulation.result()
 
 
 class Scenario:
@@ -483,7 +619,7 @@ class Scenario:
 
         self.__simulation_ready = False
 
-    def build(self, param_mod_funs=None):
+    def build(self, param_mod_funs=None, overlay=False):
         """
         Take a user-defined dictionary with param names as keys and Python
         functions as values, copy the original input files as given when
@@ -495,6 +631,14 @@ class Scenario:
         Keyword Arguments:
             param_mod_funs (dict): dictionary with parameter names as keys
                 and Python functions as values to apply to the names (key)
+            overlay (bool): if True only write the modified parameters to
+                the *parameters* file in ``scenario_dir`` and list it after
+                the absolute paths of the parameter files of the *control*
+                file in ``base_dir``, including its *parameters* file, in
+                the *param_file* entry of the copied *control* file,
+                PRMS uses the later file for parameters in both. The
+                *parameters* file in ``base_dir`` must then be kept in
+                place. Default False.
 
         Returns:
             None
@@ -515,19 +659,31 @@ class Scenario:
                 shutil.rmtree(self.scenario_dir)
 
             os.makedirs(self.scenario_dir)
-            shutil.copy(
-                os.path.join(self.base_dir, 'control'), self.scenario_dir
-            )
             shutil.copy(
                 os.path.join(self.base_dir, 'data'), self.scenario_dir
             )
 
             old_params_path = os.path.join(self.base_dir, 'parameters')
             new_params_path = os.path.join(self.scenario_dir, 'parameters')
-            if not param_mod_funs:
-                shutil.copy(old_params_path, self.scenario_dir)
+            control_path = os.path.join(self.base_dir, 'control')
+            if overlay:
+                params = Parameters(old_params_path)
+                for k in param_mod_funs:
+                    params[k] = param_mod_funs[k](params[k])
+                params.write_overlay(new_params_path)
+                control = Control(control_path)
+                control['param_file'] = _overlay_param_files(
+                    control, old_params_path
+                )
+                control.write(os.path.join(self.scenario_dir, 'control'))
             else:
-                modify_params(old_params_path, new_params_path, param_mod_funs)
+                shutil.copy(control_path, self.scenario_dir)
+                if not param_mod_funs:
+                    shutil.copy(old_params_path, self.scenario_dir)
+                else:
+                    modify_params(
+                        old_params_path, new_params_path, param_mod_funs
+                    )
 
             param_mod_funs_metadata = {
                 param_name: inspect.getsource(param_mod_fun)
@@ -543,13 +699,20 @@ class Scenario:
 
         self.__simulation_ready = True
 
-    def run(self, prms_exec='prms'):
+    def run(self, prms_exec='prms', timeout=None, retries=0, cache=None):
         """
         Run the PRMS simulation for a *built* ``Scenario`` instance.
 
+        The PRMS exit status is recorded as ``returncode`` in the scenario
+        metadata, a failed run does not raise.
+
         Keyword Arguments: 
             prms_exec (str): name of PRMS executable on $PATH or path to 
                 executable
+            timeout (float or None): wall-clock seconds after which PRMS is
+                killed, see :meth:`Simulation.run`
+            retries (int): number of times a failed PRMS run is repeated
+            cache (:class:`ResultCache` or None): see :meth:`Simulation.run`
         
         Returns:
             None
@@ -561,14 +724,26 @@ class Scenario:
             RuntimeError: if the :func:`Scenario.build` method has not yet
                 been called.
         """
+        self._start_run()
+        self.simulation.run(
+            prms_exec=prms_exec, timeout=timeout, retries=retries,
+            cache=cache
+        )
+        self._finish_run()
+
+    def _start_run(self):
+        "Check that the scenario is built and record the start time"
         if not self.__simulation_ready:
             raise RuntimeError(
                 'Scenario has not yet been prepared: run build_scenario first'
             )
 
         self.metadata['start_datetime'] = datetime.now().isoformat()
-        self.simulation.run(prms_exec=prms_exec)
+
+    def _finish_run(self):
+        "Record the end time and exit status and write the scenario metadata"
         self.metadata['end_datetime'] = datetime.now().isoformat()
+        self.metadata['returncode'] = self.simulation.returncode
 
         self.metadata.write(os.path.join(self.scenario_dir, 'metadata.json'))
 
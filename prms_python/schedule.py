@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+'''
+schedule.py -- holds ``CostModel``, which learns how long simulations take
+from earlier runs so a ``SimulationSeries`` can start the longest ones
+first.
+'''
+
+import hashlib
+import json
+import math
+import os
+import uuid
+
+from .cache import OUTPUT_ENTRIES
+from .control import Control
+from .parameters import Parameters
+
+OPJ = os.path.join
+
+# control file entries that do not change the cost per simulated day
+_IGNORED_ENTRIES = OUTPUT_ENTRIES + (
+    'start_time', 'end_time', 'data_file', 'param_file', 'var_init_file'
+)
+
+
+class CostModel(object):
+    '''
+    Expected wall-clock time of simulations learned from earlier runs.
+
+    Simulations are grouped by their *control* file settings other than
+    the simulation period and file names, i.e. simulations of the same
+    model and modules. For each group the model keeps a moving average of
+    the seconds PRMS took per simulated day and predicts the cost of a
+    simulation as that rate times the number of days it simulates, so
+    simulations with longer periods are expected to take longer. Groups
+    without history use the mean rate of all groups.
+
+    Within a group, e.g. the samples of a Monte Carlo stage, the rate of a
+    simulation is predicted from the recent runs with the most similar
+    parameters instead: each run is described by the mean value of every
+    parameter it modified, and the rates of the ``neighbors`` nearest runs
+    are averaged weighted by their inverse distance, with each parameter
+    scaled by its range. Parameters that are the same in all runs do not
+    count, if none differ the group rate is used. The modified parameters
+    of a simulation built by :meth:`Simulation.from_data` are taken from
+    the arrays in memory, otherwise only an overlay parameter file in its
+    directory is read, see ``overlay`` of :meth:`Simulation.from_data`,
+    once per simulation.
+
+    Given as ``costs`` to :meth:`SimulationSeries.run` the simulations are
+    started in order of decreasing expected cost and the model learns from
+    each run, runs taken from a :class:`ResultCache` are not counted. With
+    a ``path`` what was learned is saved after each series and used by
+    later series, e.g. the next stages of an optimization.
+
+    Keyword Arguments:
+        path (str or None): JSON file the model is loaded from if it exists
+            and saved to, default None keeps it in memory
+        window (int): number of recent runs a group's rate mostly depends
+            on, older runs are weighted down exponentially, and number of
+            recent runs per group kept to compare parameters with
+        neighbors (int): number of runs with the most similar parameters
+            the rate of a simulation is predicted from
+
+    Example:
+        >>> costs = CostModel('calibration_costs.json')
+        >>> for stage, names in stages.items():
+                optr.monte_carlo(measured, names, 'basin_cfs_1', stage=stage,
+                                 costs=costs)
+    '''
+
+    def __init__(self, path=None, window=50, neighbors=5):
+        self.path = path
+        self.window = window
+        self.neighbors = neighbors
+        self.rates = {}
+        self.runs = {}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.rates = saved['rates']
+            self.runs = saved.get('runs', {})
+
+    def predict(self, sim):
+        '''
+        Expected wall-clock seconds of running a simulation.
+
+        Arguments:
+            sim (:class:`Simulation`): built simulation
+
+        Returns:
+            float: predicted seconds, in units of simulated days if nothing
+                has been learned yet
+        '''
+        group, days = _features(sim)
+        rate = None
+        if self.runs.get(group):
+            rate = _nearest_rate(self.runs[group], self._params(sim),
+                                 self.neighbors)
+        if rate is None and group in self.rates:
+            rate = self.rates[group]['rate']
+        elif rate is None and self.rates:
+            rate = sum(g['rate'] for g in self.rates.values()) / \
+                len(self.rates)
+        elif rate is None:
+            rate = 1.0
+
+        return rate * days
+
+    def update(self, sim):
+        '''
+        Learn from a simulation that has run.
+
+        Returns:
+            None
+        '''
+        if not sim.has_run or sim.cached or sim.returncode != 0:
+            return
+        group, days = _features(sim)
+        rate = sim.wall_time / days
+        entry = self.rates.setdefault(group, {'rate': rate, 'n': 0})
+        entry['n'] += 1
+        entry['rate'] += (rate - entry['rate']) / min(entry['n'], self.window)
+
+        runs = self.runs.setdefault(group, [])
+        runs.append({'params': self._params(sim), 'rate': rate})
+        del runs[:-self.window]
+
+    def save(self, path=None):
+        '''
+        Save the learned rates as JSON.
+
+        Keyword Arguments:
+            path (str or None): file to write, default ``path``
+
+        Returns:
+            None
+        '''
+        path = path or self.path
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp, 'w') as f:
+            json.dump({'rates': self.rates, 'runs': self.runs}, f)
+        os.rename(tmp, path)
+
+    def _params(self, sim):
+        "Mean value of each modified parameter of a simulation, cached on it"
+        if getattr(sim, 'param_features', None) is None:
+            path = _overlay_file(sim)
+            sim.param_features = {} if path is None else \
+                _param_features(Parameters(path).load())
+
+        return sim.param_features
+
+    def __repr__(self):
+        return '<CostModel {} groups>'.format(len(self.rates))
+
+
+def _control_path(sim):
+    run_dir = sim.simulation_dir or sim.input_dir
+    path = OPJ(run_dir, 'control')
+    if not os.path.exists(path):
+        # moved after the run
+        path = OPJ(run_dir, 'inputs', 'control')
+
+    return path
+
+
+def _features(sim):
+    "Group key and number of simulated days of a simulation"
+    control = Control(_control_path(sim))
+
+    h = hashlib.sha256()
+    for name in sorted(control):
+        if name not in _IGNORED_ENTRIES:
+            h.update(json.dumps([name, control[name]]).encode('utf-8'))
+    days = (control.end_time - control.start_time).days + 1
+
+    return h.hexdigest()[:16], max(days, 1)
+
+
+def _overlay_file(sim):
+    """
+    Overlay parameter file of a simulation, the last of several parameter
+    files of its *control* file if it is next to it, else None
+    """
+    path = _control_path(sim)
+    names = Control(path)['param_file']
+    if len(names) < 2 or os.path.isabs(names[-1]):
+        return None
+    name = OPJ(os.path.dirname(path), names[-1])
+
+    return name if os.path.isfile(name) else None
+
+
+def _param_features(arrays):
+    "Mean value of each numeric parameter array, to compare simulations"
+    return dict(
+        (name, float(arr.mean())) for name, arr in arrays.items()
+        if arr.dtype.kind in 'iuf' and arr.size
+    )
+
+
+def _nearest_rate(runs, params, neighbors):
+    """
+    Inverse distance weighted rate of the runs with the most similar
+    parameter means, None if no parameter differs between them
+    """
+    names = set(params)
+    for run in runs:
+        names &= set(run['params'])
+
+    scales = {}
+    for name in names:
+        values = [run['params'][name] for run in runs] + [params[name]]
+        if max(values) > min(values):
+            scales[name] = max(values) - min(values)
+    if not scales:
+        return None
+
+    dists = [
+        math.sqrt(sum(
+            ((run['params'][name] - params[name]) / scale) ** 2
+            for name, scale in scales.items()
+        ))
+        for run in runs
+    ]
+    nearest = sorted(range(len(runs)), key=lambda idx: dists[idx])
+    weights = [(1.0 / (dists[idx] + 1e-6), runs[idx]['rate'])
+               for idx in nearest[:neighbors]]
+
+    return sum(w * rate for w, rate in weights) / sum(w for w, _ in weights)
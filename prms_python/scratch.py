@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''
+scratch.py -- holds ``ScratchSpace``, a bounded scratch area, e.g. on a RAM
+disk, where simulations run before the outputs worth keeping are copied to
+their ``simulation_dir``.
+'''
+
+import errno
+import fnmatch
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+OPJ = os.path.join
+
+
+class ScratchSpace(object):
+    '''
+    Scratch directory where PRMS runs instead of in ``simulation_dir``.
+
+    Each simulation run with ``scratch=ScratchSpace(...)`` gets a slot
+    directory under ``root`` with links to its input files, so PRMS reads
+    the inputs where they are and writes all of its outputs to the scratch
+    file system. After the run only the outputs matching one of the
+    ``keep`` patterns are copied to ``simulation_dir/outputs`` and the slot
+    is removed. The inputs stay in ``simulation_dir/inputs`` for
+    provenance as without scratch space.
+
+    At most ``max_sims`` simulations are staged at once by all processes
+    and threads using the same ``root``, and no simulation is staged while
+    less than ``min_free`` bytes are free on its file system, so many
+    concurrent simulations cannot fill up a RAM disk. Slots of processes
+    that died are reclaimed.
+
+    Keyword Arguments:
+        root (str or None): scratch directory, created if needed. Default
+            *prms_python_scratch* in */dev/shm* if it exists, otherwise in
+            the temporary directory of :mod:`tempfile`.
+        max_sims (int or None): maximum number of simulations staged at
+            once, default the number of processors
+        min_free (int): bytes that must be free on the file system of
+            ``root`` before a simulation is staged. Default 0.
+        keep (tuple): :mod:`fnmatch` patterns of the outputs copied to
+            ``simulation_dir``. Default ('statvar.dat', 'prms.out').
+        poll (float): seconds between checks for a free slot
+
+    Example:
+        Run a Monte Carlo stage on a RAM disk keeping only the statvar
+        files,
+
+        >>> scratch = ScratchSpace('/dev/shm/calib', max_sims=16,
+                                   min_free=2**30, keep=('statvar.dat',))
+        >>> optr.monte_carlo(measured, names, 'basin_cfs_1',
+                             scratch=scratch)
+    '''
+
+    def __init__(self, root=None, max_sims=None, min_free=0,
+                 keep=('statvar.dat', 'prms.out'), poll=0.1):
+        if root is None:
+            base = '/dev/shm' if os.path.isdir('/dev/shm') \
+                else tempfile.gettempdir()
+            root = OPJ(base, 'prms_python_scratch')
+        self.root = os.path.abspath(root)
+        self.max_sims = max_sims or mp.cpu_count()
+        self.min_free = min_free
+        self.keep = tuple(keep)
+        self.poll = poll
+
+    def stage(self, run_dir):
+        '''
+        Wait for a free slot and link the files of ``run_dir`` into it.
+
+        Arguments:
+            run_dir (str): directory with the PRMS inputs of a simulation
+
+        Returns:
+            str: absolute path of the directory to run PRMS in
+        '''
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        slot = self._acquire()
+        stage_dir = OPJ(slot, 'run')
+        os.mkdir(stage_dir)
+        run_dir = os.path.abspath(run_dir)
+        for name in os.listdir(run_dir):
+            _link(OPJ(run_dir, name), OPJ(stage_dir, name))
+
+        return stage_dir
+
+    def collect(self, stage_dir, outputs_dir):
+        '''
+        Copy the outputs in ``stage_dir`` that match ``keep`` to
+        ``outputs_dir``.
+
+        Returns:
+            :obj:`list`: names of the copied outputs
+        '''
+        kept = []
+        for name in sorted(os.listdir(stage_dir)):
+            path = OPJ(stage_dir, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            if any(fnmatch.fnmatch(name, pat) for pat in self.keep):
+                shutil.copy2(path, OPJ(outputs_dir, name))
+                kept.append(name)
+
+        return kept
+
+    def release(self, stage_dir):
+        '''
+        Remove a directory returned by :meth:`ScratchSpace.stage` and free
+        its slot.
+        '''
+        _remove_slot(os.path.dirname(stage_dir))
+
+    def free_bytes(self):
+        "int or None: bytes free on the file system of ``root``"
+        if not hasattr(os, 'statvfs'):
+            return None
+        st = os.statvfs(self.root)
+
+        return st.f_bavail * st.f_frsize
+
+    def _acquire(self):
+        "Create and return a free slot directory, waiting for one if needed"
+        while True:
+            free = self.free_bytes()
+            if not self.min_free or free is None or free >= self.min_free:
+                for idx in range(self.max_sims):
+                    slot = OPJ(self.root, 'slot-{}'.format(idx))
+                    try:
+                        os.mkdir(slot)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                        _reclaim_if_stale(slot)
+                        continue
+                    with open(OPJ(slot, 'owner'), 'w') as f:
+                        f.write(str(os.getpid()))
+                    return slot
+            time.sleep(self.poll)
+
+    def __repr__(self):
+        return '<ScratchSpace {} max_sims={}>'.format(
+            self.root, self.max_sims
+        )
+
+
+def _link(src, dst):
+    "Symbolic link dst to src, or a copy where links are not available"
+    if hasattr(os, 'symlink'):
+        try:
+            os.symlink(src, dst)
+            return
+        except OSError:
+            pass # e.g. no privilege to create links on Windows
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def _remove_slot(slot):
+    "Remove a slot directory, renamed first so its index is free at once"
+    trash = '{}.removed-{}'.format(slot, uuid.uuid4().hex)
+    try:
+        os.rename(slot, trash)
+    except OSError:
+        return
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+def _reclaim_if_stale(slot):
+    "Remove slot if the process that staged it is no longer running"
+    if os.name == 'nt':
+        return
+    try:
+        with open(OPJ(slot, 'owner')) as f:
+            pid = int(f.read())
+    except (IOError, OSError, ValueError):
+        return # being created or removed
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            _remove_slot(slot)
@@ -10,7 +10,10 @@ import re
 from datetime import datetime
 from matplotlib.backends.backend_pdf import PdfPages
 
+from ..cache import ResultCache
+from ..jobqueue import JobQueue
 from ..scenario import ScenarioSeries
+from ..scratch import ScratchSpace
 from ..util import load_data, load_statvar, nash_sutcliffe
 
 
@@ -125,6 +128,39 @@ def param_scale_sim(base_data_dir,
         print('\n** Sorry, analyze_output has not yet been implemented! **\n')
 
 
+@prmspy.command()
+@click.argument('queue_dir', nargs=1)
+@click.option('--prms-exec', '-e', default=None,
+              help='PRMS executable to be used on this host, default the '
+                   'one the simulations were submitted with')
+@click.option('--nproc', '-n', default=1, type=int,
+              help='number of simulations to run at once')
+@click.option('--cache', default=None, type=str,
+              help='result cache directory to use on this host')
+@click.option('--scratch', default=None, type=str,
+              help='scratch directory, e.g. on a RAM disk, to run PRMS in '
+                   'on this host')
+@click.option('--max-jobs', default=None, type=int,
+              help='stop after running this many simulations')
+@click.option('--idle-timeout', default=None, type=float,
+              help='stop after this many seconds without pending '
+                   'simulations, 0 stops when the queue is empty; default '
+                   'wait for simulations until killed')
+def worker(queue_dir, prms_exec, nproc, cache, scratch, max_jobs,
+           idle_timeout):
+    'Run simulations submitted to the job queue in <queue_dir>'
+    queue = JobQueue(queue_dir)
+    n_jobs = queue.work(
+        prms_exec=prms_exec, nproc=nproc,
+        cache=None if cache is None else ResultCache(cache),
+        scratch=None if scratch is None else ScratchSpace(
+            scratch, max_sims=nproc
+        ),
+        max_jobs=max_jobs, idle_timeout=idle_timeout
+    )
+    click.echo('ran {} simulations from {}'.format(n_jobs, queue.root))
+
+
 @prmspy.command()
 @click.argument('data_dir', nargs=1)
 @click.argument('output_pdf_path', nargs=1)
@@ -141,7 +177,8 @@ def nash_sutcliffe_matrix(data_dir, output_pdf_path):
     modeled_flows = {
 
         title: load_statvar(
-            os.path.join(data_dir, uu, 'outputs', 'statvar.dat')
+            os.path.join(data_dir, uu, 'outputs', 'statvar.dat'),
+            'basin_cfs_1'
         ).basin_cfs_1
 
         for uu, title in series_metadata['uuid_title_map'].items()
@@ -5,19 +5,58 @@ associated functions for managing PRMS simulations at a low level.
 """
 
 from __future__ import print_function
+import collections
+import errno
+import functools
 import glob
+import json
 import multiprocessing as mp
 import os
+import shlex
 import shutil
+import signal
 import subprocess
+import sys
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
+from .control import Control
 from .data import Data
 from .parameters import Parameters
-from .util import load_statvar
+from .schedule import _param_features
+from .pool import WorkerPool
+from .util import (
+    cache_statvar as _cache_statvar, find_output, load_statvar
+)
 
 OPJ = os.path.join
 
+# lines of PRMS standard error kept in simulation result records
+STDERR_TAIL_LINES = 20
+
+# name of the file with the result record in each simulation directory
+RESOURCES_FILE = 'resources.json'
+
+# resource usage of PRMS over all attempts of a run in result records
+_USAGE_KEYS = ('user_time', 'system_time', 'max_rss')
+
+# resource usage of a run whose outputs were taken from a ResultCache
+_CACHED_USAGE = {'user_time': 0.0, 'system_time': 0.0, 'max_rss': 0}
+
+# ru_maxrss is in bytes on macOS and kilobytes elsewhere
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# start PRMS in its own process group so a timeout kills all its processes
+if os.name == 'nt':
+    _NEW_PROCESS_GROUP = {
+        'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP
+    }
+elif sys.version_info[0] >= 3:
+    _NEW_PROCESS_GROUP = {'start_new_session': True}
+else:
+    _NEW_PROCESS_GROUP = {'preexec_fn': os.setsid}
+
 class SimulationSeries(object):
     '''
     Series of simulations all to be run through a common interface. 
@@ -32,8 +71,28 @@ class SimulationSeries(object):
     creating new programatic workflows not provided yet by PRMS-Python.
 
     Arguments:
-        simulations (list or tuple): list of :class:`Simulation` objects
-            to be run.
+        simulations (iterable): :class:`Simulation` objects to be run, or
+            functions without arguments that build and return one, e.g.
+            ``functools.partial(Simulation.from_data, ...)``, so several
+            can be built at once, see ``build_nproc``
+
+    Keyword Arguments:
+        retention (:class:`Retention` or None): if given, the output
+            retention policy of all simulations, see :class:`Simulation`
+        lookahead (int or None): if given ``simulations`` is consumed
+            lazily while the series runs and at most ``lookahead``
+            simulations are built and not yet finished at any time, so the
+            first simulations run while later ones are built and the disk
+            space of inputs waiting to run is bounded. Applies to the
+            'process' and 'thread' backends, the others and ``costs``, see
+            :meth:`SimulationSeries.run`, build all simulations first.
+            Default None builds all simulations right away.
+        build_nproc (int): number of simulations built at once from
+            threads when ``simulations`` yields functions that build them.
+            Default 1.
+
+    Raises:
+        ValueError: if ``lookahead`` is less than 1
 
     Example:
         Lets say you have already created a series of PRMS models by modifying
@@ -83,18 +142,91 @@ class SimulationSeries(object):
         
     '''
 
-    def __init__(self, simulations):
-        self.series = list(simulations)
-
-    def run(self, prms_exec='prms', nproc=None):
+    def __init__(self, simulations, retention=None, lookahead=None,
+                 build_nproc=1):
+        if lookahead is not None and lookahead < 1:
+            raise ValueError('lookahead must be at least 1')
+        self.retention = retention
+        self.lookahead = lookahead
+        self.build_nproc = build_nproc
+        self.series = []
+        # number of simulations if known without consuming them
+        try:
+            self._length = len(simulations)
+        except TypeError:
+            self._length = None
+        # simulations not built yet
+        self._pending = iter(simulations)
+        if lookahead is None:
+            self._build_all()
+        self.results = []
+        self.elapsed = None
+        self.nproc = None
+
+    def run(self, prms_exec='prms', nproc=None, cache_statvar=False,
+            backend='process', chunksize=1, timeout=None, retries=0,
+            pool=None, scratch=None, cache=None, queue=None, costs=None):
         """
         Method to run multiple :class:`Simulation` objects in parrallel.
 
+        Simulations are handed to the workers as they become free and
+        collected in order of completion, see
+        :meth:`SimulationSeries.iter_run`. The result record of each
+        simulation is stored in the ``results`` attribute in the order of
+        the series.
+
         Keyword Arguments:
             prms_exec (str): name of PRMS executable on $PATH or path to 
                 executable
             nproc (int or None): number of logical or physical processors
                 for parrallel execution of PRMS simulations.  
+            cache_statvar (bool or numpy.dtype): if True or a float data
+                type convert the *statvar.dat* output of each simulation to
+                a binary copy in parallel after running it, see
+                :meth:`Simulation.run`
+            backend (str): 'process' to run the simulations from a
+                :class:`multiprocessing.Pool`, 'thread' to run them from a
+                thread pool in this process or 'asyncio' to run them as
+                :mod:`asyncio` subprocesses from one event loop, see
+                :meth:`SimulationSeries.run_async`. PRMS always runs in its
+                own process, the thread and asyncio backends avoid starting
+                Python workers and pickling the simulations. Default
+                'process'.
+            chunksize (int): number of simulations sent to a worker at
+                once by the process and thread backends, larger chunks
+                reduce overhead for many short simulations, 1 (default)
+                balances simulations of uneven length best. Limited to the
+                ``lookahead`` of a series built while it runs.
+            timeout (float or None): wall-clock seconds after which a PRMS
+                run is killed, see :meth:`Simulation.run`
+            retries (int): number of times a failed PRMS run is repeated,
+                see :meth:`Simulation.run`
+            pool (:class:`WorkerPool` or None): run the simulations in
+                these persistent workers instead of starting a new pool,
+                ``nproc`` and ``backend`` are then ignored and the pool is
+                left open for further series
+            scratch (:class:`ScratchSpace` or None): run PRMS in this
+                bounded scratch space, e.g. on a RAM disk, and keep only
+                some outputs, see :meth:`Simulation.run`
+            cache (:class:`ResultCache` or None): reuse the outputs of
+                earlier runs with the same inputs, see
+                :meth:`Simulation.run`
+            queue (:class:`JobQueue` or None): submit the simulations to
+                this job queue and wait for workers on any host sharing it
+                to run them, see ``prmspy worker``. ``nproc``, ``backend``
+                and ``pool`` are then ignored.
+            costs (:class:`CostModel`, list or None): expected cost of each
+                simulation, a list of numbers in the order of the series or
+                a ``CostModel`` that predicts them and learns from this
+                run. Simulations are started longest first so a few slow
+                ones do not run alone at the end of the series. Default
+                None starts them in order.
+
+        Failed simulations do not stop the series, check the
+        ``returncode`` of their result records.
+
+        Returns:
+            :class:`SimulationSeries`: this instance
 
         Example:
             see :class:`SimulationSeries`
@@ -104,21 +236,365 @@ class SimulationSeries(object):
             of the available processecors on the machine using the Python
             :mod:`multiprocessing` module. 
 
+        Raises:
+            ValueError: if ``backend`` is not 'process', 'thread' or
+                'asyncio' and no ``pool`` is given
+            RuntimeError: with ``backend='asyncio'`` if an event loop is
+                already running, e.g. in a Jupyter notebook, await
+                :meth:`SimulationSeries.run_async` there instead
         """
-        if not nproc:
-            nproc = mp.cpu_count() // 2 
+        if pool is not None:
+            nproc = pool.nproc
+        elif not nproc:
+            nproc = max(1, mp.cpu_count() // 2)
+
+        start = time.time()
+        if queue is None and pool is None and backend == 'asyncio':
+            from .aio import run_sync
+            run_sync(self.run_async(prms_exec, nproc, cache_statvar,
+                                    timeout=timeout, retries=retries,
+                                    scratch=scratch, cache=cache,
+                                    costs=costs))
+            for sim in self.series:
+                _update_costs(costs, sim)
+            _save_costs(costs)
+        else:
+            for _ in self.iter_run(prms_exec, nproc, cache_statvar, backend,
+                                   chunksize, timeout, retries, pool,
+                                   scratch, cache, queue, costs):
+                pass
+        self.elapsed = time.time() - start
+        self.nproc = nproc
 
-        pool = mp.Pool(processes=nproc)
-        pool.map(_simulation_runner, self.series)
-        pool.close() 
+        self.results = [sim.result() for sim in self.series]
 
         return self
 
+    def resource_report(self, elapsed=None, nproc=None):
+        '''
+        Aggregate resource usage of the simulations that have run, to size
+        machines and choose ``nproc``.
+
+        Keyword Arguments:
+            elapsed (float or None): wall-clock seconds the series took,
+                default the duration of the last call of
+                :meth:`SimulationSeries.run`
+            nproc (int or None): number of workers the series ran on,
+                default the ``nproc`` of the last call of ``run``
+
+        Returns:
+            :obj:`dict`: the number of simulations ``n_sims`` and failed
+                simulations ``n_failed``, ``nproc``, ``elapsed``, the
+                throughput ``sims_per_hour``, the ``mean_wall_time`` and
+                ``max_wall_time`` of a simulation, the total ``user_time``
+                and ``system_time`` of PRMS, ``core_utilization``, the
+                fraction of the ``nproc`` cores busy with PRMS, the largest
+                peak resident set size of a simulation ``max_rss`` in bytes
+                and the total ``bytes_written``. Values that are not
+                available, see :meth:`Simulation.run`, are None.
+
+        Example:
+            >>> series.run(nproc=8).resource_report()['core_utilization']
+                0.93
+        '''
+        return _resource_report(
+            [sim.result() for sim in self.series if sim.has_run],
+            elapsed=elapsed or self.elapsed, nproc=nproc or self.nproc or 1
+        )
+
+    def iter_run(self, prms_exec='prms', nproc=None, cache_statvar=False,
+                 backend='process', chunksize=1, timeout=None, retries=0,
+                 pool=None, scratch=None, cache=None, queue=None,
+                 costs=None):
+        """
+        Run all simulations like :meth:`SimulationSeries.run` and yield a
+        result record for each simulation as soon as it has finished, in
+        order of completion. Stopping the iteration early stops the
+        workers, simulations that have not started are not run. A shared
+        ``pool`` is not stopped, simulations already queued in it still
+        run, jobs of a ``queue`` that no worker has claimed are removed.
+
+        Keyword Arguments:
+            see :meth:`SimulationSeries.run`
+
+        Yields:
+            :obj:`dict`: result record of a finished simulation with the
+                ``simulation_dir``, the PRMS exit status ``returncode``,
+                the ``wall_time`` in seconds, resource usage, ``timed_out``,
+                the number of ``attempts`` and the last lines of PRMS
+                standard error, ``stderr``, see :meth:`Simulation.result`
+
+        Example:
+            >>> for rec in series.iter_run(nproc=8):
+                    if rec['returncode'] != 0:
+                        print(rec['simulation_dir'], rec['stderr'])
+
+        Raises:
+            ValueError: if ``backend`` is not 'process', 'thread' or
+                'asyncio' and no ``pool`` is given
+        """
+        if not nproc:
+            nproc = max(1, mp.cpu_count() // 2)
+
+        lazy = self._pending is not None and costs is None and \
+            queue is None and (pool is not None or backend != 'asyncio')
+        if not lazy:
+            self._build_all()
+        order = _dispatch_order(self.series, costs)
+        if queue is not None:
+            records = self._iter_queue(queue, order, prms_exec,
+                                       cache_statvar, timeout, retries,
+                                       scratch, cache)
+        elif pool is None and backend == 'asyncio':
+            from .aio import iter_sync
+            index = dict((id(sim), idx) for idx, sim in enumerate(self.series))
+            records = (
+                (index[id(sim)], sim.result())
+                for sim in iter_sync(self.iter_async(
+                    prms_exec, nproc, cache_statvar, timeout=timeout,
+                    retries=retries, scratch=scratch, cache=cache,
+                    costs=costs
+                ))
+            )
+        elif pool is None and backend not in ('process', 'thread'):
+            raise ValueError('backend must be process, thread or asyncio')
+        elif lazy:
+            records = self._iter_pool(pool, None, nproc, backend, chunksize,
+                                      prms_exec, cache_statvar, timeout,
+                                      retries, scratch, cache)
+        else:
+            records = self._iter_pool(pool, order, nproc, backend, chunksize,
+                                      prms_exec, cache_statvar, timeout,
+                                      retries, scratch, cache)
+
+        try:
+            for idx, record in records:
+                _update_costs(costs, self.series[idx])
+                yield record
+        finally:
+            # stops the workers right away if the iteration stopped early
+            records.close()
+        _save_costs(costs)
+
+    def _iter_pool(self, pool, order, nproc, backend, chunksize, prms_exec,
+                   cache_statvar, timeout, retries, scratch, cache):
+        '''
+        Run the simulations in order in a WorkerPool and yield their index
+        and result record, order None builds and runs the simulations not
+        built yet with at most lookahead of them in flight.
+        '''
+        runner = functools.partial(
+            _simulation_runner, prms_exec=prms_exec,
+            cache_statvar=cache_statvar, timeout=timeout, retries=retries,
+            scratch=scratch, cache=cache
+        )
+        if order is None:
+            # the pool collects a whole chunk before it starts it, larger
+            # chunks than the slots for built simulations never fill up
+            chunksize = min(chunksize, self.lookahead)
+            slots = threading.Semaphore(self.lookahead)
+            stop = threading.Event()
+            errors = []
+            items = self._build_ahead(slots, stop, errors)
+        else:
+            slots = None
+            items = ((idx, self.series[idx]) for idx in order)
+        own_pool = pool is None
+        if own_pool:
+            pool = WorkerPool(nproc, backend)
+        completed = False
+        try:
+            for idx, record in pool.imap_unordered(runner, items, chunksize):
+                # simulations run in worker processes are copies
+                self.series[idx]._update(record)
+                if slots is not None:
+                    slots.release()
+                yield idx, record
+            completed = True
+        finally:
+            if slots is not None:
+                # the pool iterates items in a thread that may wait for a slot
+                stop.set()
+                slots.release()
+            if own_pool and completed:
+                pool.close()
+            elif own_pool:
+                pool.terminate()
+        if slots is not None and errors:
+            raise errors[0]
+
+    def _build_ahead(self, slots, stop, errors):
+        '''
+        Build the simulations not built yet in order, build_nproc at once,
+        and yield them with their index as soon as a slot is free. Errors
+        of builds end the iteration and are appended to errors.
+        '''
+        build_pool = ThreadPool(self.build_nproc) \
+            if self.build_nproc > 1 else None
+        building = collections.deque()
+        exhausted = False
+        try:
+            while True:
+                # start builds while slots are free, wait for one if none is
+                # being built
+                while not exhausted:
+                    if building and not slots.acquire(False):
+                        break
+                    elif not building:
+                        slots.acquire()
+                    if stop.is_set():
+                        return
+                    try:
+                        item = next(self._pending)
+                    except StopIteration:
+                        exhausted = True
+                        self._pending = None
+                        slots.release()
+                        break
+                    if build_pool is None:
+                        building.append(_Built(self._build(item)))
+                    else:
+                        building.append(
+                            build_pool.apply_async(self._build, (item,))
+                        )
+                if not building:
+                    return
+                sim = building.popleft().get()
+                self.series.append(sim)
+                yield len(self.series) - 1, sim
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if build_pool is not None:
+                build_pool.close()
+
+    def _build(self, item):
+        "Build a simulation from an item of the simulations iterable"
+        sim = item() if callable(item) else item
+        if self.retention is not None:
+            sim.retention = self.retention
+
+        return sim
+
+    def _build_all(self):
+        "Build all simulations not built yet, build_nproc at once"
+        if self._pending is None:
+            return
+        if self.build_nproc > 1:
+            build_pool = ThreadPool(self.build_nproc)
+            try:
+                self.series.extend(build_pool.map(self._build,
+                                                  list(self._pending)))
+            finally:
+                build_pool.close()
+        else:
+            self.series.extend(self._build(item) for item in self._pending)
+        self._pending = None
+
+    def _iter_queue(self, queue, order, prms_exec, cache_statvar, timeout,
+                    retries, scratch, cache):
+        '''
+        Submit the simulations in order to a JobQueue and yield their index
+        and result record.
+        '''
+        job_ids = queue.submit([self.series[idx] for idx in order], prms_exec,
+                               cache_statvar, timeout, retries, scratch, cache)
+        index = dict(zip(job_ids, order))
+        completed = False
+        try:
+            for job_id, record in queue.iter_results(job_ids):
+                sim = self.series[index[job_id]]
+                sim._update(record)
+                yield index[job_id], sim.result()
+            completed = True
+        finally:
+            if not completed:
+                queue.cancel(job_ids)
+
+    def run_async(self, prms_exec='prms', nproc=None, cache_statvar=False,
+                  timeout=None, retries=0, scratch=None, cache=None,
+                  costs=None):
+        """
+        Coroutine that runs all simulations as :mod:`asyncio` subprocesses
+        with at most ``nproc`` PRMS processes at once. Await it from a
+        running event loop, e.g. in a Jupyter notebook; cancelling the
+        awaiting task kills the outstanding PRMS processes. Requires
+        Python 3.7 or later.
+
+        Keyword Arguments:
+            prms_exec (str): name of PRMS executable on $PATH or path to
+                executable
+            nproc (int or None): maximum number of PRMS processes running
+                at once, default half of the available processors
+            cache_statvar (bool or numpy.dtype): see
+                :meth:`SimulationSeries.run`
+            timeout (float or None): see :meth:`Simulation.run`
+            retries (int): see :meth:`Simulation.run`
+            scratch (:class:`ScratchSpace` or None): see
+                :meth:`Simulation.run`
+            cache (:class:`ResultCache` or None): see :meth:`Simulation.run`
+            costs (:class:`CostModel`, list or None): expected costs to
+                start the simulations longest first, see
+                :meth:`SimulationSeries.run`. A ``CostModel`` does not
+                learn from these runs, call its ``update`` method.
+
+        Returns:
+            coroutine that returns the list of simulations in the order
+                they were started when awaited
+
+        Example:
+            >>> series = SimulationSeries(simulations)
+            >>> await series.run_async(nproc=8)
+        """
+        from .aio import run_all, run_simulation
+
+        self._build_all()
+        return run_all(
+            run_simulation,
+            [self.series[idx] for idx in _dispatch_order(self.series, costs)],
+            nproc=nproc, prms_exec=prms_exec,
+            cache_statvar=cache_statvar, timeout=timeout, retries=retries,
+            scratch=scratch, cache=cache
+        )
+
+    def iter_async(self, prms_exec='prms', nproc=None, cache_statvar=False,
+                   timeout=None, retries=0, scratch=None, cache=None,
+                   costs=None):
+        """
+        Asynchronous iterator that runs all simulations like
+        :meth:`SimulationSeries.run_async` and yields each
+        :class:`Simulation` as soon as it has finished, so results can be
+        processed while other simulations are still running. Closing the
+        iterator early kills the outstanding PRMS processes.
+
+        Keyword Arguments:
+            see :meth:`SimulationSeries.run_async`
+
+        Returns:
+            asynchronous generator of finished :class:`Simulation` objects
+
+        Example:
+            >>> async for sim in series.iter_async(nproc=8):
+                    print(sim.simulation_dir, sim.returncode)
+        """
+        from .aio import as_completed, run_simulation
+
+        self._build_all()
+        return as_completed(
+            run_simulation,
+            [self.series[idx] for idx in _dispatch_order(self.series, costs)],
+            nproc=nproc, prms_exec=prms_exec,
+            cache_statvar=cache_statvar, timeout=timeout, retries=retries,
+            scratch=scratch, cache=cache
+        )
+
     def outputs_iter(self):
         '''
         Return a :class:`generator` of directories with the path to the 
         ``simulation_dir`` as well as paths to the *statvar.dat* output 
         file, and *data* and *parameters* input files used in the simulation.
+        Only simulations built so far are included, all of them once the
+        series has run.
 
         Yields:
             :obj:`dict`: dictionary of paths to simulation directory,
@@ -140,7 +616,6 @@ class SimulationSeries(object):
                  }
         '''
         dirs = list(s.simulation_dir for s in self.series)
-        print(dirs)
 
         return (
             {
@@ -153,11 +628,273 @@ class SimulationSeries(object):
         )        
 
     def __len__(self):
-        return len(list(self.outputs_iter()))
+        if self._pending is None:
+            return len(self.series)
+        if self._length is None:
+            # count the items of an iterator, functions that build
+            # simulations are not called
+            items = list(self._pending)
+            self._length = len(self.series) + len(items)
+            self._pending = iter(items)
+
+        return self._length
+
+
+def _simulation_runner(indexed_sim, prms_exec='prms', cache_statvar=False,
+                       timeout=None, retries=0, scratch=None, cache=None):
+    idx, sim = indexed_sim
+    sim.run(prms_exec=prms_exec, cache_statvar=cache_statvar,
+            timeout=timeout, retries=retries, scratch=scratch, cache=cache)
 
+    return idx, sim.result()
 
-def _simulation_runner(sim):
-    sim.run(prms_exec='prms')
+
+class _Built(object):
+    "A simulation built right away, like the AsyncResult of a build"
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def get(self):
+        return self.sim
+
+
+def _dispatch_order(simulations, costs):
+    "Indices of simulations by decreasing expected cost, stable for ties"
+    if costs is None:
+        return list(range(len(simulations)))
+    if hasattr(costs, 'predict'):
+        costs = [costs.predict(sim) for sim in simulations]
+    elif len(costs) != len(simulations):
+        raise ValueError('costs must have one value per simulation')
+
+    return sorted(range(len(simulations)), key=lambda idx: -costs[idx])
+
+
+def _overlay_param_files(control, base_file):
+    """
+    *param_file* entry of a control file for an overlay *parameters* file
+    written next to it: the parameter files of ``control`` as absolute
+    paths, relative paths are relative to the directory of the control
+    file, with ``base_file`` first if it is not among them, then the
+    overlay file
+    """
+    control_dir = os.path.dirname(os.path.abspath(control.base_file))
+    param_files = [
+        os.path.abspath(OPJ(control_dir, name))
+        for name in control['param_file']
+    ]
+    base_file = os.path.abspath(base_file)
+    if base_file not in param_files:
+        param_files.insert(0, base_file)
+
+    return param_files + ['parameters']
+
+
+def _update_costs(costs, sim):
+    "Let a CostModel learn from a simulation that has run"
+    if hasattr(costs, 'update'):
+        costs.update(sim)
+
+
+def _save_costs(costs):
+    if hasattr(costs, 'save') and costs.path is not None:
+        costs.save()
+
+
+def _run_prms(argv, run_dir, timeout=None):
+    """
+    Run PRMS once in run_dir in a new process group and return its exit
+    status, standard error, whether it was killed after timeout seconds
+    and its resource usage, see _wait.
+    A PRMS that cannot be started gives exit status 127 like a shell.
+    """
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            p = subprocess.Popen(
+                argv, cwd=run_dir, stdout=devnull, stderr=subprocess.PIPE,
+                **_NEW_PROCESS_GROUP
+            )
+    except OSError as e:
+        return 127, str(e).encode('utf-8'), False, _no_usage()
+
+    expired = []
+    if timeout is not None:
+        def _expire():
+            expired.append(True)
+            _kill_process_group(p)
+        timer = threading.Timer(timeout, _expire)
+        timer.start()
+    try:
+        # stdout goes to devnull so reading only stderr cannot deadlock
+        stderr = p.stderr.read()
+        p.stderr.close()
+        returncode, usage = _wait(p)
+    finally:
+        if timeout is not None:
+            timer.cancel()
+
+    if expired:
+        stderr += _timeout_message(timeout)
+
+    return returncode, stderr, bool(expired), usage
+
+
+def _wait(proc):
+    """
+    Wait for proc and return its exit status and a dict with the user and
+    system CPU seconds and peak resident set size in bytes of it and the
+    children it waited for, from os.wait4 so runs in other threads are not
+    counted. The usage values are None where os.wait4 is not available.
+    """
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), _no_usage()
+
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    return proc.returncode, {
+        'user_time': rusage.ru_utime,
+        'system_time': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss * _MAXRSS_UNIT
+    }
+
+
+def _no_usage():
+    return dict.fromkeys(_USAGE_KEYS)
+
+
+def _add_usage(total, usage):
+    "Resource usage of two PRMS runs, times are added, the peak RSS is kept"
+    if total is None:
+        return dict(usage)
+    ret = {}
+    for key in _USAGE_KEYS:
+        if total[key] is None or usage[key] is None:
+            ret[key] = None
+        elif key == 'max_rss':
+            ret[key] = max(total[key], usage[key])
+        else:
+            ret[key] = total[key] + usage[key]
+
+    return ret
+
+
+def _store_outputs(cache, key, run_dir, before, wall_time, link=None):
+    "Add the files PRMS wrote to run_dir since before to a ResultCache"
+    files = [os.path.relpath(path, run_dir)
+             for path in _changed_files(run_dir, before)]
+    cache.store(key, run_dir, files, wall_time, link)
+
+
+def _file_stats(directory):
+    "Size and modification time of all files under directory by path"
+    stats = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = OPJ(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (st.st_size, st.st_mtime)
+
+    return stats
+
+
+def _changed_files(directory, before):
+    "Paths and sizes of the files under directory created or changed since"
+    return dict(
+        (path, stat[0]) for path, stat in _file_stats(directory).items()
+        if before.get(path) != stat
+    )
+
+
+def _bytes_written(directory, before):
+    "Total size of the files under directory created or changed since before"
+    return sum(_changed_files(directory, before).values())
+
+
+def _resource_report(records, elapsed=None, nproc=1):
+    """
+    Aggregate the resource usage in result records of runs that took
+    elapsed seconds on nproc workers, see SimulationSeries.resource_report.
+    """
+    records = [r for r in records if r['returncode'] is not None]
+    n = len(records)
+
+    def _total(key):
+        values = [r.get(key) for r in records]
+        if n == 0 or any(v is None for v in values):
+            return None
+        return sum(values)
+
+    user, system = _total('user_time'), _total('system_time')
+    cpu = None if user is None else user + system
+    rss = [r.get('max_rss') for r in records]
+    wall = [r['wall_time'] for r in records]
+
+    report = {
+        'n_sims': n,
+        'n_failed': sum(1 for r in records if r['returncode'] != 0),
+        'nproc': nproc,
+        'elapsed': elapsed,
+        'sims_per_hour': None,
+        'mean_wall_time': sum(wall) / n if n else None,
+        'max_wall_time': max(wall) if n else None,
+        'user_time': user,
+        'system_time': system,
+        'core_utilization': None,
+        'max_rss': None if not n or None in rss else max(rss),
+        'bytes_written': _total('bytes_written')
+    }
+    if elapsed:
+        report['sims_per_hour'] = n * 3600.0 / elapsed
+        if cpu is not None and nproc:
+            report['core_utilization'] = cpu / (elapsed * nproc)
+
+    return report
+
+
+def _kill_process_group(proc):
+    "Kill a process started with _NEW_PROCESS_GROUP and its children"
+    try:
+        if os.name == 'nt':
+            proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass # already finished
+
+
+def _timeout_message(timeout):
+    return '\nPRMS killed after timeout of {} seconds\n'.format(timeout)\
+        .encode('utf-8')
+
+
+def _prms_command(prms_exec):
+    """
+    Argument vector to run prms_exec, which is an executable on $PATH, a
+    path to one or a command with arguments, e.g. 'prms -C'. Relative paths
+    are made absolute so they do not depend on the simulation directory.
+    """
+    if os.path.isfile(prms_exec):
+        argv = [prms_exec]
+    else:
+        argv = shlex.split(prms_exec, posix=(os.name != 'nt'))
+    if os.path.dirname(argv[0]):
+        argv[0] = os.path.abspath(argv[0])
+
+    return argv
 
 
 class Simulation(object):
@@ -182,6 +919,9 @@ class Simulation(object):
         input_dir (str): path to directory that contains control, parameter, 
             and data files for the simulation
         simulation_dir (str): directory path to bundle inputs and outputs
+        retention (:class:`Retention` or None): which outputs to keep and
+            how to compress them after a run, only applied with a
+            ``simulation_dir``. Default None keeps all outputs as they are.
        
     Example:
         see :func:`Simulation.run()`
@@ -191,7 +931,7 @@ class Simulation(object):
             *parameters*, and *control* file.
 
     """
-    def __init__(self, input_dir=None, simulation_dir=None):
+    def __init__(self, input_dir=None, simulation_dir=None, retention=None):
         # check if model input paths exist
         idir = input_dir
         self.input_dir = idir
@@ -234,23 +974,58 @@ class Simulation(object):
             self.data_path = None
             self.simulation_dir = None
 
+        self.retention = retention
         self.has_run = False
+        self.returncode = None
+        self.stderr = None
+        self.wall_time = None
+        self.timed_out = False
+        self.attempts = 0
+        self.usage = _no_usage()
+        self.bytes_written = None
+        self.cached = False
+        # mean of each modified parameter, see CostModel
+        self.param_features = None
 
     @classmethod
-    def from_data(cls, data, parameters, control_path, simulation_dir):
+    def from_data(cls, data, parameters, control_path, simulation_dir,
+                  overlay=False, warm_start=None, retention=None):
         '''
         Create a ``Simulation`` from a :class:`Data` and :class:`Parameter` object,
         plus a path to the *control* file, and providing a ``simulation_dir`` 
         where the simulation should be run.
 
+        With ``overlay=True`` the *parameters* file in ``simulation_dir``
+        only holds the modified parameters (see
+        :meth:`Parameters.write_overlay`) and the *param_file* entry of
+        the copied *control* file lists the absolute paths of its
+        parameter files, with the base parameter file of ``parameters``
+        first if it is not among them, followed by it. This greatly
+        reduces the size of each simulation when many simulations differ
+        in only a few parameters, e.g. with :class:`ParameterOverlay`, but
+        the base parameter file must not be moved or changed until the
+        simulation has run.
+
         Arguments:
             data (:class:`Data`): ``Data`` object for simulation
             parameters (:class:`Parameters`): ``Parameters`` object for simulation 
-            control_path (str): path to control file
+            control_path (str or :class:`Control`): path to control file or
+                ``Control`` instance to write to ``simulation_dir``
             simulation_dir (str): path to directory where simulations will be
                 run and where input and output will be stored. If it exists it will 
                 be overwritten.
 
+        Keyword Arguments:
+            overlay (bool): if True write an overlay parameter file that
+                is used on top of the base parameter file instead of a
+                full copy of the parameters. Default False.
+            warm_start (:class:`WarmStart` or None): if given the simulation
+                starts at ``warm_start.start_time`` from the model state
+                saved by a spin-up simulation instead of the start time of
+                the *control* file.
+            retention (:class:`Retention` or None): outputs to keep and
+                compress after the run, see :class:`Simulation`
+
         Returns:
             :class:`Simulation` ready to be run using ``simulation_dir`` for
                 inputs and outputs
@@ -267,6 +1042,9 @@ class Simulation(object):
         Raises:
             TypeError: if ``data`` and ``parameters`` arguments are not of type
                 :class:`Data` and :class:`Parameters`
+            ValueError: if ``parameters`` or the *control* file are not
+                compatible with the model state of ``warm_start``, see
+                :meth:`WarmStart.check`
         '''
 
         if not isinstance(data, Data):
@@ -276,25 +1054,47 @@ class Simulation(object):
             raise TypeError('parameters must be instance of Parameters, not '\
                              + str(type(parameters)))
 
+        control = control_path
+        if warm_start is not None:
+            if not isinstance(control, Control):
+                control = Control(control)
+            warm_start.check(parameters, control)
+            control = warm_start.apply(control)
+        elif overlay:
+            control = control.copy() if isinstance(control, Control) \
+                else Control(control)
+
         if os.path.exists(simulation_dir):
             shutil.rmtree(simulation_dir)
 
         os.makedirs(simulation_dir)
 
-        sim = cls()
+        sim = cls(retention=retention)
         sim.simulation_dir = simulation_dir
+        sim.param_features = _param_features(parameters._modified_arrays())
 
         sd = simulation_dir
 
         data_path = OPJ(sd, 'data')
         data.write(data_path)
         params_path = OPJ(sd, 'parameters')
-        parameters.write(params_path)
-        shutil.copy(control_path, OPJ(sd, 'control'))
+        if overlay:
+            parameters.write_overlay(params_path)
+            control['param_file'] = _overlay_param_files(
+                control, parameters.base_file
+            )
+        else:
+            parameters.write(params_path)
+
+        if isinstance(control, Control):
+            control.write(OPJ(sd, 'control'))
+        else:
+            shutil.copy(control, OPJ(sd, 'control'))
 
         return sim
 
-    def run(self, prms_exec='prms'):
+    def run(self, prms_exec='prms', cache_statvar=False, timeout=None,
+            retries=0, scratch=None, cache=None):
         """
         Run a ``Simulation`` instance using PRMS input files from ``input_dir`` 
         and copy to the ``Simulation`` file structure under ``simulation_dir`` if
@@ -308,6 +1108,23 @@ class Simulation(object):
 
         Keyword Arguments:
             prms_exec (str): name of PRMS executable on $PATH or path to executable
+            cache_statvar (bool or numpy.dtype): if True or a float data type,
+                e.g. ``numpy.float32``, convert the *statvar.dat* output to a
+                binary copy with :func:`util.cache_statvar` that
+                :func:`util.load_statvar` reads much faster. Default False.
+            timeout (float or None): wall-clock seconds after which PRMS
+                and any processes it started are killed, e.g. when it hangs
+                on bad parameters. Default None, no timeout.
+            retries (int): number of times PRMS is run again when it fails
+                or times out. Default 0.
+            scratch (:class:`ScratchSpace` or None): run PRMS in a slot of
+                this scratch space, e.g. on a RAM disk, and copy only the
+                outputs it keeps to ``simulation_dir``. Default None, run
+                PRMS in ``simulation_dir``.
+            cache (:class:`ResultCache` or None): take the outputs from
+                this cache instead of running PRMS if a run with the same
+                executable and inputs has been cached, and cache the outputs
+                of a successful run otherwise. Default None.
         
         Examples:
             If we create a :class:`Simulation` instance by only assigning the 
@@ -338,7 +1155,8 @@ class Simulation(object):
                  'control',
                  'statvar.dat',
                  'prms_ic.out',
-                 'prms.out' ]
+                 'prms.out',
+                 'resources.json']
             
             Instead if we assigned a path for ``simulation_dir`` keyword 
             argument and then called ``run``, i.e. 
@@ -354,12 +1172,31 @@ class Simulation(object):
              │   ├── control
              │   ├── data
              │   └── parameters
-             └── outputs
-                 ├── data_3deg_upshift
-                 ├── parameters_adjusted
-                 ├── prms_ic.out
-                 ├── prms.out
-                 └── statvar.dat
+             ├── outputs
+             │   ├── data_3deg_upshift
+             │   ├── parameters_adjusted
+             │   ├── prms_ic.out
+             │   ├── prms.out
+             │   └── statvar.dat
+             └── resources.json
+
+        After the run the exit status of PRMS and its standard error are
+        available as the ``returncode`` and ``stderr`` attributes. A failed
+        run does not raise, ``failed`` is True if PRMS exited with an error,
+        could not be started (``returncode`` 127) or was killed after
+        ``timeout`` (``timed_out`` is True).
+
+        The resources used by PRMS over all attempts are recorded as well:
+        the user and system CPU seconds and peak resident set size in bytes
+        of PRMS and the processes it waited for (``usage``, None on
+        platforms without :func:`os.wait4` and with the asyncio backend)
+        and the ``bytes_written`` to the simulation directory. They are
+        saved with the rest of :meth:`Simulation.result` in the file
+        *resources.json* in ``simulation_dir``, a run without
+        ``simulation_dir`` does not add it to ``input_dir``. PRMS is
+        started with the simulation directory as its working directory and
+        the working directory of the calling process is never changed, so
+        different simulations may be run from several threads at once.
 
         Note:
             As shown in the last example, currently the ``Simulation.run`` routine only
@@ -367,45 +1204,174 @@ class Simulation(object):
             all other files found in ``input_dir`` before *and* after normal completion 
             of the PRMS simulation will be transferred to ``simulation_dir/outputs/``. 
         """
-        cwd = os.getcwd()
-
-        if self.simulation_dir:
-            os.chdir(self.simulation_dir)
-
-        else:
-            os.chdir(self.input_dir)
+        argv, run_dir = self._command(prms_exec)
+
+        stage_dir = None
+        if scratch is not None:
+            stage_dir = scratch.stage(run_dir)
+        try:
+            # PRMS runs in run_dir without changing the working directory of
+            # this process, so simulations can be run from several threads
+            before = _file_stats(stage_dir or run_dir)
+            start = time.time()
+            key, link, hit = self._cache_lookup(
+                cache, argv, stage_dir or run_dir, stage_dir is not None
+            )
+            if hit:
+                self._finish_run(
+                    0, b'', time.time() - start, cache_statvar, attempts=0,
+                    usage=_CACHED_USAGE, before=before, scratch=scratch,
+                    stage_dir=stage_dir, cached=True
+                )
+                return
+
+            usage = None
+            for attempt in range(1 + retries):
+                returncode, stderr, timed_out, attempt_usage = _run_prms(
+                    argv, stage_dir or run_dir, timeout
+                )
+                usage = _add_usage(usage, attempt_usage)
+                if returncode == 0:
+                    break
+            wall_time = time.time() - start
+
+            if key is not None and returncode == 0:
+                _store_outputs(cache, key, stage_dir or run_dir, before,
+                               wall_time, link)
+
+            self._finish_run(
+                returncode, stderr, wall_time, cache_statvar,
+                timed_out=timed_out, attempts=attempt + 1, usage=usage,
+                before=before, scratch=scratch, stage_dir=stage_dir
+            )
+        finally:
+            if stage_dir is not None:
+                scratch.release(stage_dir)
+
+    @property
+    def failed(self):
+        "bool: True if the simulation has run and PRMS did not succeed"
+        return self.has_run and self.returncode != 0
+
+    def result(self):
+        '''
+        Result record of the last run of this simulation
 
-        p = subprocess.Popen(
-            prms_exec + ' control', shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+        Returns:
+            :obj:`dict`: with the ``simulation_dir`` (the ``input_dir`` if
+                the simulation has none), the PRMS exit status
+                ``returncode``, the ``wall_time`` of PRMS in seconds over
+                all ``attempts``, its CPU seconds ``user_time`` and
+                ``system_time``, its peak resident set size ``max_rss`` in
+                bytes, the ``bytes_written`` to the simulation directory,
+                whether the outputs were taken from a :class:`ResultCache`,
+                ``cached``, whether the last attempt ``timed_out`` and the
+                last lines of its standard error, ``stderr``; the values are
+                None before the simulation has run or if they are not
+                available
+        '''
+        stderr = self.stderr
+        if stderr is not None:
+            stderr = '\n'.join(stderr.splitlines()[-STDERR_TAIL_LINES:])
+
+        record = {
+            'simulation_dir': self.simulation_dir or self.input_dir,
+            'returncode': self.returncode,
+            'wall_time': self.wall_time,
+            'bytes_written': self.bytes_written,
+            'cached': self.cached,
+            'timed_out': self.timed_out,
+            'attempts': self.attempts,
+            'stderr': stderr
+        }
+        record.update(self.usage)
+
+        return record
+
+    def _update(self, record):
+        "Update the run status from a result record of a copy that ran"
+        self.has_run = True
+        self.returncode = record['returncode']
+        self.wall_time = record['wall_time']
+        self.timed_out = record['timed_out']
+        self.attempts = record['attempts']
+        self.stderr = record['stderr']
+        self.usage = dict((key, record[key]) for key in _USAGE_KEYS)
+        self.bytes_written = record['bytes_written']
+        self.cached = record['cached']
+
+    def _cache_lookup(self, cache, argv, run_dir, staged=False):
+        '''
+        Cache key of running argv in run_dir, whether outputs may be hard
+        linked to the cache and whether cached outputs were fetched into
+        run_dir; the key is None without a cache.
+        '''
+        if cache is None:
+            return None, None, False
+        # PRMS overwrites outputs in an input_dir in place when it is run
+        # again, they must not share their contents with the cache
+        link = None if self.simulation_dir or staged else False
+        key = cache.key(argv, run_dir)
 
-        prms_finished = False
-        checked_once = False
-        while not prms_finished:
+        return key, link, cache.fetch(key, run_dir, link) is not None
 
-            if not checked_once:
-                p.communicate()
-                checked_once = True
+    def _command(self, prms_exec):
+        "Argument vector and absolute directory to run PRMS in"
+        run_dir = os.path.abspath(self.simulation_dir or self.input_dir)
 
-            poll = p.poll()
-            prms_finished = poll >= 0
+        return _prms_command(prms_exec) + ['control'], run_dir
 
+    def _finish_run(self, returncode, stderr, wall_time,
+                    cache_statvar=False, timed_out=False, attempts=1,
+                    usage=None, before=None, scratch=None, stage_dir=None,
+                    cached=False):
+        '''
+        Record the exit status and resource usage, organize the files of a
+        finished run and write its result record. before are the
+        _file_stats of the directory PRMS ran in before it was started,
+        stage_dir if it ran in a slot of scratch.
+        '''
+        run_dir = os.path.abspath(self.simulation_dir or self.input_dir)
         self.has_run = True
-        # avoid too many files open error
-        p.stdout.close()
-        p.stderr.close()
+        self.returncode = returncode
+        self.wall_time = wall_time
+        self.timed_out = timed_out
+        self.attempts = attempts
+        self.stderr = stderr.decode('utf-8', 'replace')
+        self.usage = usage or _no_usage()
+        self.cached = cached
+        if before is not None:
+            self.bytes_written = _bytes_written(stage_dir or run_dir, before)
 
         if self.simulation_dir:
-            os.mkdir('inputs')
-            os.mkdir('outputs')
-            shutil.move('data', 'inputs')
-            shutil.move('parameters', 'inputs')
-            shutil.move('control', 'inputs')
+            inputs_dir = OPJ(run_dir, 'inputs')
+            outputs_dir = OPJ(run_dir, 'outputs')
+            os.mkdir(inputs_dir)
+            os.mkdir(outputs_dir)
+            for name in ('data', 'parameters', 'control'):
+                shutil.move(OPJ(run_dir, name), inputs_dir)
 
             # all remaining files are outputs
-            for g in glob.glob('*'):
+            for g in glob.glob(OPJ(run_dir, '*')):
                 if not os.path.isdir(g):
-                    shutil.move(g, 'outputs')
+                    shutil.move(g, outputs_dir)
+        else:
+            outputs_dir = run_dir
+        statvar_path = OPJ(outputs_dir, 'statvar.dat')
+
+        if stage_dir is not None:
+            scratch.collect(stage_dir, outputs_dir)
+        if self.retention is not None and self.simulation_dir:
+            self.retention.apply(outputs_dir)
+
+        if self.simulation_dir:
+            with open(OPJ(run_dir, RESOURCES_FILE), 'w') as f:
+                f.write(json.dumps(self.result(), indent=2))
+
+        if cache_statvar is not False and \
+                os.path.isfile(find_output(statvar_path)):
+            if cache_statvar is True:
+                _cache_statvar(statvar_path)
+            else:
+                _cache_statvar(statvar_path, dtype=cache_statvar)
 
-        os.chdir(cwd)
@@ -3,11 +3,20 @@
 util.py -- Utilities for working with PRMS data or other functionality that aren't
 appropriate to put elsewhere at this time.
 """
+import gzip
 import warnings
 import os, shutil, json
 import numpy as np
 import pandas as pd
 
+try:
+    import lzma
+except ImportError: # Python 2
+    lzma = None
+
+# suffixes of compressed output files, see Retention
+COMPRESSED_SUFFIXES = ('.gz', '.xz')
+
 def calc_emp_CDF(data):
     # changed function name for PEP 8 style
     warnings.warn("calc_emp_CDF is deprecated, please use "+\
@@ -19,51 +28,172 @@ def calc_emp_cdf(data):
     Create empirical CDF of arbitrary data
     
     Arguments:
-        data (array_like) : array to calculate CDF on
+        data (array_like) : array to calculate CDF on, or 2-D array with
+            one sample per row to calculate the CDF of each row at once
 
     Returns:
-        X (numpy.ndarray) : array of x values of CDF (sorted data)
+        X (numpy.ndarray) : array of x values of CDF (sorted data), sorted
+            along the last axis for a 2-D ``data``
         
         F (numpy.ndarray) : array of CDF values for each X value or cumulative 
-            exceedence probability, in [0,1].
+            exceedence probability, in [0,1]. For a 2-D ``data`` a read-only
+            array with the shape of X, the same for each row.
     """
-    n_bins = len(data)
-    X = np.sort(data)
-    F = np.array(range(n_bins))/float(n_bins)
+    X = np.sort(np.asarray(data), axis=-1)
+    n_bins = X.shape[-1]
+    F = np.arange(n_bins)/float(n_bins)
+    if X.ndim > 1:
+        F = np.broadcast_to(F, X.shape)
     return X,F
 
-def Kolmogorov_Smirnov(uncond, cond, n_bins=10000):
+def Kolmogorov_Smirnov(uncond, cond, n_bins=None):
     # changed function name for PEP 8 style
     warnings.warn("Kolmogorov_Smirnov is deprecated, please use "+\
-                  "util.komogorov_smirnov instead", DeprecationWarning)
-    return kolmogorov_smirnov(uncond, cond, n_bins=10000)
+                  "util.kolmogorov_smirnov instead", DeprecationWarning)
+    return kolmogorov_smirnov(uncond, cond, n_bins=n_bins)
 
-def kolmogorov_smirnov(uncond, cond, n_bins=10000):
+def kolmogorov_smirnov(uncond, cond, n_bins=None):
     """ 
-    Calculate the Kolmogorov-Smirnov statistic between two datasets by first 
-    computing their empirical CDFs
+    Calculate the exact two-sample Kolmogorov-Smirnov statistic between an
+    unconditional sample and one or many conditional samples
     
+    The statistic is the maximum absolute distance between the empirical
+    CDFs of the samples. Only jumps of the conditional CDF need to be
+    checked, the unconditional CDF is evaluated at all conditional values
+    at once by binary search in the sorted unconditional sample, so many
+    conditional samples, e.g. all conditioning values of a PAWN
+    sensitivity analysis, are compared in a single vectorized call.
+
     Arguments:
         uncond (array_like) : data for creating the unconditional CDF.
-        cond (array_like) : data for creating the conditional CDF
-        n_bins (int) : number of bins for both CDFs, note if n_bins > length
-            of either dataset then CDF values are interpolated by numpy
+        cond (array_like) : data for creating the conditional CDF, or a
+            2-D array with one conditional sample per row, or a list of
+            conditional samples of different sizes
+        n_bins (None) : deprecated and ignored, the statistic was
+            previously approximated with histograms of n_bins bins
         
     Returns: 
-        KS (float) : Kolmogorov-Smirnov statistic, i.e. absolute max distance
-            between uncond and cond CDFs
-    """
-    # create unconditional CDF (F_Uc)
-    H,X = np.histogram(uncond, bins=n_bins, normed=True)
-    dx = X[1] - X[0]
-    F_Uc = np.cumsum(H)*dx    
-    # create conditional CDF (F_C)
-    H,X = np.histogram(cond, bins=n_bins, normed=True)
-    dx = X[1] - X[0]
-    F_C = np.cumsum(H)*dx
-    # Calc max absolulte divergence
-    KS = np.max(np.abs(F_Uc - F_C)) 
-    return KS
+        KS (float or numpy.ndarray) : Kolmogorov-Smirnov statistic, i.e.
+            absolute max distance between uncond and cond CDFs, an array
+            with one statistic per conditional sample if ``cond`` holds
+            several samples
+
+    Example:
+        >>> uncond = np.random.uniform(size=4000)
+        >>> cond = np.random.uniform(0, 0.9, size=(20, 100))
+        >>> kolmogorov_smirnov(uncond, cond).shape
+            (20,)
+    """
+    if n_bins is not None:
+        warnings.warn("n_bins is ignored, kolmogorov_smirnov computes the "+\
+                      "exact statistic", DeprecationWarning)
+    uncond = np.sort(np.ravel(uncond))
+
+    if isinstance(cond, (list, tuple)) and len(cond) and \
+            np.ndim(cond[0]) > 0:
+        lengths = [len(c) for c in cond]
+        if len(set(lengths)) > 1:
+            # samples of different sizes, vectorize over samples of each size
+            KS = np.empty(len(cond))
+            for length in set(lengths):
+                idx = [i for i, l in enumerate(lengths) if l == length]
+                KS[idx] = _ks_sorted(
+                    uncond, np.sort([cond[i] for i in idx], axis=-1)
+                )
+            return KS
+
+    cond = np.asarray(cond)
+    if cond.ndim == 1:
+        return float(_ks_sorted(uncond, np.sort(cond)[np.newaxis])[0])
+    return _ks_sorted(uncond, np.sort(cond, axis=-1))
+
+def _ks_sorted(uncond, cond):
+    """
+    KS statistic between sorted 1-D uncond and each sorted row of cond.
+
+    Between two jumps of the conditional CDF F_c is constant and the
+    unconditional F_u monotone, so the largest distance is at a jump: F_u
+    right at a conditional value against F_c right at it, or F_u just
+    before it against F_c just before it. Ties within a row are resolved
+    to the first and last position of equal values.
+    """
+    n_rows, m = cond.shape
+    Fu_right = np.searchsorted(uncond, cond, side='right') / float(len(uncond))
+    Fu_left = np.searchsorted(uncond, cond, side='left') / float(len(uncond))
+
+    pos = np.broadcast_to(np.arange(m), cond.shape)
+    new = np.ones(cond.shape, dtype=bool)
+    new[:, 1:] = cond[:, 1:] != cond[:, :-1]
+    # count of values < x is the position of the first of equal values
+    n_left = np.maximum.accumulate(np.where(new, pos, 0), axis=1)
+    # count of values <= x is one past the position of the last of them
+    last = np.ones(cond.shape, dtype=bool)
+    last[:, :-1] = new[:, 1:]
+    n_right = np.minimum.accumulate(
+        np.where(last, pos + 1, m)[:, ::-1], axis=1
+    )[:, ::-1]
+
+    return np.maximum(
+        np.abs(Fu_right - n_right / float(m)).max(axis=1),
+        np.abs(Fu_left - n_left / float(m)).max(axis=1)
+    )
+
+def pawn_indices(uncond, cond, names=None):
+    """
+    Calculate PAWN sensitivity indices of many input factors at once
+    
+    For each input factor the Kolmogorov-Smirnov statistic between the
+    unconditional model output sample and the output sample of each
+    conditioning value of the factor is computed with
+    :func:`kolmogorov_smirnov`, the PAWN index of the factor is a summary
+    statistic of these KS values over its conditioning values, commonly
+    the median or the maximum (Pianosi and Wagener, 2015).
+
+    Arguments:
+        uncond (array_like) : model output of the unconditional
+            simulations, length Nuc
+        cond (array_like) : model output of the conditional simulations
+            with shape (M, Nc, n) for M input factors, Nc conditioning
+            values and n simulations per conditioning value, or a list of
+            M lists of Nc samples that may differ in size, e.g. when some
+            simulations failed
+    
+    Keyword Arguments:
+        names (list or None) : names of the M input factors, default 0 to
+            M - 1
+        
+    Returns: 
+        (pandas.DataFrame) : one row per input factor with the KS statistic
+            of each conditioning value in columns 0 to Nc - 1 followed by
+            the columns min, mean, median and max of these KS statistics
+
+    Example:
+        Summarise the output of the PAWN workflow notebook,
+
+        >>> result = pawn_indices(Y_uncond, Y_cond, names=['p1', 'p2', 'p3'])
+        >>> result['median']
+    """
+    if isinstance(cond, np.ndarray) and cond.ndim == 3:
+        M, Nc = cond.shape[:2]
+        KS = kolmogorov_smirnov(uncond, cond.reshape(M * Nc, -1))
+        KS = KS.reshape(M, Nc)
+    else:
+        sizes = [len(factor) for factor in cond]
+        if len(set(sizes)) > 1:
+            raise ValueError('Each factor needs the same number of '+\
+                             'conditioning values')
+        samples = [np.ravel(s) for factor in cond for s in factor]
+        KS = kolmogorov_smirnov(uncond, samples)
+        KS = np.reshape(KS, (len(cond), sizes[0]))
+
+    df = pd.DataFrame(KS, index=names)
+    df['min'] = KS.min(axis=1)
+    df['mean'] = KS.mean(axis=1)
+    df['median'] = np.median(KS, axis=1)
+    df['max'] = KS.max(axis=1)
+    df.columns.name = 'KS'
+
+    return df
 
 def remove_all_optimization_sims_of_other_stage(work_directory, stage):
     """
@@ -156,58 +286,97 @@ def delete_files(work_directory, file_name=''):
         for path in paths:
             os.remove(path)        
 
-def load_statvar(statvar_file):
+def load_statvar(statvar_file, variables=None, start=None, end=None,
+                 dtype=None):
     """
     Read the statvar file and load into a datetime indexed
     Pandas dataframe object
 
+    Only the date columns and the columns of ``variables`` are parsed
+    which is considerably faster than loading all variables when only
+    a few of many statistical variables are needed. If a binary copy of
+    the statvar file created by :func:`cache_statvar` exists and is not
+    older than the statvar file it is read through a memory map instead,
+    which is much faster again. A statvar file compressed with gzip or
+    lzma, e.g. by a :class:`Retention` policy, is read transparently,
+    either by its own path or by the path it had before it was compressed.
+
     Arguments:
         statvar_file (str): statvar file path
+
+    Keyword Arguments:
+        variables (str, list or None): name or list of names of the
+            statistical variables to load as in the returned columns,
+            i.e. variable name and element joined by an underscore like
+            'basin_cfs_1'. Default None loads all variables.
+        start (str, datetime or None): first date to load, default None
+            loads from the beginning of the file
+        end (str, datetime or None): last date to load, default None
+            loads to the end of the file
+        dtype (numpy.dtype or None): data type of the variable columns,
+            e.g. ``numpy.float32``, default None for float64 or the data
+            type of the binary copy
+
     Returns:
         (pandas.DataFrame) Pandas DataFrame of PRMS variables date indexed
             from statvar file
+
+    Raises:
+        KeyError: if any of ``variables`` is not in the statvar file
+
+    Example:
+        >>> load_statvar('statvar.dat', 'basin_cfs_1', start='1995-10-01')
     """
-    # make list of statistical output variables for df header
-    column_list = ['index',
-                   'year',
-                   'month',
-                   'day',
-                   'hh',
-                   'mm',
-                   'sec']
+    cache_file = _statvar_cache_path(statvar_file)
+    statvar_file = find_output(statvar_file)
+    if os.path.isfile(cache_file) and (
+            not os.path.isfile(statvar_file) or
+            os.path.getmtime(cache_file) >= os.path.getmtime(statvar_file)):
+        return _load_statvar_cache(cache_file, variables, start, end, dtype)
 
-    # append to header list the variables present in the file
-    with open(statvar_file, 'r') as inf:
-        for idx, l in enumerate(inf):
-            # first line is always number of stat variables
-            if idx == 0:
-                n_statvars = int(l)
-            elif idx <= n_statvars and idx != 0:
-                column_list.append(l.rstrip().replace(' ', '_'))
-            else:
-                break
+    column_list, skiprows = _statvar_header(statvar_file)
+
+    if isinstance(variables, str):
+        variables = [variables]
+
+    missing = [v for v in variables or [] if v not in column_list]
+    if missing:
+        raise KeyError(
+            'Not in {}: {}'.format(statvar_file, ', '.join(missing))
+        )
+
+    positions = _column_positions(column_list, variables)
+
+    # file columns are index, year, month, day, hh, mm, sec then variables
+    date_cols = ['year', 'month', 'day']
+    usecols = [1, 2, 3] + [i + 7 for i in positions]
+    dtypes = None if dtype is None else {col: dtype for col in usecols[3:]}
 
     # arguments for read_csv function
     missing_value = -999
-    skiprows = n_statvars+1
     df = pd.read_csv(
-        statvar_file, delim_whitespace=True, skiprows=skiprows,
-        header=-1, na_values=[missing_value]
-    )
-
-    # apply correct header names using metadata retrieved from file
-    df.columns = column_list
-    date = pd.Series(
-        pd.to_datetime(df.year*10000+df.month*100+df.day, format='%Y%m%d'),
-        index=df.index
+        statvar_file, sep=r'\s+', skiprows=skiprows, header=None,
+        usecols=usecols, dtype=dtypes, na_values=[missing_value]
     )
+    # usecols are parsed in file order and labeled by their file position
+    df = df[usecols]
+    df.columns = date_cols + [column_list[i] for i in positions]
+    # drop an incomplete last line, e.g. of an interrupted simulation
+    df = df.dropna(subset=date_cols).astype({col: int for col in date_cols})
+
+    date = df.year*10000 + df.month*100 + df.day
+    if start is not None:
+        start = pd.to_datetime(start)
+        df = df[date >= start.year*10000 + start.month*100 + start.day]
+        date = date[df.index]
+    if end is not None:
+        end = pd.to_datetime(end)
+        df = df[date <= end.year*10000 + end.month*100 + end.day]
+        date = date[df.index]
 
     # make the df index the datetime for the time series data
-    df.index = pd.to_datetime(date)
-
-    # drop unneeded columns
-    df.drop(['index', 'year', 'month', 'day', 'hh', 'mm', 'sec'],
-            axis=1, inplace=True)
+    df = df.iloc[:, len(date_cols):]
+    df.index = pd.to_datetime(date, format='%Y%m%d')
 
     # name dataframe axes (index,columns)
     df.columns.name = 'statistical_variables'
@@ -216,6 +385,197 @@ def load_statvar(statvar_file):
     return df
 
 
+def cache_statvar(statvar_file, dtype=np.float64):
+    """
+    Convert a statvar file to a compact binary columnar copy that
+    :func:`load_statvar` reads through a memory map.
+
+    The copy is written next to the statvar file with the ".npy"
+    extension appended, e.g. "statvar.dat.npy". It is a NumPy ".npy" file
+    holding a single record with a "date" field with the dates and a
+    field with the values of each statistical variable, stored one after
+    the other so that loading one variable only reads its own values.
+    Further columns of a variable listed more than once in the statvar
+    file are stored in fields named by the variable and a "#" and count,
+    e.g. "basin_cfs_1#2".
+    It is only used by :func:`load_statvar` while it is not older than
+    the statvar file.
+
+    Arguments:
+        statvar_file (str): statvar file path
+
+    Keyword Arguments:
+        dtype (numpy.dtype): data type of the stored values,
+            ``numpy.float32`` halves the size. Default ``numpy.float64``.
+
+    Returns:
+        (str): path of the binary copy
+
+    Example:
+        Convert the output of all simulations of an optimization stage
+        once before repeatedly scoring them,
+
+        >>> for sim_dir in sim_dirs:
+                cache_statvar(os.path.join(sim_dir, 'outputs', 'statvar.dat'))
+    """
+    cache_file = _statvar_cache_path(statvar_file)
+    # parse the text even if an up to date binary copy exists
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+
+    df = load_statvar(statvar_file)
+    n = len(df)
+    # structured array field names must be unique
+    fields, counts = [], {}
+    for name in df.columns:
+        counts[name] = counts.get(name, 0) + 1
+        fields.append(str(name) if counts[name] == 1 else
+                      '{}#{}'.format(name, counts[name]))
+    record = np.zeros((), dtype=[('date', 'M8[D]', (n,))] + [
+        (field, dtype, (n,)) for field in fields
+    ])
+    record['date'] = df.index.values.astype('M8[D]')
+    for i, field in enumerate(fields):
+        record[field] = df.iloc[:, i].values
+
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as outf:
+            np.save(outf, record)
+        _replace_file(tmp_file, cache_file)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+    return cache_file
+
+
+def _statvar_cache_path(statvar_file):
+    return statvar_file + '.npy'
+
+
+def _load_statvar_cache(cache_file, variables, start, end, dtype):
+    "``load_statvar`` from a memory map of a ``cache_statvar`` binary copy"
+    record = np.load(cache_file, mmap_mode='r')
+    fields = [name for name in record.dtype.names if name != 'date']
+    # repeated columns of a variable are stored as "<variable>#<count>"
+    column_list = [field.split('#')[0] for field in fields]
+
+    if isinstance(variables, str):
+        variables = [variables]
+
+    missing = [v for v in variables or [] if v not in column_list]
+    if missing:
+        raise KeyError(
+            'Not in {}: {}'.format(cache_file, ', '.join(missing))
+        )
+
+    positions = _column_positions(column_list, variables)
+
+    dates = record['date']
+    first, last = 0, len(dates)
+    if start is not None:
+        first = np.searchsorted(dates, np.datetime64(pd.to_datetime(start),
+                                                     'D'))
+    if end is not None:
+        last = np.searchsorted(dates, np.datetime64(pd.to_datetime(end),
+                                                    'D'), side='right')
+
+    # copy the selected values out of the memory map
+    df = pd.DataFrame(
+        {
+            k: np.array(record[fields[i]][first:last],
+                        dtype=dtype or record[fields[i]].dtype)
+            for k, i in enumerate(positions)
+        },
+        index=pd.DatetimeIndex(np.array(dates[first:last], dtype='M8[ns]')),
+        columns=list(range(len(positions)))
+    )
+    df.columns = [column_list[i] for i in positions]
+
+    df.columns.name = 'statistical_variables'
+    df.index.name = 'date'
+
+    return df
+
+
+def _column_positions(column_list, variables):
+    """
+    Positions of the columns of ``variables`` in ``column_list``, all of
+    them for None. A variable listed more than once in the control file
+    has several columns with the same name which are all kept.
+    """
+    if variables is None:
+        return list(range(len(column_list)))
+
+    positions, seen = [], set()
+    for v in variables:
+        for i, name in enumerate(column_list):
+            if name == v and i not in seen:
+                positions.append(i)
+                seen.add(i)
+
+    return positions
+
+
+def _statvar_header(statvar_file):
+    """
+    Names of the statistical variables in a statvar file, variable name
+    and element joined by an underscore, and the number of header lines
+    """
+    column_list = []
+    with open_output(statvar_file) as inf:
+        # first line is always number of stat variables
+        n_statvars = int(inf.readline())
+        for idx in range(n_statvars):
+            column_list.append(inf.readline().rstrip().replace(' ', '_'))
+
+    return column_list, n_statvars + 1
+
+
+def find_output(path):
+    """
+    Path of a PRMS output or input file that may have been compressed.
+
+    Arguments:
+        path (str): file path as written by PRMS, e.g. 'outputs/statvar.dat'
+
+    Returns:
+        (str): ``path`` if it exists, otherwise the path of its gzip
+            ('.gz') or lzma ('.xz') compressed version if one exists,
+            otherwise ``path``
+    """
+    if os.path.exists(path):
+        return path
+    for suffix in COMPRESSED_SUFFIXES:
+        if os.path.exists(path + suffix):
+            return path + suffix
+
+    return path
+
+
+def open_output(path):
+    """
+    Open a PRMS text file for reading, decompressing it if its name, or the
+    name found by :func:`find_output`, ends with '.gz' or '.xz'.
+
+    Arguments:
+        path (str): file path
+
+    Returns:
+        text file object
+    """
+    path = find_output(path)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    if path.endswith('.xz'):
+        if lzma is None:
+            raise IOError('Reading {} requires the lzma module'.format(path))
+        return lzma.open(path, 'rt')
+
+    return open(path, 'r')
+
+
 def load_data_file(data_file):
     # changed function name for PEP 8 style
     warnings.warn("load_data_file is deprecated, please use "+\
@@ -225,6 +585,8 @@ def load_data_file(data_file):
 def load_data(data_file):
     """
     Read the data file and load into a datetime indexed Pandas dataframe object.
+    Like :func:`load_statvar` it reads gzip or lzma compressed files
+    transparently.
     
     Arguments: 
 	    data_file (str): data file path 
@@ -253,7 +615,8 @@ def load_data(data_file):
                    'mm',
                    'sec']
     # append to header list the variables present in the file
-    with open(data_file, 'r') as inf:
+    data_file = find_output(data_file)
+    with open_output(data_file) as inf:
         for idx, l in enumerate(inf):
 
             # first line always string identifier of the file- may use later
@@ -284,8 +647,8 @@ def load_data(data_file):
 
     # read data file into pandas dataframe object with correct header names
     missing_value = -999  # missing data representation
-    df = pd.read_csv(data_file, header=-1, skiprows=skip_line,
-                     delim_whitespace=True, na_values=[missing_value])
+    df = pd.read_csv(data_file, header=None, skiprows=skip_line,
+                     sep=r'\s+', na_values=[missing_value])
 
     # apply correct header names using metadata retrieved from file
     df.columns = column_list
@@ -343,4 +706,227 @@ def rmse(observed, modeled):
     return np.sqrt( sum((observed - modeled)**2) / len(observed) )
 
 
+def goodness_of_fit(observed, simulated, freq='daily', names=None,
+                    dates=None, log_epsilon=None, chunksize=1000):
+    """
+    Calculate goodness-of-fit metrics of many simulations at once.
+
+    All simulations are scored against the same observed time series in
+    vectorized NumPy operations, which is orders of magnitude faster than
+    calling :func:`nash_sutcliffe`, :func:`rmse` and :func:`percent_bias`
+    for each simulation. Days where the observed or the simulated value
+    is missing (NaN) are excluded for that simulation.
+
+    Arguments:
+        observed (pandas.Series or numpy.ndarray): observed time series of
+            length n_days, if a ``pandas.Series`` its datetime index gives
+            the dates for aggregation
+        simulated (numpy.ndarray or pandas.DataFrame): simulated values
+            of shape (n_sims, n_days) aligned with ``observed``, or a
+            ``DataFrame`` with the same index as ``observed`` and one
+            column per simulation
+
+    Keyword Arguments:
+        freq (str): 'daily' to score daily values, 'monthly' to score the
+            mean of each month of the year (12 values) or 'annual' to score
+            the mean of each year. Default 'daily'.
+        names (list or None): simulation names for the index of the
+            result, default the columns of a ``simulated`` ``DataFrame`` or
+            0 to n_sims - 1
+        dates (array_like or None): dates of the n_days values, only
+            needed for aggregation if ``observed`` has no datetime index
+        log_epsilon (float or None): constant added before taking
+            logarithms for LOG_NSE, default one hundredth of the mean
+            observed value
+        chunksize (int): number of simulations scored at once to limit
+            memory use
+
+    Returns:
+        (pandas.DataFrame): one row per simulation with the columns NSE
+            (Nash-Sutcliffe efficiency), RMSE (root mean squared error),
+            PBIAS (percent bias), COEF_DET (coefficient of determination,
+            R squared), KGE (Kling-Gupta efficiency) and LOG_NSE
+            (Nash-Sutcliffe efficiency of logarithms)
+
+    Raises:
+        ValueError: if the shapes of ``observed`` and ``simulated`` do not
+            match, ``freq`` is unknown or dates are missing for aggregation
+
+    Example:
+        Score 10,000 simulations of streamflow at monthly frequency,
+
+        >>> observed = pd.Series(flow, index=dates)
+        >>> simulated.shape
+            (10000, 3653)
+        >>> goodness_of_fit(observed, simulated, freq='monthly').head()
+    """
+    if isinstance(simulated, pd.DataFrame):
+        if names is None:
+            names = list(simulated.columns)
+        simulated = simulated.values.T
+    simulated = np.atleast_2d(np.asarray(simulated, dtype=float))
+
+    if dates is None and isinstance(observed, pd.Series):
+        dates = observed.index
+    observed = np.asarray(observed, dtype=float)
+
+    if simulated.shape[1] != observed.shape[0]:
+        raise ValueError(
+            'simulated must have shape (n_sims, {})'.format(len(observed))
+        )
+    if names is None:
+        names = np.arange(simulated.shape[0])
+
+    # one-hot matrix of days by aggregation period for aggregating by matmul
+    if freq == 'daily':
+        groups = None
+    elif freq in ('monthly', 'annual'):
+        if dates is None:
+            raise ValueError('dates are required for {} metrics'.format(freq))
+        dates = pd.DatetimeIndex(dates)
+        period = dates.month if freq == 'monthly' else dates.year
+        keys, inverse = np.unique(np.asarray(period), return_inverse=True)
+        groups = np.zeros((len(observed), len(keys)))
+        groups[np.arange(len(observed)), inverse] = 1
+    else:
+        raise ValueError('freq must be daily, monthly or annual')
+
+    if log_epsilon is None:
+        log_epsilon = np.nanmean(observed) / 100.
+    obs_nan = np.isnan(observed)
+
+    results = []
+    for first in range(0, simulated.shape[0], chunksize):
+        sim = simulated[first:first + chunksize]
+        obs = observed
+        chunk_groups = groups
+        sim_nan = np.isnan(sim)
+        if not sim_nan.any():
+            # usual case of complete simulations, drop missing observations
+            valid = None
+            if obs_nan.any():
+                obs = obs[~obs_nan]
+                sim = sim[:, ~obs_nan]
+                if groups is not None:
+                    chunk_groups = groups[~obs_nan]
+        else:
+            valid = ~(obs_nan | sim_nan)
+
+        if chunk_groups is not None:
+            if valid is None:
+                counts = chunk_groups.sum(axis=0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    obs = np.dot(obs, chunk_groups) / counts
+                    sim = np.dot(sim, chunk_groups) / counts
+                if not (counts > 0).all():
+                    valid = np.broadcast_to(counts > 0, sim.shape)
+            else:
+                counts = np.dot(valid, chunk_groups)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    obs = np.dot(np.where(valid, obs, 0), chunk_groups) / \
+                        counts
+                    sim = np.dot(np.where(valid, sim, 0), chunk_groups) / \
+                        counts
+                valid = counts > 0
+
+        results.append(_metrics(obs, sim, valid, log_epsilon))
+
+    df = pd.DataFrame(
+        np.vstack(results), index=names,
+        columns=['NSE', 'RMSE', 'PBIAS', 'COEF_DET', 'KGE', 'LOG_NSE']
+    )
+    df.columns.name = 'metrics'
+
+    return df
+
 
+def _moments(obs, sim, valid):
+    """
+    Count, sums, sums of squares, sums of products and sum of squared
+    errors of the valid entries of each row of sim and obs, valid is None
+    if all entries are valid which requires a 1-D obs. Values are shifted
+    by the observed mean to limit cancellation, the simulated moments are
+    derived from the errors to avoid another copy of sim.
+    """
+    if valid is None:
+        shift = obs.mean()
+        err = sim - obs
+        obs = obs - shift
+        n = np.full(sim.shape[0], float(sim.shape[1]))
+        obs_sum = np.full(sim.shape[0], obs.sum())
+        obs_sq = np.full(sim.shape[0], np.dot(obs, obs))
+        err_cross = np.dot(err, obs)
+    elif obs.ndim == 1:
+        # sums of obs over the valid entries of each row by products
+        weights = valid.astype(float)
+        shift = np.dot(weights, np.nan_to_num(obs)).sum() / weights.sum()
+        err = np.where(valid, sim - obs, 0)
+        obs = np.where(np.isnan(obs), 0, obs - shift)
+        n = weights.sum(axis=1)
+        obs_sum = np.dot(weights, obs)
+        obs_sq = np.dot(weights, obs**2)
+        err_cross = np.dot(err, obs)
+    else:
+        shift = obs[valid].mean() if valid.any() else 0.
+        err = np.where(valid, sim - obs, 0)
+        obs = np.where(valid, obs - shift, 0)
+        n = valid.sum(axis=1).astype(float)
+        obs_sum = obs.sum(axis=1)
+        obs_sq = np.einsum('ij,ij->i', obs, obs)
+        err_cross = np.einsum('ij,ij->i', err, obs)
+
+    sse = np.einsum('ij,ij->i', err, err)
+    sim_sum = err.sum(axis=1) + obs_sum
+    cross = err_cross + obs_sq
+    sim_sq = sse + 2 * err_cross + obs_sq
+
+    return shift, n, obs_sum, sim_sum, obs_sq, sim_sq, cross, sse
+
+
+def _metrics(obs, sim, valid, log_epsilon):
+    "Metrics of each row of sim against obs using entries where valid"
+    shift, n, obs_sum, sim_sum, obs_sq, sim_sq, cross, sse = \
+        _moments(obs, sim, valid)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        obs_var = obs_sq - obs_sum**2 / n
+        sim_var = sim_sq - sim_sum**2 / n
+        cov = cross - obs_sum * sim_sum / n
+        obs_total = obs_sum + n * shift
+
+        nse = 1 - sse / obs_var
+        rmse = np.sqrt(sse / n)
+        pbias = 100 * (sim_sum - obs_sum) / obs_total
+        r = cov / np.sqrt(obs_var * sim_var)
+        alpha = np.sqrt(sim_var / obs_var)
+        beta = (sim_sum + n * shift) / obs_total
+        kge = 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2)
+
+        # Nash-Sutcliffe of logarithms, excluding non-positive values
+        log_obs = np.log(obs + log_epsilon)
+        log_sim = sim + log_epsilon
+        np.log(log_sim, out=log_sim)
+        log_valid = np.isfinite(log_sim) & np.isfinite(log_obs)
+        if valid is not None:
+            log_valid &= valid
+        if log_valid.all() and obs.ndim == 1:
+            log_valid = None
+        _, n, obs_sum, _, obs_sq, _, _, sse = \
+            _moments(log_obs, log_sim, log_valid)
+        log_nse = 1 - sse / (obs_sq - obs_sum**2 / n)
+
+    return np.column_stack([nse, rmse, pbias, r**2, kge, log_nse])
+
+
+def _replace_file(src, dst):
+    """
+    Rename ``src`` to ``dst`` replacing ``dst`` if it exists, like
+    :func:`os.replace` which is not available on Python 2
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    if os.name == 'nt' and os.path.exists(dst):
+        # rename does not replace files on Windows
+        os.remove(dst)
+    os.rename(src, dst)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+'''
+warmstart.py -- holds ``WarmStart`` class for spinning up a PRMS model once
+and starting many simulations from the saved model state.
+'''
+
+import json
+import os
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from .control import Control
+from .parameters import _checksum
+from .simulation import Simulation
+
+OPJ = os.path.join
+
+
+class WarmStart(object):
+    '''
+    Model state saved by PRMS at the end of a spin-up simulation that
+    simulations of a calibration or scenario window start from.
+
+    PRMS writes its state variables to the *var_save_file* when
+    *save_vars_to_file* is 1 and initializes them from *var_init_file*
+    when *init_vars_from_file* is 1. :meth:`WarmStart.create` runs the
+    base model from its original start time to the day before the
+    simulation window once, saving the state. Simulations created with
+    :meth:`Simulation.from_data` with the ``warm_start`` keyword argument
+    then only simulate the window starting from that state.
+
+    A saved state is only valid for simulations with the same dimensions
+    and PRMS modules and with the same values of the parameters that
+    shape model storages, ``state_params``, as the spin-up. These are
+    verified by :meth:`WarmStart.check` before a simulation is created.
+    Other parameters, e.g. those resampled for calibrating solar
+    radiation or potential ET, may be modified freely.
+
+    Arguments:
+        spinup_dir (str): directory of a spin-up simulation created by
+            :meth:`WarmStart.create`
+
+    Attributes:
+        start_time (:class:`datetime.datetime`): first day of simulations
+            that start from the saved state
+        state_file (str): absolute path to the saved PRMS state file
+        state_params (tuple): parameters that must not be modified in
+            simulations using the saved state
+
+    Example:
+        Spin up the model until September 1995 and calibrate the last
+        water year only,
+
+        >>> params = Parameters('path/to/parameters')
+        >>> data = Data('path/to/data')
+        >>> warm = WarmStart.create(
+                params, data, 'path/to/control', 'spinup', '1995-10-01'
+            )
+        >>> overlay = ParameterOverlay(params)
+        >>> overlay['jh_coef'] = overlay['jh_coef'] * 1.1
+        >>> sim = Simulation.from_data(
+                data, overlay, 'path/to/control', 'sim_jh_coef',
+                warm_start=warm
+            )
+        >>> sim.run()
+
+    Raises:
+        RuntimeError: if ``spinup_dir`` does not hold a saved state
+    '''
+
+    # parameters that define model storage capacities and HRU geometry
+    state_params = (
+        'hru_area', 'hru_type', 'hru_percent_imperv', 'cov_type',
+        'covden_sum', 'covden_win', 'soil_type', 'soil_moist_max',
+        'soil_rechr_max', 'sat_threshold', 'carea_max', 'dprst_frac',
+        'hru_deplcrv', 'snarea_curve', 'gwstor_min'
+    )
+
+    metadata_file = 'warm_start.json'
+
+    def __init__(self, spinup_dir):
+        meta_path = OPJ(spinup_dir, self.metadata_file)
+        if not os.path.isfile(meta_path):
+            raise RuntimeError('No saved model state in ' + spinup_dir)
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        self.spinup_dir = spinup_dir
+        self.start_time = pd.to_datetime(meta['start_time']).to_pydatetime()
+        self.state_file = meta['state_file']
+        self.state_params = tuple(meta['state_params'])
+        self.metadata = meta
+
+    @classmethod
+    def create(cls, parameters, data, control, spinup_dir, start_time,
+               prms_exec='prms', state_params=None):
+        '''
+        Run a spin-up simulation of the base model that saves the model
+        state at the end of the day before ``start_time``.
+
+        Arguments:
+            parameters (:class:`Parameters`): base model parameters
+            data (:class:`Data`): model input data
+            control (str or :class:`Control`): path to base *control* file
+                or ``Control`` instance
+            spinup_dir (str): directory to run the spin-up simulation in,
+                overwritten if it exists
+            start_time (str or :class:`datetime.datetime`): first day of
+                simulations that start from the saved state
+
+        Keyword Arguments:
+            prms_exec (str): name of PRMS executable on $PATH or path to
+                executable
+            state_params (tuple or None): parameters that must not be
+                modified in simulations using the saved state, default
+                :attr:`WarmStart.state_params`
+
+        Returns:
+            :class:`WarmStart`
+
+        Raises:
+            ValueError: if ``start_time`` is not after the start of the
+                simulation period of ``control``
+            RuntimeError: if the spin-up simulation did not save a state
+        '''
+        control = control.copy() if isinstance(control, Control) \
+            else Control(control)
+        start_time = pd.to_datetime(start_time).to_pydatetime()
+        if not start_time > control.start_time:
+            raise ValueError(
+                'start_time must be after the control start_time {}'.format(
+                    control.start_time
+                )
+            )
+        if state_params is None:
+            state_params = cls.state_params
+
+        control.end_time = start_time - timedelta(days=1)
+        control['save_vars_to_file'] = 1
+        control['var_save_file'] = 'prms_ic.out'
+
+        sim = Simulation.from_data(data, parameters, control, spinup_dir)
+        sim.run(prms_exec=prms_exec)
+
+        state_file = os.path.abspath(OPJ(spinup_dir, 'outputs', 'prms_ic.out'))
+        if not os.path.isfile(state_file):
+            raise RuntimeError(
+                'PRMS did not save the model state to ' + state_file
+            )
+
+        meta = dict(
+            start_time=start_time.isoformat(),
+            state_file=state_file,
+            parameters=os.path.abspath(parameters.base_file),
+            dimensions=dict(parameters.dimensions),
+            modules=_modules(control),
+            state_params=list(state_params),
+            checksums=_state_checksums(parameters, state_params)
+        )
+
+        with open(OPJ(spinup_dir, cls.metadata_file), 'w') as f:
+            json.dump(meta, f, sort_keys=True, indent=4)
+
+        return cls(spinup_dir)
+
+    def check(self, parameters, control=None):
+        '''
+        Verify that a simulation with ``parameters`` and ``control`` can
+        start from the saved state.
+
+        Arguments:
+            parameters (:class:`Parameters`): simulation parameters
+
+        Keyword Arguments:
+            control (str or :class:`Control` or None): path to simulation
+                *control* file or ``Control`` instance, if given its PRMS
+                modules must match those of the spin-up
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: if the dimensions, modules or any parameter in
+                ``state_params`` differ from the spin-up simulation
+        '''
+        if dict(parameters.dimensions) != self.metadata['dimensions']:
+            raise ValueError(
+                'Parameter dimensions differ from spin-up in ' +
+                self.spinup_dir
+            )
+
+        if control is not None:
+            if not isinstance(control, Control):
+                control = Control(control)
+            if _modules(control) != self.metadata['modules']:
+                raise ValueError(
+                    'PRMS modules differ from spin-up in ' + self.spinup_dir
+                )
+
+        checksums = _state_checksums(parameters, self.state_params)
+        changed = sorted(
+            name for name, checksum in checksums.items()
+            if self.metadata['checksums'].get(name) != checksum
+        )
+        if changed:
+            raise ValueError(
+                'Saved model state in {} is invalid for modified '
+                'parameters: {}'.format(self.spinup_dir, ', '.join(changed))
+            )
+
+    def apply(self, control):
+        '''
+        Copy of ``control`` that starts at :attr:`WarmStart.start_time`
+        from the saved state.
+
+        Arguments:
+            control (str or :class:`Control`): path to *control* file or
+                ``Control`` instance
+
+        Returns:
+            :class:`Control`
+        '''
+        control = control.copy() if isinstance(control, Control) \
+            else Control(control)
+        control.start_time = self.start_time
+        control['init_vars_from_file'] = 1
+        control['var_init_file'] = self.state_file
+
+        return control
+
+
+def _modules(control):
+    "PRMS mode and modules selected in a control file"
+    return {
+        name: control[name] for name in control
+        if name.endswith('_module') or name == 'model_mode'
+    }
+
+
+def _state_checksums(parameters, names):
+    "Checksums of the parameters in names that exist in parameters"
+    valid = set(param['name'] for param in parameters.base_params)
+
+    return {
+        name: _checksum(np.asarray(parameters[name], dtype=float))
+        for name in names if name in valid
+    }
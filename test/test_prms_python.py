@@ -1,18 +1,30 @@
 from copy import copy
+import asyncio
 import json
 import glob
+import multiprocessing as mp
 import numpy as np
 import os
+import pandas as pd
 import re
 import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+import warnings
 
 from difflib import Differ
 from numpy.testing import assert_array_almost_equal
 
 from prms_python import (
-    modify_params, Parameters, Scenario, ScenarioSeries, Simulation,
-    SimulationSeries, Data
+    modify_params, Control, CostModel, JobQueue, Parameters, ParameterOverlay,
+    ResultCache, Retention, Scenario, ScenarioSeries, Simulation, SimulationSeries, Data,
+    WarmStart, ScratchSpace, WorkerPool, cache_statvar, goodness_of_fit, load_data,
+    load_statvar
+)
+from prms_python.util import (
+    kolmogorov_smirnov, nash_sutcliffe, pawn_indices, percent_bias, rmse
 )
 
 
@@ -73,6 +85,451 @@ class TestSimulationSeries(unittest.TestCase):
 
             shutil.rmtree(sdir)
 
+    def test_simulation_series_threads(self):
+        "Simulations run from threads should not change the working directory"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+        cwd = os.getcwd()
+
+        series = SimulationSeries(
+            Simulation.from_data(
+                data, parameters, control_path,
+                self.simulation_dir + 'thread' + str(i)
+            )
+            for i in range(4)
+        )
+        outputs = list(series.run(nproc=4, backend='thread').outputs_iter())
+
+        self.assertEqual(os.getcwd(), cwd)
+        for sim, out in zip(series.series, outputs):
+            self.assertEqual(sim.returncode, 0)
+            assert os.path.exists(out['statvar'])
+            assert os.path.exists(OPJ(out['simulation_dir'], 'inputs',
+                                      'control'))
+            shutil.rmtree(out['simulation_dir'])
+
+        self.assertRaises(ValueError, series.run, backend='cluster')
+
+    def test_simulation_series_results(self):
+        "Result records should be yielded for every simulation as it ends"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+
+        series = SimulationSeries(
+            Simulation.from_data(
+                data, parameters, control_path,
+                self.simulation_dir + 'results' + str(i)
+            )
+            for i in range(4)
+        )
+        records = list(series.iter_run(nproc=2, chunksize=2))
+        self.assertEqual(
+            sorted(r['simulation_dir'] for r in records),
+            sorted(s.simulation_dir for s in series.series)
+        )
+        for rec in records:
+            self.assertEqual(rec['returncode'], 0)
+            self.assertTrue(rec['wall_time'] >= 0)
+        # records of runs in worker processes update the parent's series
+        self.assertTrue(all(s.has_run for s in series.series))
+
+        # prms_exec is honored and failures are reported, not raised
+        failing = 'sh -c "echo bad parameter >&2; exit 3"'
+        series = SimulationSeries(
+            Simulation.from_data(
+                data, parameters, control_path,
+                self.simulation_dir + 'failing' + str(i)
+            )
+            for i in range(2)
+        )
+        series.run(prms_exec=failing, nproc=2)
+        for rec in series.results:
+            self.assertEqual(rec['returncode'], 3)
+            self.assertEqual(rec['stderr'], 'bad parameter')
+
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_series_asyncio(self):
+        "The asyncio backend should run all simulations and stream results"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+
+        def _series(name):
+            return SimulationSeries(
+                Simulation.from_data(
+                    data, parameters, control_path,
+                    self.simulation_dir + name + str(i)
+                )
+                for i in range(3)
+            )
+
+        series = _series('asyncio').run(nproc=2, backend='asyncio')
+        for sim in series.series:
+            self.assertEqual(sim.returncode, 0)
+
+        series = _series('stream')
+        done = []
+
+        async def _collect():
+            async for sim in series.iter_async(nproc=2):
+                done.append(sim)
+
+        asyncio.run(_collect())
+        self.assertEqual(
+            sorted(s.simulation_dir for s in done),
+            sorted(s.simulation_dir for s in series.series)
+        )
+        for sim in done:
+            assert os.path.exists(
+                OPJ(sim.simulation_dir, 'outputs', 'statvar.dat')
+            )
+
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_series_resources(self):
+        "Resource usage should be recorded per simulation and per series"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+
+        series = SimulationSeries(
+            Simulation.from_data(
+                data, parameters, control_path,
+                self.simulation_dir + 'resources' + str(i)
+            )
+            for i in range(3)
+        ).run(nproc=2, backend='thread')
+
+        statvar_size = os.path.getsize(OPJ('test', 'data', 'statvar'))
+        for rec in series.results:
+            self.assertTrue(rec['bytes_written'] >= statvar_size)
+            with open(OPJ(rec['simulation_dir'], 'resources.json')) as f:
+                self.assertEqual(json.load(f), rec)
+            if hasattr(os, 'wait4'):
+                self.assertTrue(rec['user_time'] >= 0)
+                self.assertTrue(rec['system_time'] >= 0)
+                self.assertTrue(rec['max_rss'] > 0)
+
+        report = series.resource_report()
+        self.assertEqual(report['n_sims'], 3)
+        self.assertEqual(report['n_failed'], 0)
+        self.assertEqual(report['nproc'], 2)
+        self.assertAlmostEqual(
+            report['sims_per_hour'], 3 * 3600.0 / series.elapsed
+        )
+        self.assertEqual(
+            report['bytes_written'],
+            sum(r['bytes_written'] for r in series.results)
+        )
+        if hasattr(os, 'wait4'):
+            self.assertTrue(0 <= report['core_utilization'] <= 1)
+            self.assertEqual(
+                report['max_rss'], max(r['max_rss'] for r in series.results)
+            )
+
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_series_scratch(self):
+        "Simulations should run in bounded scratch space keeping some outputs"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+        root = tempfile.mkdtemp()
+
+        # a slot left behind by a process that died is reclaimed
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        os.mkdir(OPJ(root, 'slot-0'))
+        with open(OPJ(root, 'slot-0', 'owner'), 'w') as f:
+            f.write(str(dead.pid))
+
+        scratch = ScratchSpace(root, max_sims=1, keep=('statvar.dat',),
+                               poll=0.01)
+        series = SimulationSeries(
+            Simulation.from_data(
+                data, parameters, control_path,
+                self.simulation_dir + 'scratch' + str(i)
+            )
+            for i in range(3)
+        ).run(nproc=3, backend='thread', scratch=scratch)
+
+        for rec in series.results:
+            sdir = rec['simulation_dir']
+            self.assertEqual(rec['returncode'], 0)
+            self.assertEqual(os.listdir(OPJ(sdir, 'outputs')),
+                             ['statvar.dat'])
+            self.assertEqual(sorted(os.listdir(OPJ(sdir, 'inputs'))),
+                             ['control', 'data', 'parameters'])
+            self.assertTrue(rec['bytes_written'] > 0)
+        self.assertEqual(os.listdir(root), [])
+
+        shutil.rmtree(root)
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_series_worker_pool(self):
+        "One WorkerPool should run several series and scenarios"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+        scenarios_dir = OPJ('test', 'data', 'tmp_pool_scenarios')
+
+        def _series(name):
+            return SimulationSeries(
+                Simulation.from_data(
+                    data, parameters, control_path,
+                    self.simulation_dir + name + str(i)
+                )
+                for i in range(2)
+            )
+
+        start_method = None
+        if 'forkserver' in getattr(mp, 'get_all_start_methods', list)():
+            start_method = 'forkserver'
+
+        with WorkerPool(nproc=2, start_method=start_method) as pool:
+            workers = list(pool._pool._pool)
+            # the backend is ignored when a pool is given
+            for name, backend in (('pool_a', 'process'),
+                                  ('pool_b', 'asyncio')):
+                series = _series(name).run(pool=pool, backend=backend)
+                for rec in series.results:
+                    self.assertEqual(rec['returncode'], 0)
+            scenarios = ScenarioSeries(tdd, scenarios_dir)
+            scenarios.build([
+                {'title': 'scaled', 'snow_adj': lambda x: x * 0.9}
+            ])
+            scenarios.run(pool=pool, backend='asyncio')
+            self.assertFalse(pool.closed)
+            # the same worker processes ran everything
+            self.assertEqual(list(pool._pool._pool), workers)
+
+        self.assertTrue(pool.closed)
+        self.assertRaises(RuntimeError, _series('closed').run, pool=pool)
+        self.assertRaises(ValueError, WorkerPool, backend='asyncio')
+
+        metadata = glob.glob(OPJ(scenarios_dir, '*', 'metadata.json'))
+        self.assertEqual(len(metadata), 1)
+        assert os.path.exists(
+            OPJ(os.path.dirname(metadata[0]), 'outputs', 'statvar.dat')
+        )
+        shutil.rmtree(scenarios_dir)
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_series_lookahead(self):
+        "Simulations should be built lazily while earlier ones run"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+        built = []
+
+        def _builder(i):
+            def build():
+                built.append(i)
+                return Simulation.from_data(
+                    data, parameters, control_path,
+                    self.simulation_dir + 'lazy' + str(i)
+                )
+            return build
+
+        series = SimulationSeries((_builder(i) for i in range(5)),
+                                  lookahead=2, build_nproc=2)
+        self.assertEqual(len(series), 5)
+        self.assertEqual(list(series.outputs_iter()), [])
+        self.assertEqual(built, [])
+        n_built = []
+        for rec in series.iter_run(nproc=1, backend='thread'):
+            self.assertEqual(rec['returncode'], 0)
+            n_built.append(len(built))
+        # at most lookahead simulations plus one being built are not done
+        self.assertTrue(n_built[0] <= 3)
+        self.assertEqual(sorted(built), list(range(5)))
+        self.assertEqual(
+            [sim.simulation_dir for sim in series.series],
+            [self.simulation_dir + 'lazy' + str(i) for i in range(5)]
+        )
+
+        # chunks larger than lookahead are limited to it instead of waiting
+        # for simulations that cannot be built yet
+        for backend in ('thread', 'process'):
+            for g in glob.glob(self.simulation_dir + 'lazy*'):
+                shutil.rmtree(g)
+            series = SimulationSeries((_builder(i) for i in range(5)),
+                                      lookahead=2)
+            series.run(nproc=2, backend=backend, chunksize=4)
+            self.assertEqual([rec['returncode'] for rec in series.results],
+                             [0] * 5)
+
+        def _fail():
+            raise RuntimeError('cannot build')
+        series = SimulationSeries(iter([_fail]), lookahead=1)
+        self.assertRaises(RuntimeError, series.run, backend='thread')
+        self.assertRaises(ValueError, SimulationSeries, [], lookahead=0)
+
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_series_costs(self):
+        "Simulations expected to take longest should be started first"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        root = tempfile.mkdtemp()
+
+        def _series(name):
+            sims = []
+            for i, end_time in enumerate(('1993-09-30', '1996-12-06',
+                                          '1994-09-30')):
+                control = Control(OPJ(tdd, 'control'))
+                control.end_time = end_time
+                sims.append(Simulation.from_data(
+                    data, parameters, control,
+                    self.simulation_dir + name + str(i)
+                ))
+            return SimulationSeries(sims)
+
+        # without history the longest simulation period goes first
+        series = _series('costs')
+        sims = series.series
+        costs = CostModel(OPJ(root, 'costs.json'))
+        records = list(series.iter_run(nproc=1, backend='thread',
+                                       costs=costs))
+        self.assertEqual([rec['simulation_dir'] for rec in records],
+                         [sims[i].simulation_dir for i in (1, 2, 0)])
+
+        learned = CostModel(OPJ(root, 'costs.json'))
+        self.assertEqual([g['n'] for g in learned.rates.values()], [3])
+        self.assertTrue(learned.predict(sims[1]) > learned.predict(sims[0]))
+
+        # simulations of the same period are ordered by the cost of earlier
+        # runs with similar parameters
+        def _scaled(name, scales):
+            sims = []
+            for i, scale in enumerate(scales):
+                p = ParameterOverlay(parameters)
+                p['jh_coef'] = parameters['jh_coef'] * scale
+                sims.append(Simulation.from_data(
+                    data, p, OPJ(tdd, 'control'),
+                    self.simulation_dir + name + str(i)
+                ))
+            return sims
+
+        similar = CostModel()
+        for sim, wall_time in zip(_scaled('history', (0.5, 1.0, 2.0)),
+                                  (1.0, 2.0, 4.0)):
+            sim.has_run, sim.returncode = True, 0
+            sim.wall_time = wall_time
+            similar.update(sim)
+        series = SimulationSeries(_scaled('similar', (0.6, 1.9, 1.1)))
+        records = list(series.iter_run(nproc=1, backend='thread',
+                                       costs=similar))
+        self.assertEqual([rec['simulation_dir'] for rec in records],
+                         [series.series[i].simulation_dir for i in (1, 2, 0)])
+        # features are the modified parameters, or read from an overlay file
+        self.assertEqual(list(series.series[0].param_features), ['jh_coef'])
+        p = ParameterOverlay(parameters)
+        p['snow_adj'] = parameters['snow_adj'] * 2
+        sim = Simulation.from_data(data, p, OPJ(tdd, 'control'),
+                                   self.simulation_dir + 'features',
+                                   overlay=True)
+        sim.param_features = None
+        similar.predict(sim)
+        self.assertEqual(list(sim.param_features), ['snow_adj'])
+
+        series = _series('given_costs')
+        records = list(series.iter_run(nproc=1, backend='thread',
+                                       costs=[1.0, 3.0, 2.0]))
+        self.assertEqual([rec['simulation_dir'] for rec in records],
+                         [series.series[i].simulation_dir for i in (1, 2, 0)])
+        self.assertRaises(ValueError, series.run, costs=[1.0])
+
+        shutil.rmtree(root)
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_series_job_queue(self):
+        "Worker processes should run simulations submitted to a job queue"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        control_path = OPJ(tdd, 'control')
+        root = tempfile.mkdtemp()
+        queue = JobQueue(root, poll=0.1)
+
+        workers = [
+            subprocess.Popen([
+                sys.executable, '-c',
+                'from prms_python.scripts.prmspy import prmspy; prmspy()',
+                'worker', root, '--idle-timeout', '3'
+            ])
+            for _ in range(2)
+        ]
+        series = SimulationSeries(
+            Simulation.from_data(
+                data, parameters, control_path,
+                self.simulation_dir + 'queue' + str(i)
+            )
+            for i in range(4)
+        ).run(queue=queue)
+        for rec in series.results:
+            self.assertEqual(rec['returncode'], 0)
+            assert os.path.exists(
+                OPJ(rec['simulation_dir'], 'outputs', 'statvar.dat')
+            )
+        self.assertEqual(queue.status(),
+                         {'pending': 0, 'running': 0, 'done': 4})
+        for p in workers:
+            self.assertEqual(p.wait(), 0)
+
+        # jobs of a worker that stopped touching them are run again
+        stale = JobQueue(root, stale_after=0)
+        job_ids = stale.submit(series.series[:1])
+        self.assertEqual(stale.claim()['id'], job_ids[0])
+        self.assertEqual(stale.requeue_stale(), 1)
+        self.assertEqual(stale.cancel(job_ids), 1)
+        self.assertEqual(stale.status()['pending'], 0)
+
+        # vanished jobs are skipped and a failed claim does not stop a
+        # worker thread
+        class _FlakyQueue(JobQueue):
+            failures = [OSError('shared directory unavailable')]
+
+            def claim(self):
+                if self.failures:
+                    raise self.failures.pop()
+                return JobQueue.claim(self)
+
+            def _job_ids(self, state):
+                ids = JobQueue._job_ids(self, state)
+                return ['vanished'] + ids if state == 'pending' else ids
+
+        flaky = _FlakyQueue(root, poll=0.1)
+        flaky.submit(series.series[:1])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(flaky.work(idle_timeout=1), 1)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(JobQueue(root).status(),
+                         {'pending': 0, 'running': 0, 'done': 5})
+
+        shutil.rmtree(root)
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
 
 class TestSimulation(unittest.TestCase):
     """
@@ -107,6 +564,8 @@ class TestSimulation(unittest.TestCase):
         self.assertIn('prms_ic.out', g)
         self.assertIn('prms.out', g)
         self.assertIn('statvar.dat', g)
+        # the result record is only saved with a simulation_dir
+        self.assertNotIn('resources.json', g)
 
     def test_simulation_w_simdir(self):
         "Simulation should create sim dir with inputs and outputs directory when simulation_dir is specified"
@@ -157,6 +616,205 @@ class TestSimulation(unittest.TestCase):
         # clean up
         shutil.rmtree(test_dir)
 
+    def test_simulation_retention(self):
+        "Only kept outputs should remain, compressed and still loadable"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        expected = load_statvar(OPJ(self.test_data_dir, 'statvar'))
+
+        retention = Retention(keep=('statvar.dat',), compress='gzip')
+        s = Simulation.from_data(data, parameters, OPJ(tdd, 'control'),
+                                 self.simulation_dir, retention=retention)
+        s.run(cache_statvar=True)
+
+        outputs = OPJ(self.simulation_dir, 'outputs')
+        self.assertEqual(sorted(os.listdir(outputs)),
+                         ['statvar.dat.gz', 'statvar.dat.npy'])
+        os.remove(OPJ(outputs, 'statvar.dat.npy'))
+        loaded = load_statvar(OPJ(outputs, 'statvar.dat'))
+        self.assertTrue(loaded.index.equals(expected.index))
+        assert_array_almost_equal(loaded.values, expected.values)
+
+        self.assertRaises(ValueError, Retention, compress='zip')
+
+    def test_simulation_result_cache(self):
+        "Simulations with the same inputs should reuse cached outputs"
+        tdd = self.test_model_data_dir
+        data = Data(OPJ(tdd, 'data'))
+        parameters = Parameters(OPJ(tdd, 'parameters'))
+        root = tempfile.mkdtemp()
+        cache = ResultCache(root, max_entries=1)
+
+        sims = [
+            Simulation.from_data(data, parameters, OPJ(tdd, 'control'),
+                                 self.simulation_dir + str(i))
+            for i in range(2)
+        ]
+        for s in sims:
+            s.run(cache=cache)
+        self.assertFalse(sims[0].cached)
+        self.assertTrue(sims[1].cached)
+        self.assertEqual(sims[1].result()['attempts'], 0)
+        statvar = OPJ(self.simulation_dir + '1', 'outputs', 'statvar.dat')
+        self.assertTrue(os.path.isfile(statvar))
+        self.assertEqual(cache.info()['entries'], 1)
+
+        # other parameters are a miss and evict the least recently used run
+        parameters['jh_coef'] = parameters['jh_coef'] * 1.1
+        s = Simulation.from_data(data, parameters, OPJ(tdd, 'control'),
+                                 self.simulation_dir + '2')
+        s.run(cache=cache)
+        self.assertFalse(s.cached)
+        self.assertEqual(cache.info()['entries'], 1)
+
+        # only digests of inputs named by paths outside the run directory
+        # are kept, not of inputs linked into it like in scratch space
+        from prms_python import cache as cache_module
+        base_params = os.path.realpath(OPJ(tdd, 'parameters'))
+        run_dir = OPJ(root, 'run')
+        os.mkdir(run_dir)
+        for name in ('data', 'parameters'):
+            os.symlink(os.path.abspath(OPJ(tdd, name)), OPJ(run_dir, name))
+
+        def _memoized():
+            return [k for k in cache_module._DIGESTS if k[0] == base_params]
+
+        control = Control(OPJ(tdd, 'control'))
+        control.write(OPJ(run_dir, 'control'))
+        cache.key(['prms', 'control'], run_dir)
+        self.assertEqual(_memoized(), [])
+        control['param_file'] = [base_params]
+        control.write(OPJ(run_dir, 'control'))
+        cache.key(['prms', 'control'], run_dir)
+        self.assertEqual(len(_memoized()), 1)
+        self.assertTrue(
+            len(cache_module._DIGESTS) <= cache_module._MAX_DIGESTS
+        )
+
+        shutil.rmtree(root)
+        for g in glob.glob(self.simulation_dir + '*'):
+            shutil.rmtree(g)
+
+    def test_simulation_from_data_overlay(self):
+        """
+        With overlay=True only modified parameters should be written and the
+        control file should list the base parameters then the overlay
+        """
+        tdd = self.test_model_data_dir
+
+        data = Data(OPJ(tdd, 'data'))
+        base = Parameters(OPJ(tdd, 'parameters'))
+        overlay = ParameterOverlay(base)
+        overlay['rad_trncf'] = overlay['rad_trncf'] * 0.9
+        ctrl = OPJ(tdd, 'control')
+
+        s = Simulation.from_data(
+            data, overlay, ctrl, self.simulation_dir, overlay=True
+        )
+
+        p_overlay = Parameters(OPJ(self.simulation_dir, 'parameters'))
+        self.assertEqual(
+            [param['name'] for param in p_overlay.base_params], ['rad_trncf']
+        )
+        assert_array_almost_equal(
+            p_overlay['rad_trncf'], base['rad_trncf'] * 0.9
+        )
+
+        lines = open(OPJ(self.simulation_dir, 'control')).read().splitlines()
+        idx = lines.index('param_file')
+        self.assertEqual(
+            lines[idx + 1:idx + 5],
+            ['2', '4', os.path.abspath(base.base_file), 'parameters']
+        )
+        self.assertEqual(
+            lines[idx + 5:], open(ctrl).read().splitlines()[idx + 4:]
+        )
+
+        s.run()
+        assert_valid_output_dir(
+            self, os.path.join(self.simulation_dir, 'outputs')
+        )
+
+        # further parameter files of the control file are kept
+        two_files = Control(ctrl)
+        two_files['param_file'] = ['parameters', 'extra_parameters']
+        overlay_dir = self.simulation_dir + '_two_files'
+        Simulation.from_data(data, overlay, two_files, overlay_dir,
+                             overlay=True)
+        self.assertEqual(
+            Control(OPJ(overlay_dir, 'control'))['param_file'],
+            [os.path.abspath(base.base_file),
+             os.path.abspath(OPJ(tdd, 'extra_parameters')), 'parameters']
+        )
+        shutil.rmtree(overlay_dir)
+
+    @unittest.skipIf(os.name == 'nt', 'uses a POSIX shell as PRMS')
+    def test_simulation_timeout_retries(self):
+        "Hanging runs should be killed with their children and retried"
+        # a "PRMS" that hangs in a child process holding the stderr pipe
+        s = Simulation(self.test_model_data_dir, self.simulation_dir)
+        s.run(prms_exec='sh -c "sleep 30; true"', timeout=0.5, retries=1)
+        self.assertTrue(s.failed)
+        self.assertTrue(s.timed_out)
+        self.assertEqual(s.attempts, 2)
+        self.assertLess(s.wall_time, 10)
+        self.assertIn('timeout', s.stderr)
+        assert_valid_input_dir(self, OPJ(self.simulation_dir, 'inputs'))
+
+        # fails on the first attempt only
+        flaky = 'sh -c "test -f tried && exit 0; touch tried; exit 1"'
+        s = Simulation(self.test_model_data_dir, self.simulation_dir)
+        s.run(prms_exec=flaky, retries=2)
+        self.assertFalse(s.failed)
+        self.assertEqual(s.attempts, 2)
+        self.assertEqual(s.result()['attempts'], 2)
+
+        s = Simulation(self.test_model_data_dir, self.simulation_dir)
+        s.run(prms_exec='no-such-prms-executable')
+        self.assertEqual(s.returncode, 127)
+
+    def test_simulation_warm_start(self):
+        """
+        Simulations should start from a saved spin-up state unless parameters
+        that define the state were modified
+        """
+        tdd = self.test_model_data_dir
+
+        data = Data(OPJ(tdd, 'data'))
+        base = Parameters(OPJ(tdd, 'parameters'))
+        ctrl = OPJ(tdd, 'control')
+        spinup_dir = OPJ(self.simulation_dir, 'spinup')
+        os.makedirs(self.simulation_dir)
+
+        warm = WarmStart.create(
+            base, data, ctrl, spinup_dir, '1995-10-01',
+            state_params=('snow_adj',)
+        )
+        spinup_ctrl = Control(OPJ(spinup_dir, 'inputs', 'control'))
+        self.assertEqual(spinup_ctrl['end_time'], [1995, 9, 30, 0, 0, 0])
+        self.assertEqual(spinup_ctrl['save_vars_to_file'], [1])
+
+        overlay = ParameterOverlay(base)
+        overlay['rad_trncf'] = overlay['rad_trncf'] * 0.9
+        sim_dir = OPJ(self.simulation_dir, 'sim')
+        Simulation.from_data(data, overlay, ctrl, sim_dir, warm_start=warm)
+
+        sim_ctrl = Control(OPJ(sim_dir, 'control'))
+        self.assertEqual(sim_ctrl['start_time'], [1995, 10, 1, 0, 0, 0])
+        self.assertEqual(sim_ctrl['init_vars_from_file'], [1])
+        self.assertEqual(
+            sim_ctrl['var_init_file'],
+            [os.path.abspath(OPJ(spinup_dir, 'outputs', 'prms_ic.out'))]
+        )
+
+        # modified state parameters invalidate the saved state
+        overlay['snow_adj'] = overlay['snow_adj'] * 1.1
+        self.assertRaises(
+            ValueError, Simulation.from_data, data, overlay, ctrl, sim_dir,
+            warm_start=warm
+        )
+
 
 class TestScenario(unittest.TestCase):
 
@@ -374,6 +1032,57 @@ def assert_valid_output_dir(test_case, d):
     test_case.assertIn('statvar.dat', go)
 
 
+class TestControl(unittest.TestCase):
+
+    def setUp(self):
+        self.test_control = os.path.join(
+            'test', 'data', 'models', 'lbcd', 'control'
+        )
+        self.temp_dir = os.path.join('test', 'data', 'tmp_control')
+        os.mkdir(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_faithful_copy(self):
+        "Control class should load and write an identical file"
+        out_path = os.path.join(self.temp_dir, 'control')
+        Control(self.test_control).write(out_path)
+
+        self.assertEqual(
+            open(out_path).read(), open(self.test_control).read()
+        )
+
+    def test_control_edits(self):
+        "Edits should be written and leave the original Control unchanged"
+        c = Control(self.test_control)
+        c_mod = c.copy()
+        c_mod.start_time = '1993-10-01'
+        c_mod.end_time = '1994-09-30'
+        c_mod.statvar_names = ['basin_sroff_cfs', ('hru_ppt', 3)]
+        c_mod.disable_outputs()
+        c_mod['param_file'] = ['base_parameters', 'parameters']
+
+        out_path = os.path.join(self.temp_dir, 'control')
+        c_mod.write(out_path)
+        c_out = Control(out_path)
+
+        self.assertEqual(c_out['start_time'], [1993, 10, 1, 0, 0, 0])
+        self.assertEqual(c_out.end_time.year, 1994)
+        self.assertEqual(c_out['nstatVars'], [2])
+        self.assertEqual(
+            c_out.statvar_names, ['basin_sroff_cfs', 'hru_ppt']
+        )
+        self.assertEqual(c_out.statvar_elements, ['1', '3'])
+        self.assertEqual(c_out['save_vars_to_file'], [0])
+        self.assertEqual(c_out['statsON_OFF'], [1])
+        self.assertEqual(
+            c_out['param_file'], ['base_parameters', 'parameters']
+        )
+        self.assertEqual(c.start_time.year, 1992)
+        self.assertEqual(c['nstatVars'], [41])
+
+
 class TestParameters(unittest.TestCase):
 
     def setUp(self):
@@ -408,6 +1117,204 @@ class TestParameters(unittest.TestCase):
 
         assert expected == generated
 
+    def test_load_parameters(self):
+        """
+        Bulk loading parameters in one pass should match item access
+        """
+        p = Parameters(self.test_param)
+        loaded = p.load()
+
+        names = [param['name'] for param in p.base_params]
+        self.assertEqual(sorted(loaded.keys()), sorted(names))
+
+        p_item = Parameters(self.test_param)
+        for name in names:
+            assert_array_almost_equal(loaded[name], p_item[name])
+            self.assertEqual(loaded[name].shape, p_item[name].shape)
+            self.assertIs(loaded[name], p[name])
+
+        self.assertRaises(KeyError, p.load, ['not_a_parameter'])
+
+    def test_string_parameters(self):
+        """
+        PRMS data type 4 parameters should load and write as strings
+        """
+        param_path = os.path.join(self.temp_dir, 'parameters')
+        shutil.copy(self.test_param, param_path)
+        with open(param_path, 'a') as f:
+            f.write('####\nsegment_name\n1\nnsub\n3\n4\nup\nmid\nlow\n')
+
+        p = Parameters(param_path)
+        self.assertEqual(p['segment_name'].tolist(), ['up', 'mid', 'low'])
+
+        p['segment_name'] = np.array(['a', 'b', 'c'])
+        out_path = os.path.join(self.temp_dir, 'string_params')
+        p.write(out_path)
+        self.assertEqual(
+            Parameters(out_path)['segment_name'].tolist(), ['a', 'b', 'c']
+        )
+        # the second instance reads the binary cache written by the first
+        for _ in range(2):
+            p_cached = Parameters(param_path, cache=True)
+            self.assertEqual(
+                p_cached['segment_name'].tolist(), ['up', 'mid', 'low']
+            )
+
+    def test_parameters_cache(self):
+        """
+        Binary parameter cache should be reused and rebuilt when stale
+        """
+        param_path = os.path.join(self.temp_dir, 'parameters')
+        shutil.copy(self.test_param, param_path)
+
+        p_text = Parameters(param_path)
+        p_first = Parameters(param_path, cache=True)
+        assert os.path.isfile(p_first.cache_file)
+
+        p_cached = Parameters(param_path, cache=True)
+        self.assertEqual(p_cached.dimensions, p_text.dimensions)
+        self.assertEqual(p_cached.base_params, p_text.base_params)
+        for param in p_text.base_params:
+            name = param['name']
+            assert_array_almost_equal(p_cached[name], p_text[name])
+
+        # modifying the base file invalidates the cache
+        p_text['rad_trncf'] = p_text['rad_trncf'] * 2
+        p_text.write(param_path + '_mod')
+        shutil.move(param_path + '_mod', param_path)
+        p_stale = Parameters(param_path, cache=True)
+        assert_array_almost_equal(p_stale['rad_trncf'], p_text['rad_trncf'])
+
+    def test_write_roundtrip(self):
+        """
+        Written parameters should read back with the same values, with
+        modified parameters written after the copied unmodified ones
+        """
+        out_path = os.path.join(self.temp_dir, 'roundtrip')
+        p = Parameters(self.test_param)
+        p['snow_adj'] = p['snow_adj'] * 1.1
+        p.write(out_path)
+
+        p_out = Parameters(out_path)
+        names = [param['name'] for param in p.base_params]
+        self.assertEqual(
+            [param['name'] for param in p_out.base_params],
+            [n for n in names if n != 'snow_adj'] + ['snow_adj']
+        )
+        for name in names:
+            assert_array_almost_equal(p_out[name], p[name])
+
+    def test_parameter_overlay(self):
+        """
+        Overlays should only store assigned arrays, never modify the base
+        and write all parameters with the overlay modifications
+        """
+        base = Parameters(self.test_param)
+        base_rad = base['rad_trncf'].copy()
+
+        overlay = ParameterOverlay(base)
+        overlay['rad_trncf'] = overlay['rad_trncf'] * 1.1
+        self.assertEqual(list(overlay.param_arrays.keys()), ['rad_trncf'])
+        assert_array_almost_equal(base['rad_trncf'], base_rad)
+
+        # arrays read through the overlay are read-only views of the base
+        with self.assertRaises(ValueError):
+            overlay['snow_adj'][0] = 0
+        self.assertRaises(ValueError, overlay.__setitem__, 'snow_adj',
+                          np.zeros(3))
+
+        overlay_out = os.path.join(self.temp_dir, 'overlay_out')
+        overlay.write(overlay_out)
+
+        p_out = Parameters(overlay_out)
+        assert_array_almost_equal(p_out['rad_trncf'], base_rad * 1.1)
+        assert_array_almost_equal(p_out['snow_adj'], base['snow_adj'])
+        assert_array_almost_equal(p_out['jh_coef'], base['jh_coef'])
+
+    def test_write_overlay_modified_only(self):
+        """
+        Overlay files should only hold assigned or in place modified
+        parameters, not parameters that were only read
+        """
+        p = Parameters(self.test_param)
+        p['rad_trncf'] = p['rad_trncf'] * 1.1
+        p['snow_adj'][0] = 0.5
+        p['jh_coef']
+
+        overlay_out = os.path.join(self.temp_dir, 'overlay_out')
+        p.write_overlay(overlay_out)
+        p_out = Parameters(overlay_out)
+        self.assertEqual(
+            sorted(param['name'] for param in p_out.base_params),
+            ['rad_trncf', 'snow_adj']
+        )
+        assert_array_almost_equal(p_out['snow_adj'], p['snow_adj'])
+
+        overlay = ParameterOverlay(p)
+        overlay['jh_coef'] = overlay['jh_coef'] * 2
+        overlay['jh_coef_hru']
+        overlay.write_overlay(overlay_out)
+        self.assertEqual(
+            sorted(param['name'] for param in Parameters(overlay_out).base_params),
+            ['jh_coef', 'rad_trncf', 'snow_adj']
+        )
+
+    def test_write_batch(self):
+        """
+        Batch writing should give the same files as writing each sample
+        """
+        n_samples = 3
+        scales = np.array([0.9, 1.0, 1.1]).reshape(n_samples, 1)
+        p = Parameters(self.test_param)
+        rad_stack = p['rad_trncf'] * scales
+
+        out_names = [
+            os.path.join(self.temp_dir, 'batch_{}'.format(i))
+            for i in range(n_samples)
+        ]
+        p.write_batch(out_names, {'rad_trncf': rad_stack}, nthreads=2)
+
+        expected_path = os.path.join(self.temp_dir, 'expected')
+        for i, out_name in enumerate(out_names):
+            p_expected = Parameters(self.test_param)
+            p_expected['rad_trncf'] = rad_stack[i]
+            p_expected.write(expected_path)
+
+            self.assertEqual(open(out_name).readlines()[2:],
+                             open(expected_path).readlines()[2:])
+
+        self.assertRaises(ValueError, p.write_batch, out_names,
+                          {'rad_trncf': rad_stack[:2]})
+
+    def test_param_array_budget(self):
+        """
+        Unmodified arrays should be evicted least recently used first to
+        stay within the memory budget, modified arrays should be kept
+        """
+        p_full = Parameters(self.test_param)
+        snow_bytes = p_full['snow_adj'].nbytes
+
+        p = Parameters(self.test_param, max_bytes=snow_bytes)
+        p['rad_trncf'] = p['rad_trncf'] * 2
+        jh_coef = p['jh_coef']
+        p['snow_adj']
+        info = p.cache_info()
+        self.assertEqual(info['misses'], 3)
+        self.assertEqual(info['evictions'], 1)
+        self.assertEqual(info['n_modified'], 1)
+        self.assertNotIn('jh_coef', p.param_arrays.keys())
+
+        # arrays modified in place after eviction are still written
+        jh_coef[0] = 1.0
+        out_path = os.path.join(self.temp_dir, 'budget_out')
+        p.write(out_path)
+
+        p_out = Parameters(out_path)
+        assert_array_almost_equal(p_out['rad_trncf'], p_full['rad_trncf'] * 2)
+        assert_array_almost_equal(p_out['jh_coef'][1:], p_full['jh_coef'][1:])
+        self.assertEqual(p_out['jh_coef'][0], 1.0)
+        assert_array_almost_equal(p_out['snow_adj'], p_full['snow_adj'])
+
     def test_modify_params(self):
         "parameter and data file modification access should work as expected"
 
@@ -450,6 +1357,199 @@ class TestParameters(unittest.TestCase):
                 assert a == b
 
 
+class TestUtil(unittest.TestCase):
+
+    def setUp(self):
+        self.test_statvar = os.path.join('test', 'data', 'statvar')
+
+    def test_load_statvar_selective(self):
+        "Loading selected statvar columns and dates should match a full load"
+        full = load_statvar(self.test_statvar)
+        self.assertEqual(
+            list(full.columns),
+            ['basin_cfs_1', 'basin_potet_1', 'orad_1', 'runoff_57']
+        )
+
+        sel = load_statvar(
+            self.test_statvar, ['runoff_57', 'basin_cfs_1'],
+            start='1985-01-01', end='1985-12-31', dtype=np.float32
+        )
+        self.assertEqual(list(sel.columns), ['runoff_57', 'basin_cfs_1'])
+        self.assertEqual(sel.dtypes.tolist(), [np.float32, np.float32])
+        self.assertEqual(len(sel), 365)
+        assert_array_almost_equal(
+            sel.values,
+            full.loc['1985', ['runoff_57', 'basin_cfs_1']].values, decimal=2
+        )
+        self.assertRaises(
+            KeyError, load_statvar, self.test_statvar, 'basin_cfs'
+        )
+
+    def test_load_statvar_duplicate_columns(self):
+        "Variables listed twice in the statvar file should keep both columns"
+        temp_dir = os.path.join('test', 'data', 'tmp_statvar_dup')
+        os.mkdir(temp_dir)
+        try:
+            statvar = os.path.join(temp_dir, 'statvar.dat')
+            with open(self.test_statvar) as inf, open(statvar, 'w') as outf:
+                lines = inf.readlines()
+                outf.write('5\n')
+                outf.writelines(lines[1:5])
+                outf.write('basin_cfs 1\n')
+                for line in lines[5:]:
+                    values = line.split()
+                    if len(values) > 7:
+                        line = '{} {}\n'.format(line.rstrip(), values[7])
+                    # incomplete last line is copied as is
+                    outf.write(line)
+
+            text = load_statvar(statvar)
+            self.assertEqual(
+                list(text.columns),
+                ['basin_cfs_1', 'basin_potet_1', 'orad_1', 'runoff_57',
+                 'basin_cfs_1']
+            )
+            assert_array_almost_equal(
+                text.iloc[:, 0].values, text.iloc[:, 4].values
+            )
+
+            sel = load_statvar(statvar, ['orad_1', 'basin_cfs_1'])
+            self.assertEqual(
+                list(sel.columns), ['orad_1', 'basin_cfs_1', 'basin_cfs_1']
+            )
+
+            # the binary copy keeps the repeated columns too
+            cache_statvar(statvar)
+            cached = load_statvar(statvar)
+            self.assertEqual(list(cached.columns), list(text.columns))
+            assert_array_almost_equal(cached.values, text.values)
+            cached_sel = load_statvar(statvar, ['orad_1', 'basin_cfs_1'])
+            self.assertEqual(list(cached_sel.columns), list(sel.columns))
+            assert_array_almost_equal(cached_sel.values, sel.values)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_statvar_cache(self):
+        "Binary statvar copies should load the same data while up to date"
+        temp_dir = os.path.join('test', 'data', 'tmp_statvar')
+        os.mkdir(temp_dir)
+        try:
+            statvar = os.path.join(temp_dir, 'statvar.dat')
+            shutil.copy(self.test_statvar, statvar)
+            text = load_statvar(statvar)
+
+            cache_file = cache_statvar(statvar, dtype=np.float32)
+            self.assertTrue(os.path.isfile(cache_file))
+            cached = load_statvar(statvar)
+            self.assertEqual(cached.dtypes.tolist(), [np.float32] * 4)
+            self.assertTrue(cached.index.equals(text.index))
+            assert_array_almost_equal(cached.values, text.values, decimal=2)
+
+            window = load_statvar(
+                statvar, 'orad_1', start='1985-01-01', end='1985-12-31'
+            )
+            self.assertEqual(len(window), 365)
+
+            # a newer text file is read instead of the binary copy
+            mtime = os.path.getmtime(cache_file)
+            os.utime(statvar, (mtime + 10, mtime + 10))
+            self.assertEqual(
+                load_statvar(statvar).dtypes.tolist(), [np.float64] * 4
+            )
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_compressed(self):
+        "Compressed statvar and data files should load like the originals"
+        import gzip
+        temp_dir = os.path.join('test', 'data', 'tmp_compressed')
+        os.mkdir(temp_dir)
+        try:
+            data_file = os.path.join(
+                'test', 'data', 'models', 'lbcd', 'data'
+            )
+            expected = load_data(data_file)
+            self.assertEqual(expected.index.name, 'date')
+            for name, path in (('statvar.dat', self.test_statvar),
+                               ('data', data_file)):
+                with open(path, 'rb') as inf:
+                    with gzip.open(os.path.join(temp_dir, name + '.gz'),
+                                   'wb') as outf:
+                        shutil.copyfileobj(inf, outf)
+
+            statvar = os.path.join(temp_dir, 'statvar.dat')
+            self.assertTrue(load_statvar(statvar).equals(
+                load_statvar(self.test_statvar)
+            ))
+            self.assertTrue(load_statvar(statvar + '.gz', 'orad_1').equals(
+                load_statvar(self.test_statvar, 'orad_1')
+            ))
+            self.assertTrue(load_data(
+                os.path.join(temp_dir, 'data')
+            ).equals(expected))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_goodness_of_fit(self):
+        "Batched metrics should match the single simulation functions"
+        statvar = load_statvar(self.test_statvar)
+        observed = statvar['basin_cfs_1'].copy()
+        observed.iloc[::7] = np.nan
+        sims = np.vstack([
+            statvar['basin_cfs_1'].values * f for f in (0.8, 1.0, 1.1)
+        ])
+        sims[2, 10:20] = np.nan
+
+        result = goodness_of_fit(observed, sims, names=['a', 'b', 'c'])
+        self.assertEqual(list(result.index), ['a', 'b', 'c'])
+        for name, sim in zip(result.index, sims):
+            keep = observed.notnull().values & ~np.isnan(sim)
+            obs, mod = observed.values[keep], sim[keep]
+            self.assertAlmostEqual(
+                result.loc[name, 'NSE'], nash_sutcliffe(obs, mod)
+            )
+            self.assertAlmostEqual(result.loc[name, 'RMSE'], rmse(obs, mod))
+            self.assertAlmostEqual(
+                result.loc[name, 'PBIAS'], percent_bias(obs, mod)
+            )
+        self.assertAlmostEqual(result.loc['b', 'KGE'], 1.0)
+
+        monthly = goodness_of_fit(observed, sims[:2], freq='monthly')
+        obs_month = observed.groupby(observed.index.month).mean()
+        sim_month = pd.Series(sims[0], index=observed.index)[
+            observed.notnull()
+        ]
+        sim_month = sim_month.groupby(sim_month.index.month).mean()
+        self.assertAlmostEqual(
+            monthly.loc[0, 'NSE'], nash_sutcliffe(obs_month, sim_month)
+        )
+
+        self.assertRaises(
+            ValueError, goodness_of_fit, observed, sims, freq='weekly'
+        )
+
+    def test_kolmogorov_smirnov(self):
+        "Batched KS statistics should be exact, also with ties"
+        uncond = np.array([1., 2., 2., 3., 4., 5.])
+        cond = np.array([[2., 2., 2.], [6., 7., 8.], [1., 3., 5.]])
+        # largest distances at 2 for all twos, below 6 and at 1, 2 and 4
+        assert_array_almost_equal(
+            kolmogorov_smirnov(uncond, cond), [0.5, 1.0, 1. / 6]
+        )
+        self.assertAlmostEqual(kolmogorov_smirnov(uncond, cond[0]), 0.5)
+        # samples of different sizes
+        assert_array_almost_equal(
+            kolmogorov_smirnov(uncond, [cond[0], [6., 7.]]), [0.5, 1.0]
+        )
+
+        result = pawn_indices(
+            uncond, cond.reshape(1, 3, 3), names=['snow_adj']
+        )
+        self.assertEqual(list(result.index), ['snow_adj'])
+        self.assertAlmostEqual(result.loc['snow_adj', 'median'], 0.5)
+        self.assertAlmostEqual(result.loc['snow_adj', 'max'], 1.0)
+
+
 def colored_string_diff(s1, s2):
     """ Writes differences between strings s1 and s2 """
     d = Differ()